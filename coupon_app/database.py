@@ -0,0 +1,252 @@
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+from threading import Lock
+from typing import Any, NamedTuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import base, Connection
+from sqlalchemy.future import Engine
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import ClauseElement
+from sqlmodel import create_engine, Session
+
+from coupon_utils.slow_queries import SlowQueryLog
+from coupon_utils.tasks import TaskExecutor
+
+from .settings import Settings
+
+# The engines of at most this many settings are kept, e.g. of the application database and of the coupon shards,
+# so settings built on the fly, e.g. by the benchmarks, do not pile up engines.
+ENGINE_CACHE_SIZE = 32
+
+
+class Engines(NamedTuple):
+    """
+    The engines of the application database.
+
+    `reader` is only set in the SQLite production mode, otherwise every statement goes to `writer`.
+    """
+
+    writer: Engine
+    reader: Engine | None
+
+    def session(self) -> Session:
+        """
+        Returns a new session on the engines.
+        """
+        if self.reader is None:
+            return Session(self.writer)
+        return RoutingSession(self.writer, self.reader)
+
+
+class RoutingSession(Session):
+    """
+    A session sending plain reads to the reader engine and everything else to the writer engine.
+
+    Once a transaction used the writer, its reads go to the writer too, so they see its own uncommitted writes.
+    """
+
+    def __init__(self, writer: Engine, reader: Engine, **kwargs) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            writer: The engine of the writes.
+            reader: The engine of the reads.
+        """
+        super().__init__(bind=writer, **kwargs)
+        self._reader = reader
+        self._writing = False
+        event.listen(self, "after_transaction_end", self._on_transaction_end)
+
+    def get_bind(
+        self,
+        mapper: Any | None = None,
+        clause: ClauseElement | None = None,
+        bind: Connection | base.Engine | None = None,
+        _sa_skip_events: Any | None = None,
+        _sa_skip_for_implicit_returning: bool = False,
+    ) -> Connection | base.Engine:
+        if not self._writing and getattr(clause, "is_select", False):
+            return self._reader
+        if clause is not None or mapper is not None:
+            self._writing = True
+        return super().get_bind(mapper, clause, bind, _sa_skip_events, _sa_skip_for_implicit_returning)
+
+    def connection(self, *args, **kwargs):
+        # Statements executed on the connection are writes as far as the routing is concerned.
+        self._writing = True
+        return super().connection(*args, **kwargs)
+
+    def _on_transaction_end(self, session: Session, transaction) -> None:
+        if transaction.parent is None:
+            self._writing = False
+
+
+def set_pragmas(engine: Engine, pragmas: dict[str, object], begin: str) -> None:
+    """
+    Sets the pragmas of every new SQLite connection of the engine and the statement beginning its transactions.
+
+    The `sqlite3` module is told not to begin transactions on its own, so SQLAlchemy emits `begin` instead.
+
+    Arguments:
+        engine: A SQLite engine.
+        pragmas: Pragma values by name.
+        begin: `BEGIN`, `BEGIN IMMEDIATE` or `BEGIN EXCLUSIVE`.
+    """
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record) -> None:
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def on_begin(connection) -> None:
+        connection.exec_driver_sql(begin)
+
+
+def create_sqlite_engines(settings: Settings) -> Engines:
+    """
+    Creates the engines of the SQLite production mode.
+
+    The single writer connection begins its transactions with `BEGIN IMMEDIATE`: a transaction takes the write lock
+    before reading, so a redemption waits for the previous one instead of failing on a lock upgrade. Readers never
+    block the writer in WAL mode and run on their own pool of read-only connections.
+    """
+    pragmas = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "foreign_keys": "ON",
+        "busy_timeout": settings.sqlite_busy_timeout_ms,
+        "cache_size": -settings.sqlite_cache_size_kib,
+        "mmap_size": settings.sqlite_mmap_size,
+    }
+
+    def create_pooled_engine(pool_size: int) -> Engine:
+        return create_engine(
+            settings.database_url,
+            echo=settings.database_echo,
+            poolclass=QueuePool,
+            pool_size=pool_size,
+            max_overflow=0,
+            connect_args={"check_same_thread": False},
+        )
+
+    writer = create_pooled_engine(1)
+    set_pragmas(writer, pragmas, "BEGIN IMMEDIATE")
+    # The writer switches the database to WAL mode before a reader connects.
+    with writer.connect():
+        pass
+
+    reader = create_pooled_engine(settings.sqlite_reader_pool_size)
+    set_pragmas(reader, pragmas | {"query_only": "ON"}, "BEGIN")
+    return Engines(writer=writer, reader=reader)
+
+
+def create_slow_query_log(settings: Settings) -> SlowQueryLog | None:
+    """
+    Returns the slow-query log of the settings, if it is enabled.
+
+    Settings differing in other values share the log of the same file.
+    """
+    if settings.slow_query_threshold_ms is None:
+        return None
+    return _create_slow_query_log(
+        settings.slow_query_log_path, settings.slow_query_threshold_ms, settings.slow_query_explain_interval
+    )
+
+
+@lru_cache(maxsize=None)
+def _create_slow_query_log(path: str, threshold_ms: float, explain_interval: float) -> SlowQueryLog:
+    return SlowQueryLog(Path(path), threshold_ms / 1000, explain_interval)
+
+
+def create_task_executor(settings: Settings) -> TaskExecutor:
+    """
+    Returns the executor of the background tasks of the settings.
+
+    Settings differing in other values share the executor of the same task settings.
+    """
+    return _create_task_executor(
+        settings.task_workers,
+        settings.task_max_queued,
+        settings.task_batch_size,
+        settings.task_poll_interval,
+        settings.task_max_attempts,
+    )
+
+
+@lru_cache(maxsize=None)
+def _create_task_executor(
+    workers: int, max_queued: int, batch_size: int, poll_interval: float, max_attempts: int
+) -> TaskExecutor:
+    return TaskExecutor(
+        workers=workers,
+        max_queued=max_queued,
+        batch_size=batch_size,
+        poll_interval=poll_interval,
+        max_attempts=max_attempts,
+    )
+
+
+# The engines by settings, from the least to the most recently used.
+_engines: OrderedDict[Settings, Engines] = OrderedDict()
+_engines_lock = Lock()
+
+
+def create_engines(settings: Settings) -> Engines:
+    """
+    Creates the engines of the settings, once per settings among the `ENGINE_CACHE_SIZE` last used.
+
+    The engines of the least recently used settings are disposed, which closes their idle connections.
+    """
+    with _engines_lock:
+        engines = _engines.get(settings)
+        if engines is not None:
+            _engines.move_to_end(settings)
+            return engines
+        engines = _engines[settings] = _create_engines(settings)
+        while len(_engines) > ENGINE_CACHE_SIZE:
+            _, evicted = _engines.popitem(last=False)
+            for engine in filter(None, evicted):
+                engine.dispose()
+    return engines
+
+
+def _create_engines(settings: Settings) -> Engines:
+    if settings.sqlite_production and settings.database_url.startswith("sqlite"):
+        engines = create_sqlite_engines(settings)
+    elif settings.database_url.startswith("sqlite"):
+        engines = Engines(writer=create_engine(settings.database_url, echo=settings.database_echo), reader=None)
+    else:
+        writer = create_engine(
+            settings.database_url,
+            echo=settings.database_echo,
+            pool_size=settings.database_pool_size,
+            max_overflow=settings.database_max_overflow,
+        )
+        engines = Engines(writer=writer, reader=None)
+
+    slow_query_log = create_slow_query_log(settings)
+    if slow_query_log is not None:
+        # The plans are captured on the readers, the SQLite writer is kept for the writes.
+        slow_query_log.install(engines.writer, engines.reader)
+        if engines.reader is not None:
+            slow_query_log.install(engines.reader)
+    return engines
+
+
+@lru_cache(maxsize=ENGINE_CACHE_SIZE)
+def create_shard_engines(settings: Settings) -> tuple[Engines, ...]:
+    """
+    Creates the engines of the coupon shards, once per settings among the `ENGINE_CACHE_SIZE` last used.
+
+    Without shard URLs the coupons are stored in the application database, as a single shard.
+    """
+    if not settings.coupon_shard_urls:
+        return (create_engines(settings),)
+    return tuple(create_engines(settings.copy(update={"database_url": url})) for url in settings.coupon_shard_urls)
@@ -1,27 +1,71 @@
 from fastapi import FastAPI, Depends
 from fastapi.responses import RedirectResponse
+from pathlib import Path
 from sqlalchemy.future import Engine
-from sqlmodel import create_engine, Session, SQLModel
+from sqlmodel import Session, SQLModel
 from typing import Generator
 
+from coupon_utils.db import session_engine
+from coupon_utils.slow_queries import RequestContextMiddleware
+from coupon_utils.tasks import TaskExecutor, TaskMetrics
+from coupon_utils.tracing import (
+    Exporter,
+    FileExporter,
+    instrument_sqlalchemy,
+    MemoryExporter,
+    tracer,
+    TracingMiddleware,
+)
+
+from .database import create_engines, create_task_executor, Engines
 from .settings import get_settings, Settings
 
 
+def get_db_engines(settings: Settings = Depends(get_settings)) -> Engines:
+    """
+    Get the cached SQLAlchemy Engine instances.
+    """
+    return create_engines(settings)
+
+
 def get_db_engine(settings: Settings = Depends(get_settings)) -> "Engine":
     """
-    Create the SQLAlchemy Engine instance.
+    Get the cached SQLAlchemy Engine instance of the writes.
+    """
+    return create_engines(settings).writer
+
+
+def get_task_executor(settings: Settings = Depends(get_settings)) -> TaskExecutor:
+    """
+    Get the cached executor of the background tasks.
     """
-    return create_engine(settings.database_url, echo=settings.database_echo)
+    return create_task_executor(settings)
 
 
-def get_db_session(engine: "Engine" = Depends(get_db_engine)) -> Generator[Session, None, None]:
+def get_db_session(engines: Engines = Depends(get_db_engines)) -> Generator[Session, None, None]:
     """
     Session provider
     """
-    with Session(engine) as session:
+    with engines.session() as session:
         yield session
 
 
+def configure_tracing(settings: Settings) -> None:
+    """
+    Configures the tracer of the application from the settings, tracing is disabled with a zero sample rate.
+    """
+    if settings.tracing_sample_rate <= 0:
+        tracer.configure(0.0, None)
+        return
+    exporter: Exporter
+    if settings.tracing_export_path is None:
+        exporter = MemoryExporter()
+    else:
+        exporter = FileExporter(Path(settings.tracing_export_path), "coupon-api")
+    tracer.configure(settings.tracing_sample_rate, exporter)
+    instrument_sqlalchemy()
+
+
 def register_routes(app: FastAPI, *, api_prefix="/api/v1") -> None:
     """
     Registers all the routes of the application.
@@ -34,11 +78,15 @@ def register_routes(app: FastAPI, *, api_prefix="/api/v1") -> None:
     from coupon_model.customer.api import make_routes as make_customer_routes
     from coupon_model.reseller.api import make_routes as make_reseller_routes
     from coupon_model.coupon_customer_link.api import make_routes as make_coupon_customer_link_routes
+    from coupon_model.coupon_analytics.api import make_routes as make_coupon_analytics_routes
 
-    app.include_router(make_coupon_routes(session_provider=get_db_session), prefix=api_prefix)
+    app.include_router(
+        make_coupon_routes(session_provider=get_db_session, task_provider=get_task_executor), prefix=api_prefix
+    )
     app.include_router(make_customer_routes(session_provider=get_db_session), prefix=api_prefix)
     app.include_router(make_reseller_routes(session_provider=get_db_session), prefix=api_prefix)
     app.include_router(make_coupon_customer_link_routes(session_provider=get_db_session), prefix=api_prefix)
+    app.include_router(make_coupon_analytics_routes(session_provider=get_db_session), prefix=api_prefix)
 
 
 def create_app() -> FastAPI:
@@ -49,8 +97,15 @@ def create_app() -> FastAPI:
     from coupon_model.customer.metadata import metadata as customers_metadata
     from coupon_model.reseller.metadata import metadata as reseller_metadata
     from coupon_model.coupon_customer_link.metadata import metadata as coupon_customer_link_metadata
+    from coupon_model.coupon_analytics.metadata import metadata as coupon_analytics_metadata
 
-    tags_metadata = [coupons_metadata, customers_metadata, reseller_metadata, coupon_customer_link_metadata]
+    tags_metadata = [
+        coupons_metadata,
+        customers_metadata,
+        reseller_metadata,
+        coupon_customer_link_metadata,
+        coupon_analytics_metadata,
+    ]
 
     app = FastAPI(
         title="CouponAPI",
@@ -59,6 +114,13 @@ def create_app() -> FastAPI:
         openapi_tags=tags_metadata,
     )
     settings = get_settings()
+    if settings.coupon_shard_urls:
+        # The coupon routes address coupons by ID and the change feed by sequence number, both only unique per shard.
+        raise RuntimeError("The HTTP API does not serve sharded coupons, use the coupon_cli commands and services.")
+    configure_tracing(settings)
+    app.add_middleware(TracingMiddleware)
+    if settings.slow_query_threshold_ms is not None:
+        app.add_middleware(RequestContextMiddleware)
 
     # Init DB and create tables at startup
 
@@ -76,10 +138,29 @@ def create_app() -> FastAPI:
         # Initialize the database from SQLModel's metadata.
         SQLModel.metadata.create_all(engine)
 
+        # Run the tasks left in the database by a previous run.
+        get_task_executor(settings).watch(engine)
+
+    @app.on_event("shutdown")
+    def on_shutdown() -> None:
+        """
+        Stop the background tasks, the queued ones are stored in the database.
+        """
+        get_task_executor(settings).stop()
+
     # Routing
 
     register_routes(app, api_prefix=settings.api_prefix)
 
+    @app.get(f"{settings.api_prefix.rstrip('/')}/tasks/metrics", response_model=TaskMetrics, tags=["tasks"])
+    def task_metrics(
+        executor: TaskExecutor = Depends(get_task_executor), session: Session = Depends(get_db_session)
+    ) -> TaskMetrics:
+        """
+        Return the depth and the lag of the background task queues of the process.
+        """
+        return executor.metrics(session_engine(session))
+
     @app.get("/", response_class=RedirectResponse)
     def redirect_docs():
         return "/docs"
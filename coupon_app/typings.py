@@ -7,5 +7,4 @@ class SessionContextProvider(Protocol):
     Session context provider
     """
 
-    def __call__(self) -> Generator[Session, None, None]:
-        ...
+    def __call__(self) -> Generator[Session, None, None]: ...
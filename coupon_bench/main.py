@@ -0,0 +1,419 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+from pathlib import Path
+import random
+import statistics
+import string
+import time
+import tracemalloc
+from typing import Callable, Iterable
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import select as sql_select
+from sqlmodel import create_engine, select, Session, SQLModel
+from sqlalchemy.future import Engine
+from typer import Exit, Option, Typer
+
+from coupon_app.database import create_engines, Engines
+from coupon_app.settings import Settings
+
+from coupon_model import init_models
+from coupon_model.coupon.model import Cart, CartItem, Coupon, CouponTable, DiscountType
+from coupon_model.coupon.service import CouponService
+from coupon_model.coupon_analytics.service import CouponSnapshot
+from coupon_model.coupon_customer_link.model import CouponCustomerLinkTable
+from coupon_model.coupon_customer_link.service import CouponCustomerLinkService
+from coupon_model.customer.model import CustomerTable
+from coupon_model.customer.service import CustomerService
+from coupon_model.reseller.model import ResellerTable
+from coupon_utils.db import chunked, projection
+from coupon_utils.http import row_fields
+
+from .stress import print_report, StressReport, stress_redemptions
+
+app = Typer()
+
+
+@app.callback()
+def main():
+    """
+    Performance benchmarks against a throwaway database.
+    """
+
+
+def make_engine(url: str = "sqlite://") -> "Engine":
+    """
+    Creates an engine with an initialized database for a benchmark.
+    """
+    init_models()
+    engine = create_engine(url)
+    SQLModel.metadata.create_all(engine)
+    return engine
+
+
+def make_codes(count: int) -> list[str]:
+    """
+    Returns the given number of unique random coupon codes.
+    """
+    codes: set[str] = set()
+    while len(codes) < count:
+        codes.add("".join(random.choices(string.ascii_uppercase + string.digits, k=8)))
+    return list(codes)
+
+
+def seed_coupons(engine: "Engine", codes: list[str], reseller_id: int | None = None) -> None:
+    """
+    Inserts an active, currently valid coupon for each code.
+    """
+    now = datetime.utcnow()
+    rows = [
+        {
+            "code": code,
+            "description": "Benchmark",
+            "discount": random.randrange(1, 50),
+            "discount_type": DiscountType.fixed if i % 2 else DiscountType.percentage,
+            "is_active": True,
+            "valid_from": now - timedelta(days=1),
+            "valid_until": now + timedelta(days=1),
+            "created_at": now,
+            "updated_at": now,
+            "reseller_id": reseller_id,
+        }
+        for i, code in enumerate(codes)
+    ]
+    with Session(engine) as session:
+        session.execute(CouponTable.__table__.insert(), rows)  # type: ignore
+        session.commit()
+
+
+def seed_customers(engine: "Engine", count: int) -> list[int]:
+    """
+    Inserts the given number of customers.
+
+    Returns:
+        The IDs of the customers.
+    """
+    now = datetime.utcnow()
+    rows = [
+        {"username": f"customer{i}", "name": f"Customer {i}", "created_at": now, "updated_at": now}
+        for i in range(count)
+    ]
+    with Session(engine) as session:
+        session.execute(CustomerTable.__table__.insert(), rows)  # type: ignore
+        session.commit()
+        return list(session.scalars(sql_select(CustomerTable.id)))
+
+
+def seed_links(engine: "Engine", links: Iterable[tuple[int, int]]) -> None:
+    """
+    Links the coupon and customer ID pairs.
+    """
+    with Session(engine) as session:
+        session.execute(
+            CouponCustomerLinkTable.__table__.insert(),  # type: ignore
+            [{"coupon_id": coupon_id, "customer_id": customer_id} for coupon_id, customer_id in links],
+        )
+        session.commit()
+
+
+def measure_latency(name: str, calls: Iterable[Callable[[], object]]) -> list[float]:
+    """
+    Runs each call once and prints the latency distribution.
+
+    Returns:
+        The latencies in seconds.
+    """
+    latencies = []
+    for call in calls:
+        started = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - started)
+    percentiles = statistics.quantiles(latencies, n=100)
+    print(
+        f"{name}: mean {statistics.fmean(latencies) * 1e6:.0f} us, "
+        f"p50 {percentiles[49] * 1e6:.0f} us, p99 {percentiles[98] * 1e6:.0f} us"
+    )
+    return latencies
+
+
+def measure(name: str, count: int, unit: str, function: Callable[[], object], *, repeat: int = 3) -> float:
+    """
+    Runs the function a few times and prints the best throughput.
+
+    Returns:
+        The best time of a run in seconds.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    print(f"{name}: {best * 1000:.1f} ms, {count / best:,.0f} {unit}/s")
+    return best
+
+
+@app.command()
+def pricing(
+    coupons: int = Option(10_000, min=1, help="Number of coupons in the database."),
+    carts: int = Option(100_000, min=1, help="Number of carts in a batch."),
+    items: int = Option(3, min=0, help="Line items per cart."),
+    codes: int = Option(2, min=0, help="Coupon codes per cart."),
+):
+    """
+    Batch cart pricing throughput.
+    """
+    engine = make_engine()
+    all_codes = make_codes(coupons)
+    seed_coupons(engine, all_codes)
+
+    batch = [
+        Cart(
+            items=[
+                CartItem(price=random.randrange(100, 10_000), quantity=random.randrange(1, 4)) for _ in range(items)
+            ],
+            codes=random.sample(all_codes, min(codes, coupons)),
+        )
+        for _ in range(carts)
+    ]
+
+    with Session(engine) as session:
+        measure("price_carts", carts, "carts", lambda: CouponService(session).price_carts(batch))
+
+
+@app.command()
+def apply(
+    coupons: int = Option(5_000, min=2, help="Number of coupons applied by each variant."),
+    url: str = Option("sqlite:///bench.db", help="Database URL, the database is recreated."),
+):
+    """
+    Coupon redemption latency without and with the customer ownership check.
+    """
+    init_models()
+    engine = create_engine(url)
+    SQLModel.metadata.drop_all(engine)
+    SQLModel.metadata.create_all(engine)
+
+    codes = make_codes(2 * coupons)
+    seed_coupons(engine, codes)
+    customer_ids = seed_customers(engine, coupons)
+    with Session(engine) as session:
+        coupon_ids = {code: id for code, id in session.execute(sql_select(CouponTable.code, CouponTable.id))}
+
+    # Each customer owns one coupon of the second half and a decoy.
+    owned = codes[coupons:]
+    seed_links(engine, [(coupon_ids[code], customer_id) for code, customer_id in zip(owned, customer_ids)])
+    seed_links(engine, [(coupon_ids[code], customer_id) for code, customer_id in zip(codes, customer_ids)])
+
+    with Session(engine) as session:
+        service = CouponService(session)
+        measure_latency("apply", (partial(service.apply_by_code, code) for code in codes[:coupons]))
+        measure_latency(
+            "apply with customer",
+            (partial(service.apply_by_code, code, customer_id) for code, customer_id in zip(owned, customer_ids)),
+        )
+
+
+@app.command()
+def analytics(
+    coupons: int = Option(1_000_000, min=1, help="Number of coupons in the database."),
+    queries: int = Option(1_000, min=2, help="Number of measured queries."),
+):
+    """
+    Coupon snapshot load time, memory and aggregate query latency.
+    """
+    engine = make_engine()
+    for codes in chunked(make_codes(coupons), 100_000):
+        seed_coupons(engine, codes)
+
+    snapshot = CouponSnapshot()
+    with Session(engine) as session:
+        measure("full load", coupons, "coupons", lambda: snapshot.refresh(session), repeat=1)
+        # Every row is inside the overlap of the modification watermark, so this is the worst case.
+        measure("refresh", coupons, "coupons", lambda: snapshot.refresh(session), repeat=1)
+    print(f"memory: {snapshot.nbytes / len(snapshot):.1f} bytes per coupon")
+
+    now = datetime.utcnow()
+    measure("first summary (sorting)", coupons, "coupons", lambda: snapshot.summary(now), repeat=1)
+    measure_latency("summary", (lambda: snapshot.summary(now) for _ in range(queries)))
+    measure_latency("discounts", (lambda: snapshot.discounts(active_only=True) for _ in range(queries)))
+
+
+@app.command()
+def stress(
+    coupons: int = Option(1_000, min=1, help="Number of raced coupons."),
+    attempts: int = Option(5, min=1, help="Redemption attempts per coupon."),
+    workers: int = Option(32, min=1, help="Number of concurrent threads."),
+    url: str = Option("sqlite:///bench.db", help="Database URL, the database is recreated."),
+):
+    """
+    Concurrent redemptions of the same and different coupons, checking that each coupon is applied exactly once.
+
+    A SQLite database file is switched to WAL mode. Exits with status 1 if a coupon was applied more than once.
+    """
+    init_models()
+    sqlite = url.startswith("sqlite")
+    engine = create_engine(url) if sqlite else create_engine(url, pool_size=workers)
+    SQLModel.metadata.drop_all(engine)
+    SQLModel.metadata.create_all(engine)
+    if sqlite:
+        with engine.connect() as connection:
+            connection.exec_driver_sql("PRAGMA journal_mode=WAL")
+
+    now = datetime.utcnow()
+    with Session(engine) as session:
+        reseller = ResellerTable(name="Benchmark", created_at=now, updated_at=now)
+        session.add(reseller)
+        session.commit()
+        reseller_id = reseller.id
+    codes = make_codes(coupons)
+    seed_coupons(engine, codes, reseller_id)
+
+    report = stress_redemptions(lambda: Session(engine), codes, attempts, workers)
+    print_report(report)
+    if report.violations:
+        raise Exit(1)
+
+
+@app.command()
+def sqlite(
+    coupons: int = Option(2_000, min=1, help="Number of redeemed coupons."),
+    reads: int = Option(20_000, min=2, help="Number of coupon reads."),
+    workers: int = Option(16, min=1, help="Number of concurrent threads."),
+    path: str = Option("bench.db", help="SQLite database file, it is recreated."),
+):
+    """
+    Concurrent reads and redemptions with the default SQLite configuration and the production mode.
+    """
+    init_models()
+    for production in (False, True):
+        for suffix in ("", "-wal", "-shm"):
+            Path(path + suffix).unlink(missing_ok=True)
+        engines = create_engines(Settings(database_url=f"sqlite:///{path}", sqlite_production=production))
+        SQLModel.metadata.create_all(engines.writer)
+        codes = make_codes(coupons)
+        seed_coupons(engines.writer, codes)
+
+        def read(engines: Engines, code: str) -> float:
+            started = time.perf_counter()
+            with engines.session() as session:
+                CouponService(session).get_by_code(code)
+            return time.perf_counter() - started
+
+        print("production mode:" if production else "default configuration:")
+        started = time.perf_counter()
+        with ThreadPoolExecutor(workers) as executor:
+            latencies = list(executor.map(partial(read, engines), random.choices(codes, k=reads)))
+        elapsed = time.perf_counter() - started
+        read_report = StressReport(reads, elapsed, Counter(), latencies, [])
+        print(
+            f"reads: {read_report.throughput:,.0f}/s, p50 {read_report.percentile(0.5) * 1000:.2f} ms, "
+            f"p99 {read_report.percentile(0.99) * 1000:.2f} ms"
+        )
+        print_report(stress_redemptions(engines.session, codes, 2, workers))
+        for engine in filter(None, engines):
+            engine.dispose()
+
+
+@app.command()
+def lookups(
+    coupons: int = Option(10_000, min=1, help="Number of coupons in the database."),
+    calls: int = Option(20_000, min=1, help="Number of calls of each lookup."),
+):
+    """
+    Per-call CPU time of the hot lookups with statements built on every call and with the prebuilt statements.
+    """
+    engine = make_engine()
+    codes = make_codes(coupons)
+    seed_coupons(engine, codes)
+    customer_ids = seed_customers(engine, min(coupons, 1_000))
+    with Session(engine) as session:
+        coupon_ids = list(session.scalars(sql_select(CouponTable.id)))
+    seed_links(engine, zip(coupon_ids, customer_ids))
+    links = list(zip(coupon_ids, customer_ids))
+
+    variants = {
+        "get_by_code": (
+            lambda session, i: session.exec(select(CouponTable).where(CouponTable.code == codes[i % coupons])).first(),
+            lambda session, i: CouponService(session).get_by_code(codes[i % coupons]),
+        ),
+        "get_by_id": (
+            lambda session, i: session.get(CouponTable, coupon_ids[i % coupons]),
+            lambda session, i: CouponService(session).get_by_id(coupon_ids[i % coupons]),
+        ),
+        "customer get_by_id": (
+            lambda session, i: session.get(CustomerTable, customer_ids[i % len(customer_ids)]),
+            lambda session, i: CustomerService(session).get_by_id(customer_ids[i % len(customer_ids)]),
+        ),
+        "link get_by_ids": (
+            lambda session, i: session.get(
+                CouponCustomerLinkTable,
+                {"coupon_id": links[i % len(links)][0], "customer_id": links[i % len(links)][1]},
+            ),
+            lambda session, i: CouponCustomerLinkService(session).get_by_ids(*links[i % len(links)]),
+        ),
+    }
+    with Session(engine) as session:
+        for name, (built, prebuilt) in variants.items():
+            times = []
+            for variant in (built, prebuilt):
+                started = time.process_time()
+                for i in range(calls):
+                    variant(session, i)
+                    # Every lookup loads the row, as in a new request.
+                    session.expunge_all()
+                times.append((time.process_time() - started) / calls)
+            print(
+                f"{name}: built per call {times[0] * 1e6:.0f} us, prebuilt {times[1] * 1e6:.0f} us, "
+                f"saved {(times[0] - times[1]) * 1e6:.0f} us CPU per call"
+            )
+
+
+@app.command()
+def rows(
+    coupons: int = Option(10_000, min=1, help="Number of listed coupons."),
+    fields: str = Option("id,code,discount", help="Comma-separated fields of the sparse fieldset."),
+):
+    """
+    Memory and CPU time per listed coupon with table model instances, plain rows and a sparse fieldset of plain rows.
+    """
+    engine = make_engine()
+    seed_coupons(engine, make_codes(coupons))
+    all_fields = list(Coupon.__fields__)
+    sparse = fields.split(",")
+
+    def load_models(session: Session) -> list:
+        return session.exec(select(CouponTable)).all()
+
+    def serialize_models(items: list) -> object:
+        return jsonable_encoder([Coupon.from_orm(item) for item in items])
+
+    def load_rows(columns: list[str]) -> Callable[[Session], list]:
+        return lambda session: session.execute(projection(CouponTable, columns)).all()
+
+    def serialize_rows(columns: list[str]) -> Callable[[list], object]:
+        return lambda items: jsonable_encoder([row_fields(item, columns) for item in items])
+
+    variants = {
+        "table models": (load_models, serialize_models),
+        "plain rows": (load_rows(all_fields), serialize_rows(all_fields)),
+        f"plain rows ({fields})": (load_rows(sparse), serialize_rows(sparse)),
+    }
+    for name, (load, serialize) in variants.items():
+        with Session(engine) as session:
+            tracemalloc.start()
+            items = load(session)
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del items
+            session.expunge_all()
+
+            started = time.process_time()
+            serialize(load(session))
+            cpu = time.process_time() - started
+        print(f"{name}: {memory / coupons:,.0f} bytes, {cpu / coupons * 1e6:.1f} us CPU per coupon")
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,150 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import random
+import statistics
+import time
+from typing import Callable, NamedTuple
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import DBAPIError
+from sqlmodel import col, Session
+
+from coupon_model.coupon.model import CouponTable
+from coupon_model.coupon.service import CouponService
+from coupon_model.reseller.model import ResellerTable
+from coupon_utils.service import ValidationFailed
+
+# PostgreSQL error codes of the transactions aborted by a concurrent one.
+PG_ERRORS = {"40P01": "deadlock", "40001": "serialization failure"}
+
+
+class Attempt(NamedTuple):
+    """
+    The outcome of one redemption attempt.
+    """
+
+    code: str
+    # "applied", "unavailable" or the kind of the error.
+    outcome: str
+    latency: float
+
+
+class StressReport(NamedTuple):
+    """
+    The outcome of a redemption stress test.
+    """
+
+    attempts: int
+    elapsed: float
+    outcomes: Counter
+    latencies: list[float]
+    # Consistency violations, empty if every coupon was redeemed at most once.
+    violations: list[str]
+
+    @property
+    def throughput(self) -> float:
+        return self.attempts / self.elapsed
+
+    def percentile(self, fraction: float) -> float:
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+
+def classify(exception: BaseException) -> str:
+    """
+    Returns the kind of a redemption error, recognizing lock and serialization failures.
+    """
+    error: BaseException | None = exception
+    while error is not None:
+        if isinstance(error, DBAPIError):
+            code = getattr(error.orig, "pgcode", None)
+            if code in PG_ERRORS:
+                return PG_ERRORS[code]
+            if "database is locked" in str(error.orig):
+                return "database locked"
+            return type(error.orig).__name__
+        error = error.__cause__ or error.__context__
+    return type(exception).__name__
+
+
+def redeem(make_session: Callable[[], Session], code: str) -> Attempt:
+    """
+    Applies a coupon with its own session, as a request would.
+    """
+    started = time.perf_counter()
+    with make_session() as session:
+        try:
+            CouponService(session).apply_by_code(code)
+            outcome = "applied"
+        except ValidationFailed:
+            outcome = "unavailable"
+        except Exception as exception:
+            outcome = classify(exception)
+    return Attempt(code, outcome, time.perf_counter() - started)
+
+
+def stress_redemptions(
+    make_session: Callable[[], Session], codes: list[str], attempts: int, workers: int
+) -> StressReport:
+    """
+    Redeems every coupon `attempts` times from concurrent threads and checks that each was applied at most once.
+
+    The coupons must be active and valid. The attempts are shuffled, so the same code is raced by different
+    threads while other threads redeem different codes.
+
+    Arguments:
+        make_session: Returns a new session on the database with the coupons.
+        codes: The codes of the redeemed coupons.
+        attempts: The number of redemption attempts per code.
+        workers: The number of threads.
+    """
+    work = [code for code in codes for _ in range(attempts)]
+    random.shuffle(work)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(workers) as executor:
+        results = list(executor.map(lambda code: redeem(make_session, code), work))
+    elapsed = time.perf_counter() - started
+
+    applied = Counter(result.code for result in results if result.outcome == "applied")
+    violations = [f"{code} applied {count} times" for code, count in applied.items() if count > 1]
+
+    with make_session() as session:
+        redeemed = set(session.scalars(select(CouponTable.code).where(col(CouponTable.redeemed_at).isnot(None))))
+        for code in redeemed.intersection(codes) - applied.keys():
+            violations.append(f"{code} redeemed without a successful attempt")
+        for code in applied.keys() - redeemed:
+            violations.append(f"{code} applied but not redeemed")
+
+        counted = session.scalars(select(func.coalesce(func.sum(ResellerTable.redeemed_count), 0))).one()
+        expected = session.scalars(
+            select(func.count())
+            .select_from(CouponTable)
+            .where(col(CouponTable.redeemed_at).isnot(None), col(CouponTable.reseller_id).isnot(None))
+        ).one()
+        if counted != expected:
+            violations.append(f"resellers counted {counted} redemptions of {expected}")
+
+    return StressReport(
+        attempts=len(results),
+        elapsed=elapsed,
+        outcomes=Counter(result.outcome for result in results),
+        latencies=[result.latency for result in results],
+        violations=violations,
+    )
+
+
+def print_report(report: StressReport) -> None:
+    """
+    Prints the throughput, the latency distribution and the outcomes of a stress test.
+    """
+    print(f"attempts: {report.attempts}, {report.throughput:,.0f}/s")
+    print(
+        f"latency: mean {statistics.fmean(report.latencies) * 1000:.1f} ms, "
+        f"p50 {report.percentile(0.5) * 1000:.1f} ms, p99 {report.percentile(0.99) * 1000:.1f} ms, "
+        f"max {max(report.latencies) * 1000:.1f} ms"
+    )
+    for outcome, count in report.outcomes.most_common():
+        print(f"{outcome}: {count}")
+    for violation in report.violations:
+        print(f"VIOLATION: {violation}")
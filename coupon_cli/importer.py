@@ -0,0 +1,232 @@
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+import csv
+from enum import Enum
+import json
+from itertools import islice
+import os
+from pathlib import Path
+import time
+from typing import Any, Callable, Iterator, NamedTuple
+
+from pydantic import ValidationError
+from sqlmodel import Session
+from sqlalchemy.engine import Engine
+
+from coupon_model.coupon.model import CouponCreate
+from coupon_model.coupon.service import CouponService
+from coupon_model.customer.model import CustomerCreate
+from coupon_model.customer.service import CustomerService
+from coupon_utils.db import chunked
+
+
+class ImportKind(str, Enum):
+    """
+    The kind of the imported items.
+    """
+
+    coupons = "coupons"
+    customers = "customers"
+
+
+class FileFormat(str, Enum):
+    """
+    Supported import file formats.
+    """
+
+    csv = "csv"
+    ndjson = "ndjson"
+
+
+Row = dict[str, Any]
+
+
+class MalformedLine(NamedTuple):
+    """
+    An NDJSON line that is not valid JSON, it is rejected by the validation like an invalid row.
+    """
+
+    line: str
+    error: str
+
+
+_models = {
+    ImportKind.coupons: CouponCreate,
+    ImportKind.customers: CustomerCreate,
+}
+
+
+def read_rows(path: Path, file_format: FileFormat) -> Iterator[Row | MalformedLine]:
+    """
+    Streams the records of a CSV (with header) or NDJSON file one by one.
+
+    A malformed NDJSON line is streamed as a `MalformedLine`, so it does not abort the import.
+
+    Arguments:
+        path: The source file.
+        file_format: The format of the source file.
+    """
+    with path.open(newline="", encoding="utf-8") as file:
+        if file_format == FileFormat.csv:
+            yield from csv.DictReader(file)
+        else:
+            for line in file:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as exception:
+                    yield MalformedLine(line.rstrip("\r\n"), str(exception))
+
+
+def validate_rows(kind: ImportKind, rows: list[Row | MalformedLine]) -> tuple[list[Row], list[Row]]:
+    """
+    Validates raw rows with the creation model of the given kind.
+
+    Runs in a worker process, so it must stay a picklable module-level function.
+
+    Arguments:
+        kind: The kind of the imported items.
+        rows: Raw rows and malformed lines.
+
+    Returns:
+        The validated values and the rejected rows with the validation errors.
+    """
+    model = _models[kind]
+    valid: list[Row] = []
+    rejected: list[Row] = []
+    for row in rows:
+        if isinstance(row, MalformedLine):
+            rejected.append({"line": row.line, "error": f"Malformed JSON: {row.error}"})
+            continue
+        try:
+            valid.append(model(**row).dict())
+        except (ValidationError, TypeError) as exception:
+            rejected.append({"row": row, "error": str(exception)})
+    return valid, rejected
+
+
+class Checkpoint:
+    """
+    Tracks the number of committed source rows of an import in a side file, so a failed import can resume.
+    """
+
+    __slots__ = "_path"
+
+    def __init__(self, path: Path) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            path: The checkpoint file.
+        """
+        self._path = path
+
+    def load(self) -> int:
+        """
+        Returns the number of already committed source rows.
+        """
+        if not self._path.exists():
+            return 0
+        return int(json.loads(self._path.read_text())["rows"])
+
+    def save(self, rows: int) -> None:
+        """
+        Atomically stores the number of committed source rows.
+        """
+        tmp_path = self._path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps({"rows": rows}))
+        tmp_path.replace(self._path)
+
+    def clear(self) -> None:
+        """
+        Removes the checkpoint after a completed import.
+        """
+        self._path.unlink(missing_ok=True)
+
+
+def run_import(
+    engine: Engine,
+    kind: ImportKind,
+    path: Path,
+    *,
+    file_format: FileFormat,
+    chunk_size: int,
+    workers: int | None,
+    resume: bool,
+    report: Callable[[str], None] = print,
+) -> tuple[int, int]:
+    """
+    Streams a file into the database in chunks.
+
+    The chunks are validated in a process pool and upserted in order, one transaction per chunk. After each commit
+    the number of consumed source rows is stored in `<path>.checkpoint`, rejected rows are appended to
+    `<path>.rejected.ndjson`.
+
+    Arguments:
+        engine: The database engine.
+        kind: The kind of the imported items.
+        path: The source file.
+        file_format: The format of the source file.
+        chunk_size: The number of rows per chunk and transaction.
+        workers: The number of validator processes, defaults to the CPU count.
+        resume: Whether to skip the rows committed by a previous failed run.
+        report: Progress reporter.
+
+    Returns:
+        The number of imported and rejected rows.
+
+    Raises:
+        CommitFailed: If a chunk fails to commit. The import can be resumed.
+    """
+    checkpoint = Checkpoint(path.with_name(f"{path.name}.checkpoint"))
+    rejected_path = path.with_name(f"{path.name}.rejected.ndjson")
+
+    workers = workers or os.cpu_count() or 1
+    done = checkpoint.load() if resume else 0
+    if done:
+        report(f"Resuming after {done} rows")
+
+    rows = islice(read_rows(path, file_format), done, None)
+    imported = rejected_count = 0
+    started = time.perf_counter()
+
+    with (
+        ProcessPoolExecutor(max_workers=workers) as executor,
+        Session(engine) as session,
+        rejected_path.open("a" if done else "w", encoding="utf-8") as rejected_file,
+    ):
+        service = CouponService(session) if kind == ImportKind.coupons else CustomerService(session)
+
+        # Keep a bounded window of chunks in flight, so the file is never materialized.
+        window = 2 * workers
+        pending: deque[tuple[int, Future[tuple[list[Row], list[Row]]]]] = deque()
+
+        def commit_next() -> None:
+            nonlocal done, imported, rejected_count
+
+            size, future = pending.popleft()
+            valid, rejected = future.result()
+
+            service.upsert_many(valid)
+            for item in rejected:
+                rejected_file.write(json.dumps(item, default=str) + "\n")
+            rejected_file.flush()
+
+            done += size
+            imported += len(valid)
+            rejected_count += len(rejected)
+            checkpoint.save(done)
+
+            elapsed = time.perf_counter() - started
+            report(f"{done} rows, {imported} imported, {rejected_count} rejected, {imported / elapsed:.0f} rows/s")
+
+        for chunk in chunked(rows, chunk_size):
+            pending.append((len(chunk), executor.submit(validate_rows, kind, chunk)))
+            if len(pending) >= window:
+                commit_next()
+        while pending:
+            commit_next()
+
+    checkpoint.clear()
+    return imported, rejected_count
@@ -1,17 +1,27 @@
 from datetime import datetime, timedelta
+import os
+from pathlib import Path
 import random
 import string
+import time
 
 from sqlmodel import select, Session, SQLModel
-from typer import Typer
+from typer import Exit, Option, Typer
 
-from coupon_app.main import get_db_engine
+from coupon_app.database import create_engines, create_shard_engines
+from coupon_app.main import create_app, get_db_engine, get_task_executor
 from coupon_app.settings import get_settings
 from coupon_model import init_models  # noqa
 from coupon_model.coupon.model import CouponTable, CouponCreate, DiscountType
+from coupon_model.coupon.service import CouponService
+from coupon_model.coupon.sharding import ShardedCouponService
 from coupon_model.customer.model import CustomerTable, CustomerCreate
 from coupon_model.coupon_customer_link.model import CouponCustomerLinkTable
+from coupon_model.reseller.service import ResellerService
+from coupon_utils.slow_queries import read_log, summarize
 
+from .importer import FileFormat, ImportKind, run_import
+from .server import ServerOptions, Supervisor, worker_pool_size
 
 app = Typer()
 
@@ -107,6 +117,243 @@ def demo_fixture():
 
         session.commit()
 
+        CouponService(session).rebuild_available()
+
+
+def _import(
+    kind: ImportKind, path: Path, file_format: FileFormat | None, chunk_size: int, workers: int | None, resume: bool
+):
+    """
+    Runs a streaming import of the given kind.
+    """
+    if file_format is None:
+        file_format = FileFormat.csv if path.suffix.lower() == ".csv" else FileFormat.ndjson
+
+    # Create DB engine.
+    engine = get_db_engine(get_settings())
+
+    # Initialize the database from SQLModel's metadata.
+    SQLModel.metadata.create_all(engine)
+
+    imported, rejected = run_import(
+        engine,
+        kind,
+        path,
+        file_format=file_format,
+        chunk_size=chunk_size,
+        workers=workers,
+        resume=resume,
+    )
+    print(f"Done: {imported} {kind.value} imported, {rejected} rejected")
+
+
+@app.command()
+def import_coupons(
+    path: Path = Option(..., exists=True, dir_okay=False, help="CSV or NDJSON file with coupons."),
+    file_format: FileFormat = Option(None, "--format", help="Defaults to the file extension."),
+    chunk_size: int = Option(5000, min=1, help="Rows per transaction."),
+    workers: int = Option(None, min=1, help="Validator processes, defaults to the CPU count."),
+    resume: bool = Option(True, help="Continue after the last committed chunk of a failed run."),
+):
+    """
+    Streams coupons from a file, upserting them by code.
+    Rejected rows are written to <path>.rejected.ndjson.
+    """
+    _import(ImportKind.coupons, path, file_format, chunk_size, workers, resume)
+
+
+@app.command()
+def import_customers(
+    path: Path = Option(..., exists=True, dir_okay=False, help="CSV or NDJSON file with customers."),
+    file_format: FileFormat = Option(None, "--format", help="Defaults to the file extension."),
+    chunk_size: int = Option(5000, min=1, help="Rows per transaction."),
+    workers: int = Option(None, min=1, help="Validator processes, defaults to the CPU count."),
+    resume: bool = Option(True, help="Continue after the last committed chunk of a failed run."),
+):
+    """
+    Streams customers from a file, upserting them by username.
+    Rejected rows are written to <path>.rejected.ndjson.
+    """
+    _import(ImportKind.customers, path, file_format, chunk_size, workers, resume)
+
+
+@app.command()
+def recount_resellers():
+    """
+    Recompute the issued and redeemed coupon counters of the resellers.
+    """
+
+    # Create DB engine.
+    engine = get_db_engine(get_settings())
+
+    with Session(engine) as session:
+        ResellerService(session).recount()
+
+
+@app.command()
+def rebuild_available_coupons():
+    """
+    Rebuild the available coupons of the customers from the coupons and their links.
+    """
+
+    # Create DB engine.
+    engine = get_db_engine(get_settings())
+
+    with Session(engine) as session:
+        CouponService(session).rebuild_available()
+
+
+@app.command()
+def run_tasks():
+    """
+    Run the background tasks waiting in the database, e.g. stored while the application was stopping.
+    """
+
+    # Create DB engine.
+    engine = get_db_engine(get_settings())
+
+    count = get_task_executor(get_settings()).drain(engine)
+    print(f"Done: {count} tasks run")
+
+
+@app.command()
+def sweep_reservations(
+    batch_size: int = Option(1000, min=1, help="Leases cleared per transaction."),
+    every: float = Option(None, min=0.1, help="Sweep again after this many seconds, until interrupted."),
+):
+    """
+    Clear the expired coupon reservations.
+    """
+
+    # Create DB engine.
+    engine = get_db_engine(get_settings())
+
+    while True:
+        with Session(engine) as session:
+            released = CouponService(session).release_expired(batch_size)
+        print(f"Done: {released} expired reservations released")
+        if every is None:
+            return
+        time.sleep(every)
+
+
+@app.command()
+def archive_coupons(
+    days: int = Option(30, min=0, help="Archive the coupons expired or redeemed at least this many days ago."),
+    chunk_size: int = Option(1000, min=1, help="Coupons moved per transaction."),
+):
+    """
+    Move the expired and redeemed coupons to the archive tables.
+    """
+
+    # Create DB engine.
+    engine = get_db_engine(get_settings())
+
+    with Session(engine) as session:
+        archived = CouponService(session).archive(datetime.utcnow() - timedelta(days=days), chunk_size)
+    print(f"Done: {archived} coupons archived")
+
+
+@app.command()
+def slow_queries(
+    path: Path = Option(None, dir_okay=False, help="Slow-query log, SLOW_QUERY_LOG_PATH by default."),
+    top: int = Option(10, min=1, help="Number of statements to show."),
+):
+    """
+    Rank the statements of the slow-query log by total time, with their plan.
+    """
+    summaries = summarize(read_log(path or Path(get_settings().slow_query_log_path)))
+    for rank, summary in enumerate(summaries[:top], start=1):
+        print(
+            f"#{rank} total {summary.total * 1000:.1f} ms, {summary.calls} slow executions, "
+            f"mean {summary.total / summary.calls * 1000:.1f} ms, max {summary.max * 1000:.1f} ms"
+            + (", FULL SCAN" if summary.full_scan else "")
+        )
+        print(f"  {summary.statement}")
+        if summary.routes:
+            print(f"  routes: {', '.join(summary.routes)}")
+        if summary.services:
+            print(f"  services: {', '.join(summary.services)}")
+        for line in (summary.plan or "no plan captured").splitlines():
+            print(f"  | {line}")
+
+
+def _sharded_service() -> ShardedCouponService:
+    """
+    Creates the sharded coupon service of the configured shards, initializing their databases and the application
+    database.
+    """
+    settings = get_settings()
+    shared = create_engines(settings)
+    shards = create_shard_engines(settings)
+    for engines in (shared, *shards):
+        SQLModel.metadata.create_all(engines.writer)
+    return ShardedCouponService([engines.session for engines in shards], shared.session)
+
+
+@app.command()
+def rebalance_shards(chunk_size: int = Option(1000, min=1, help="Coupons read from a shard at once.")):
+    """
+    Move the coupons to the shard of their code after adding shards to COUPON_SHARD_URLS.
+    """
+    moved = _sharded_service().rebalance(chunk_size)
+    print(f"Done: {moved} coupons moved")
+
+
+@app.command()
+def export_coupons(path: Path = Option(..., dir_okay=False, help="NDJSON file to write.")):
+    """
+    Export the coupons of all the shards ordered by code, in the import format.
+    """
+    count = 0
+    with path.open("w", encoding="utf-8") as file:
+        for coupon in _sharded_service().export():
+            file.write(CouponCreate.from_orm(coupon).json() + "\n")
+            count += 1
+    print(f"Done: {count} coupons exported")
+
+
+@app.command()
+def serve(
+    host: str = Option("127.0.0.1", help="Bind address."),
+    port: int = Option(8000, help="Bind port."),
+    workers: int = Option(None, min=1, help="Worker processes, defaults to the CPU count."),
+    keep_alive: int = Option(5, min=1, help="Seconds an idle keep-alive connection stays open."),
+    backlog: int = Option(2048, min=1, help="Pending connections queued by the listening socket."),
+    max_requests: int = Option(10_000, min=0, help="Recycle a worker after this many requests, 0 to never."),
+    max_requests_jitter: int = Option(1000, min=0, help="Random extra requests per worker before it is recycled."),
+    connection_budget: int = Option(
+        None, min=1, help="Database connections of all the workers, DATABASE_CONNECTION_BUDGET by default."
+    ),
+):
+    """
+    Serve the API with worker processes, send SIGHUP to reload them gracefully.
+    """
+    workers = workers or os.cpu_count() or 1
+    budget = connection_budget or get_settings().database_connection_budget
+    if budget is not None:
+        try:
+            pool_size = worker_pool_size(budget, workers)
+        except ValueError as exception:
+            print(exception)
+            raise Exit(code=1)
+        # The workers read their settings from the environment they inherit.
+        os.environ["DATABASE_POOL_SIZE"] = str(pool_size)
+        os.environ["DATABASE_MAX_OVERFLOW"] = "0"
+        print(f"Database pool: {pool_size} connections per worker, {pool_size * workers} of {budget}")
+        # The settings were cached before the overrides.
+        get_settings.cache_clear()
+
+    # Build the application and initialize the database once, before the workers start in parallel.
+    create_app()
+    engine = get_db_engine(get_settings())
+    SQLModel.metadata.create_all(engine)
+    # The workers open their own connections, the supervisor keeps none.
+    engine.dispose()
+
+    options = ServerOptions(host, port, workers, keep_alive, backlog, max_requests, max_requests_jitter)
+    Supervisor(options).run()
+
 
 if __name__ == "__main__":
     app()
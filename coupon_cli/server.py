@@ -0,0 +1,135 @@
+import multiprocessing
+from multiprocessing.context import SpawnProcess
+import os
+import random
+import signal
+from socket import socket
+import time
+from typing import NamedTuple
+
+import uvicorn
+
+# The interval of the worker health checks of the supervisor, in seconds.
+CHECK_INTERVAL = 0.5
+
+
+class ServerOptions(NamedTuple):
+    """
+    The options of the multi-process server.
+    """
+
+    host: str
+    port: int
+    workers: int
+    keep_alive: int
+    backlog: int
+    # Requests served by a worker before it is recycled, 0 to never recycle.
+    max_requests: int
+    # A random number of requests up to this one is added to `max_requests` of each worker,
+    # so the workers are not all recycled at once.
+    max_requests_jitter: int
+
+
+def worker_pool_size(budget: int, workers: int) -> int:
+    """
+    Returns the database pool size of a worker, so all the workers together never open more than `budget` connections.
+
+    Raises:
+        ValueError: If the budget does not give a connection to each worker.
+    """
+    if budget < workers:
+        raise ValueError(f"A budget of {budget} connections cannot serve {workers} workers.")
+    return budget // workers
+
+
+def _run_worker(config: uvicorn.Config, sockets: list[socket]) -> None:
+    config.configure_logging()
+    uvicorn.Server(config).run(sockets=sockets)
+
+
+class Supervisor:
+    """
+    Runs the application in worker processes sharing one listening socket.
+
+    A worker exiting, e.g. recycled after its maximum number of requests, is replaced. On `SIGHUP`, the workers are
+    replaced one at a time, each new worker starting once its predecessor stopped gracefully: the others keep serving
+    the shared socket, and the workers never hold more than their database connection budget together.
+    `SIGINT` and `SIGTERM` stop the workers gracefully: they finish the requests in progress.
+    """
+
+    def __init__(self, options: ServerOptions) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            options: The server options.
+        """
+        self._options = options
+        self._workers: list[SpawnProcess] = []
+        self._context = multiprocessing.get_context("spawn")
+        self._socket: socket | None = None
+        self._reload = False
+        self._stop = False
+
+    def _config(self) -> uvicorn.Config:
+        options = self._options
+        max_requests = None
+        if options.max_requests:
+            max_requests = options.max_requests + random.randint(0, options.max_requests_jitter)
+        return uvicorn.Config(
+            "coupon_app:create_app",
+            factory=True,
+            host=options.host,
+            port=options.port,
+            backlog=options.backlog,
+            timeout_keep_alive=options.keep_alive,
+            limit_max_requests=max_requests,
+        )
+
+    def _spawn(self) -> SpawnProcess:
+        process = self._context.Process(target=_run_worker, args=(self._config(), [self._socket]))
+        process.start()
+        return process
+
+    def _on_reload(self, signum, frame) -> None:
+        self._reload = True
+
+    def _on_stop(self, signum, frame) -> None:
+        self._stop = True
+
+    def run(self) -> None:
+        """
+        Serves until `SIGINT` or `SIGTERM`.
+        """
+        self._socket = self._config().bind_socket()
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        print(f"Serving on http://{self._options.host}:{self._options.port} with {self._options.workers} workers")
+
+        self._workers = [self._spawn() for _ in range(self._options.workers)]
+        while not self._stop:
+            time.sleep(CHECK_INTERVAL)
+            if self._reload:
+                self._reload = False
+                for index, worker in enumerate(self._workers):
+                    if self._stop:
+                        break
+                    self._terminate([worker])
+                    self._workers[index] = self._spawn()
+                continue
+            for index, worker in enumerate(self._workers):
+                if not worker.is_alive() and not self._stop:
+                    worker.join()
+                    self._workers[index] = self._spawn()
+
+        self._terminate(self._workers)
+        self._socket.close()
+
+    @staticmethod
+    def _terminate(workers: list[SpawnProcess]) -> None:
+        for worker in workers:
+            if worker.is_alive() and worker.pid is not None:
+                os.kill(worker.pid, signal.SIGTERM)
+        for worker in workers:
+            worker.join()
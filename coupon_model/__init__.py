@@ -2,7 +2,8 @@ def init_models() -> None:
     """
     Register models to SQLModel's metadata
     """
-    from .coupon.model import CouponTable  # noqa
+    from .coupon.model import AvailableCouponTable, CouponArchiveTable, CouponChangeTable, CouponTable  # noqa
     from .customer.model import CustomerTable  # noqa
     from .reseller.model import ResellerTable  # noqa
-    from .coupon_customer_link.model import CouponCustomerLinkTable  # noqa
+    from .coupon_customer_link.model import CouponCustomerLinkArchiveTable, CouponCustomerLinkTable  # noqa
+    from coupon_utils.tasks import TaskDeadLetterTable, TaskTable  # noqa
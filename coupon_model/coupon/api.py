@@ -1,20 +1,80 @@
-from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+import time
+from typing import Callable, Iterator
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, status
+from fastapi.responses import StreamingResponse
 from sqlmodel import Session
 from typing_extensions import Annotated
 
 from coupon_app.typings import SessionContextProvider
+from coupon_utils.bulk import BulkResult
+from coupon_utils.http import (
+    conditional_response,
+    entity_tag,
+    json_response,
+    row_fields,
+    select_fields,
+    split_keys,
+    VALIDATOR_FIELDS,
+    weak_list_tag,
+)
 from coupon_utils.service import CommitFailed, NotFound, ValidationFailed
+from coupon_utils.tasks import TaskExecutor
 
-from .model import Coupon, CouponApplied, CouponCreate, CouponStatus, CouponUpdate
+from .model import (
+    Cart,
+    CartPrice,
+    Coupon,
+    CouponBatchItem,
+    CouponChangePage,
+    CouponBulkDelete,
+    CouponBulkUpdate,
+    CouponApplied,
+    CouponReservation,
+    CouponCreate,
+    CouponSearchPage,
+    CouponStatus,
+    CouponStatusQuery,
+    CouponStatusResult,
+    CouponUpdate,
+)
 from .service import CouponService
 
+# The maximum silence of a change stream, a comment is sent to keep the connection open.
+KEEP_ALIVE_SECONDS = 15.0
+
+
+def event_stream(service: CouponService, after: int, limit: int, duration: float) -> Iterator[str]:
+    """
+    Streams the coupon changes as Server-Sent Events for the given duration.
+    """
+    deadline = time.monotonic() + duration
+    # Reconnect right after the end of the stream.
+    yield "retry: 1000\n\n"
+    while True:
+        items = service.wait_for_changes(after, limit, min(KEEP_ALIVE_SECONDS, max(0.0, deadline - time.monotonic())))
+        for item in items:
+            yield f"id: {item.seq}\nevent: {item.operation.value}\ndata: {item.json()}\n\n"
+        if items:
+            after = items[-1].seq
+        elif time.monotonic() >= deadline:
+            return
+        else:
+            yield ": keep-alive\n\n"
+
 
-def make_routes(*, session_provider: SessionContextProvider) -> APIRouter:
+def make_routes(
+    *,
+    session_provider: SessionContextProvider,
+    task_provider: Callable[..., TaskExecutor | None] = lambda: None,
+) -> APIRouter:
     """
     Coupon `APIRouter` factory.
 
     Arguments:
         session_provider: Session context provider dependency.
+        task_provider: Task executor provider dependency, the side effects of the redemptions run after their commit
+            on the returned executor, or within their transaction if it is `None`.
     """
 
     router = APIRouter(
@@ -22,30 +82,136 @@ def make_routes(*, session_provider: SessionContextProvider) -> APIRouter:
         tags=["coupons"],
     )
 
-    def service_provider(session: Annotated[Session, Depends(session_provider)]) -> CouponService:
+    def service_provider(
+        session: Annotated[Session, Depends(session_provider)],
+        tasks: Annotated[TaskExecutor | None, Depends(task_provider)],
+    ) -> CouponService:
         """
         FastAPI dependency that creates a coupon service instance for the API.
         """
-        return CouponService(session)
+        return CouponService(session, tasks)
 
     ServiceProvider = Annotated[CouponService, Depends(service_provider)]
 
-    @router.get("/", response_model=list[Coupon])
-    def get_all(*, service: ServiceProvider, offset: int = 0, limit: int = Query(default=20, lte=50)):
+    @router.get("/", response_model=list[Coupon], responses={304: {"description": "Not modified."}})
+    def get_all(
+        *,
+        service: ServiceProvider,
+        response: Response,
+        offset: int = 0,
+        limit: int = Query(default=20, lte=50),
+        fields: str | None = Query(default=None, description="Comma-separated fields to return, all by default."),
+        if_none_match: Annotated[str | None, Header()] = None,
+    ):
         """
         Return all the coupons.
+
+        Pass `fields` to get only some fields of the coupons, the `id` is always returned.
+        The response has a weak `ETag`, send it in `If-None-Match` to get _304 Not Modified_ if the page is unchanged.
+        """
+        selected = select_fields(fields, Coupon)
+        coupons = service.get_rows(offset, limit, [*selected, *VALIDATOR_FIELDS])
+        etag = weak_list_tag((coupon.id, coupon.version) for coupon in coupons)
+        last_modified = max((coupon.updated_at for coupon in coupons), default=None)
+        return conditional_response(response, etag, last_modified, if_none_match) or json_response(
+            response, [row_fields(coupon, selected) for coupon in coupons]
+        )
+
+    @router.get("/search", response_model=CouponSearchPage)
+    def search(
+        *,
+        service: ServiceProvider,
+        q: str = Query(min_length=1, max_length=100),
+        limit: int = Query(default=20, lte=50),
+        after: str | None = None,
+    ):
         """
-        return service.get_all(offset, limit)
+        Search coupons by description.
+
+        The best matches come first.
+        Pass the returned `next` cursor as `after` to get the next page.
+        """
+        try:
+            items, next = service.search(q, limit, after)
+        except ValidationFailed as exception:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=exception.args)
+        return {"items": items, "next": next}
 
-    @router.get("/{id}", response_model=Coupon)
-    def get_by_id(*, service: ServiceProvider, id: int):
+    @router.get("/changes", response_model=CouponChangePage)
+    def changes(
+        *,
+        service: ServiceProvider,
+        after: int = 0,
+        limit: int = Query(default=100, lte=1000),
+        wait: float = Query(default=0, ge=0, le=300),
+        accept: Annotated[str | None, Header()] = None,
+        last_event_id: Annotated[int | None, Header()] = None,
+    ):
+        """
+        Return the coupon changes after a sequence number, with the current state of each changed coupon.
+
+        Long-poll: the response waits up to `wait` seconds for a change if there is none yet.
+        Pass the returned `next` as `after` to get the following changes.
+
+        Server-Sent Events: with `Accept: text/event-stream`, the changes are streamed for `wait` seconds.
+        The event ID is the sequence number, so a reconnecting client resumes with `Last-Event-ID`.
+
+        Arguments:
+        - **after**: The sequence number of the last known change, 0 for all the changes
+        - **limit**: The maximum number of changes of a response or event batch
+        - **wait**: The maximum waiting time, or the duration of the stream, in seconds
+        """
+        if last_event_id is not None:
+            after = max(after, last_event_id)
+        if accept is not None and "text/event-stream" in accept:
+            return StreamingResponse(event_stream(service, after, limit, wait), media_type="text/event-stream")
+
+        items = service.wait_for_changes(after, limit, wait)
+        return CouponChangePage(items=items, next=items[-1].seq if items else after)
+
+    @router.get("/batch", response_model=list[CouponBatchItem])
+    def get_many(
+        *,
+        service: ServiceProvider,
+        ids: str | None = Query(default=None, description="Comma-separated coupon IDs."),
+        codes: str | None = Query(default=None, description="Comma-separated coupon codes."),
+    ):
+        """
+        Return many coupons at once.
+
+        The coupons of the IDs come first, then the ones of the codes, in request order.
+        A coupon that does not exist is returned with a null `coupon`.
+        """
+        try:
+            keys = split_keys(ids, int), split_keys(codes, str)
+        except ValueError as exception:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=exception.args)
+        return service.get_many(*keys)
+
+    @router.get("/{id}", response_model=Coupon, responses={304: {"description": "Not modified."}})
+    def get_by_id(
+        *,
+        service: ServiceProvider,
+        response: Response,
+        id: int,
+        fields: str | None = Query(default=None, description="Comma-separated fields to return, all by default."),
+        if_none_match: Annotated[str | None, Header()] = None,
+    ):
         """
         Return a coupons by ID.
+
+        The response has an `ETag` and a `Last-Modified` header.
+        Send the `ETag` in `If-None-Match` to get _304 Not Modified_ if the coupon is unchanged.
+        Pass `fields` to get only some fields of the coupon, the `id` is always returned.
         """
-        coupon = service.get_by_id(id)
+        selected = select_fields(fields, Coupon)
+        coupon = service.get_row(id, [*selected, *VALIDATOR_FIELDS])
         if coupon is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Coupon not found.")
-        return coupon
+        etag = entity_tag(coupon.id, coupon.version)
+        return conditional_response(response, etag, coupon.updated_at, if_none_match) or json_response(
+            response, row_fields(coupon, selected)
+        )
 
     @router.post("/", status_code=status.HTTP_201_CREATED)
     def create_coupons(*, service: ServiceProvider, data: list[CouponCreate]):
@@ -69,6 +235,55 @@ def make_routes(*, session_provider: SessionContextProvider) -> APIRouter:
                 detail=exception.args,
             )
 
+    @router.post("/price", response_model=list[CartPrice])
+    def price_carts(*, service: ServiceProvider, data: list[Cart]):
+        """
+        Compute the final prices of many carts with their coupon codes, without applying the coupons.
+
+        Percentage discounts of a cart are summed up (capped at 100%) and applied first,
+        then the fixed discounts are subtracted. Unknown or unavailable codes are listed as rejected.
+
+        Arguments:
+        - **items**: The line items of the cart with _price_ and _quantity_
+        - **codes**: The coupon codes to apply
+        """
+        return service.price_carts(data)
+
+    @router.post("/bulk-update", response_model=BulkResult)
+    def bulk_update(*, service: ServiceProvider, data: CouponBulkUpdate):
+        """
+        Update many coupons selected by IDs or by a filter.
+
+        The coupons are updated in chunks of at most 1000 and every chunk is committed on its own,
+        so a large update never holds long locks. If a chunk fails, the previous chunks stay updated.
+
+        Arguments:
+        - **ids**: The IDs of the coupons, or
+        - **filter**: The attributes of the coupons
+        - **changes**: The new values, as in the update of one coupon
+        """
+        try:
+            return BulkResult(count=service.bulk_update(data))
+        except CommitFailed as exception:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=exception.args)
+
+    @router.post("/bulk-delete", response_model=BulkResult)
+    def bulk_delete(*, service: ServiceProvider, data: CouponBulkDelete):
+        """
+        Delete many coupons selected by IDs or by a filter.
+
+        The coupons are deleted in chunks and every chunk is committed on its own.
+        If a chunk fails, the previous chunks stay deleted.
+
+        Arguments:
+        - **ids**: The IDs of the coupons, or
+        - **filter**: The attributes of the coupons
+        """
+        try:
+            return BulkResult(count=service.bulk_delete(data))
+        except CommitFailed as exception:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=exception.args)
+
     @router.delete("/{id}")
     def delete_by_id(*, service: ServiceProvider, id: int):
         """
@@ -114,13 +329,30 @@ def make_routes(*, session_provider: SessionContextProvider) -> APIRouter:
         except NotFound:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Coupon not found: {id}.")
 
+    @router.post("/status", response_model=list[CouponStatusResult])
+    def coupon_statuses(*, service: ServiceProvider, data: CouponStatusQuery):
+        """
+        Returns the status of many coupons at once.
+
+        Arguments:
+        - **ids**: Coupon IDs
+        - **codes**: Coupon codes
+
+        The results follow the requested IDs, then the requested codes.
+        The status of an unknown coupon is _null_.
+        """
+        return service.status_many(data.ids, data.codes)
+
     @router.patch("/apply/{code}", response_model=CouponApplied)
-    def apply_by_code(*, service: ServiceProvider, code: str):
+    def apply_by_code(*, service: ServiceProvider, code: str, customer_id: int | None = None):
         """
         Apply a coupon.
+
+        Arguments:
+        - **customer_id**: If given, only a coupon linked to this customer can be applied
         """
         try:
-            return service.apply_by_code(code)
+            return service.apply_by_code(code, customer_id)
         except ValidationFailed:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"Coupon not available: {code}.")
         except NotFound:
@@ -128,4 +360,64 @@ def make_routes(*, session_provider: SessionContextProvider) -> APIRouter:
         except CommitFailed:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Failed to apply coupon: {code}.")
 
+    @router.patch("/reserve/{code}", response_model=CouponReservation)
+    def reserve_by_code(
+        *,
+        service: ServiceProvider,
+        code: str,
+        ttl: float = Query(default=300, gt=0, le=3600),
+        customer_id: int | None = None,
+    ):
+        """
+        Hold a coupon while the payment runs, then confirm or release it with the returned token.
+
+        Arguments:
+        - **ttl**: The duration of the reservation in seconds, the coupon is available again after it expires
+        - **customer_id**: If given, only a coupon linked to this customer can be reserved
+        """
+        try:
+            return service.reserve(code, ttl, customer_id)
+        except ValidationFailed:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"Coupon not available: {code}.")
+        except NotFound:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Coupon not found: {code}.")
+        except CommitFailed:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Failed to reserve coupon: {code}.")
+
+    @router.patch("/confirm/{code}", response_model=CouponApplied)
+    def confirm_by_code(*, service: ServiceProvider, code: str, token: str):
+        """
+        Apply a reserved coupon.
+
+        Arguments:
+        - **token**: The token of the reservation
+        """
+        try:
+            return service.confirm(code, token)
+        except ValidationFailed:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"Coupon not reserved: {code}.")
+        except NotFound:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Coupon not found: {code}.")
+        except CommitFailed:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Failed to confirm coupon: {code}.")
+
+    @router.patch("/release/{code}")
+    def release_by_code(*, service: ServiceProvider, code: str, token: str):
+        """
+        Release a reserved coupon, so it is available again.
+
+        Arguments:
+        - **token**: The token of the reservation
+        """
+        try:
+            service.release(code, token)
+        except ValidationFailed:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"Coupon not reserved: {code}.")
+        except NotFound:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Coupon not found: {code}.")
+        except CommitFailed:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Failed to release coupon: {code}.")
+
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
+
     return router
@@ -2,10 +2,12 @@ from typing import TYPE_CHECKING
 
 from datetime import datetime
 from enum import Enum
-from pydantic import BaseModel
-from sqlmodel import Column, DateTime, Field, Relationship, SQLModel
+from pydantic import BaseModel, root_validator
+from sqlmodel import BigInteger, Column, DateTime, Field, ForeignKey, Integer, Relationship, SQLModel
 
 from coupon_model.coupon_customer_link.model import CouponCustomerLinkTable
+from coupon_utils.bulk import BulkFilter, BulkSelection
+from coupon_utils.search import SearchIndex
 
 if TYPE_CHECKING:
     from coupon_model.customer.model import CustomerTable
@@ -33,6 +35,7 @@ class CouponBase(SQLModel):
     is_active: bool
     valid_from: datetime
     valid_until: datetime
+    reseller_id: int | None = Field(default=None, foreign_key="resellers.id", index=True)
 
 
 class CouponTable(CouponBase, table=True):
@@ -44,15 +47,127 @@ class CouponTable(CouponBase, table=True):
     """
 
     __tablename__ = "coupons"
+    # IDs are never reused on SQLite either, an archived coupon keeps its ID in the archive.
+    __table_args__ = {"sqlite_autoincrement": True}
 
     id: int | None = Field(default=None, primary_key=True)
     created_at: datetime | None = Field(
         default_factory=datetime.utcnow, sa_column=Column(DateTime(timezone=True), nullable=False)
     )
+    updated_at: datetime | None = Field(
+        default_factory=datetime.utcnow, sa_column=Column(DateTime(timezone=True), nullable=False)
+    )
+    # Incremented by every update, identifies the representation in the `ETag` header.
+    version: int = Field(default=1, sa_column_kwargs={"server_default": "1"})
+    redeemed_at: datetime | None = Field(default=None, sa_column=Column(DateTime(timezone=True), nullable=True))
+    # The lease of a pending two-phase redemption, held by the holder of the token until it expires.
+    reservation_token: str | None = None
+    reserved_until: datetime | None = Field(
+        default=None, sa_column=Column(DateTime(timezone=True), nullable=True, index=True)
+    )
 
     customers: list["CustomerTable"] = Relationship(back_populates="coupons", link_model=CouponCustomerLinkTable)
 
 
+coupon_search_index = SearchIndex(CouponTable, trigram_columns=("description",))
+
+
+class CouponArchiveTable(SQLModel, table=True):
+    """
+    Coupon archive
+    The expired and redeemed coupons moved out of the coupons table, with their original IDs.
+
+    Codes are not unique here, a code can be reused once its coupon is archived.
+    """
+
+    __tablename__ = "coupons_archive"
+
+    id: int = Field(primary_key=True, sa_column_kwargs={"autoincrement": False})
+    code: str = Field(index=True)
+    description: str
+    discount: int
+    discount_type: DiscountType
+    is_active: bool
+    valid_from: datetime
+    valid_until: datetime
+    reseller_id: int | None = Field(default=None, index=True)
+    created_at: datetime = Field(sa_column=Column(DateTime(timezone=True), nullable=False))
+    updated_at: datetime = Field(sa_column=Column(DateTime(timezone=True), nullable=False))
+    version: int
+    redeemed_at: datetime | None = Field(default=None, sa_column=Column(DateTime(timezone=True), nullable=True))
+    archived_at: datetime = Field(sa_column=Column(DateTime(timezone=True), nullable=False, index=True))
+
+
+class ChangeOperation(str, Enum):
+    """
+    Coupon change operations enum.
+    """
+
+    created = "created"
+    updated = "updated"
+    deleted = "deleted"
+    applied = "applied"
+    reserved = "reserved"
+    released = "released"
+    archived = "archived"
+
+
+class CouponChangeTable(SQLModel, table=True):
+    """
+    Coupon change
+    The outbox of the coupon changes, written in the transaction of the change.
+
+    The rows only identify the changed coupons, the change feed joins the current state of the coupons.
+    The sequence number is assigned when the transaction commits, so the sequence numbers follow the commit order.
+    """
+
+    __tablename__ = "coupon_changes"
+
+    id: int | None = Field(default=None, primary_key=True)
+    # Null until the commit of the change, see `assign_change_sequence()`.
+    seq: int | None = Field(default=None, sa_column=Column(BigInteger, nullable=True, unique=True))
+    coupon_id: int
+    code: str
+    operation: ChangeOperation
+    created_at: datetime = Field(sa_column=Column(DateTime(timezone=True), nullable=False))
+
+
+class AvailableCouponTable(SQLModel, table=True):
+    """
+    Available coupon
+    A projection of the active, unredeemed coupons linked to each customer, with their pricing columns.
+
+    The rows are kept up to date by the services writing the coupons and the links. The validity period is checked
+    when reading, so the rows do not change as time passes.
+    """
+
+    __tablename__ = "available_coupons"
+
+    customer_id: int = Field(
+        sa_column=Column(Integer, ForeignKey("customers.id", ondelete="CASCADE"), primary_key=True)
+    )
+    coupon_id: int = Field(
+        sa_column=Column(Integer, ForeignKey("coupons.id", ondelete="CASCADE"), primary_key=True, index=True)
+    )
+    code: str
+    discount: int
+    discount_type: DiscountType
+    valid_from: datetime
+    valid_until: datetime
+
+
+class AvailableCoupon(SQLModel):
+    """
+    A coupon a customer can use now.
+    """
+
+    coupon_id: int
+    code: str
+    discount: int
+    discount_type: DiscountType
+    valid_until: datetime
+
+
 class Coupon(CouponBase):
     """
     Coupon
@@ -63,6 +178,47 @@ class Coupon(CouponBase):
     created_at: datetime
 
 
+class CouponBatchItem(BaseModel):
+    """
+    A coupon requested by ID or code, `coupon` is null if the coupon does not exist.
+    """
+
+    id: int | None
+    code: str | None
+    coupon: Coupon | None
+
+
+class CouponChange(BaseModel):
+    """
+    A coupon change with the current state of the coupon, `coupon` is null if it was deleted since.
+    """
+
+    seq: int
+    operation: ChangeOperation
+    coupon_id: int
+    code: str
+    created_at: datetime
+    coupon: Coupon | None
+
+
+class CouponChangePage(BaseModel):
+    """
+    A page of the coupon change feed, pass `next` as `after` to get the following changes.
+    """
+
+    items: list[CouponChange]
+    next: int
+
+
+class CouponSearchPage(BaseModel):
+    """
+    A page of coupon search results, `next` is the cursor of the next page.
+    """
+
+    items: list[Coupon]
+    next: str | None
+
+
 class CouponCreate(CouponBase):
     """
     Coupon creation model.
@@ -72,6 +228,7 @@ class CouponCreate(CouponBase):
     - description
     - discount
     - discount_type
+    - reseller_id
     """
 
     pass
@@ -84,14 +241,45 @@ class CouponUpdate(SQLModel):
     Arguments:
     - description
     - discount
+    - is_active
     """
 
     description: str | None
     discount: int | None
+    is_active: bool | None
     valid_from: datetime | None
     valid_until: datetime | None
 
 
+class CouponFilter(BulkFilter):
+    """
+    Selects coupons by their attributes, the unset attributes match every coupon.
+    """
+
+    is_active: bool | None = None
+    discount_type: DiscountType | None = None
+    reseller_id: int | None = None
+    valid_until_before: datetime | None = None
+    valid_until_after: datetime | None = None
+
+
+class CouponBulkUpdate(BulkSelection):
+    """
+    Bulk coupon update request model, the coupons are selected by `ids` or `filter`.
+    """
+
+    filter: CouponFilter | None = None
+    changes: CouponUpdate
+
+
+class CouponBulkDelete(BulkSelection):
+    """
+    Bulk coupon delete request model, the coupons are selected by `ids` or `filter`.
+    """
+
+    filter: CouponFilter | None = None
+
+
 class CouponStatus(BaseModel):
     """
     Coupon status response model.
@@ -101,6 +289,31 @@ class CouponStatus(BaseModel):
     is_valid: bool
 
 
+class CouponStatusQuery(BaseModel):
+    """
+    Bulk coupon status request model.
+    """
+
+    ids: list[int] = []
+    codes: list[str] = []
+
+    @root_validator(skip_on_failure=True)
+    def check_size(cls, values):
+        if len(values["ids"]) + len(values["codes"]) > 10_000:
+            raise ValueError("At most 10000 ids and codes can be checked at once.")
+        return values
+
+
+class CouponStatusResult(BaseModel):
+    """
+    The status of a coupon requested by ID or code, `status` is null if the coupon does not exist.
+    """
+
+    id: int | None
+    code: str | None
+    status: CouponStatus | None
+
+
 class CouponApplied(BaseModel):
     """
     A discount earned by a used coupon.
@@ -108,3 +321,71 @@ class CouponApplied(BaseModel):
 
     discount: int
     discount_type: DiscountType
+
+
+class CouponReservation(BaseModel):
+    """
+    A coupon held for a pending redemption, confirm or release it with the token before it expires.
+    """
+
+    code: str
+    token: str
+    expires_at: datetime
+    discount: int
+    discount_type: DiscountType
+
+
+class CartItem(BaseModel):
+    """
+    A line item of a cart.
+    """
+
+    price: int = Field(ge=0)
+    quantity: int = Field(default=1, ge=1)
+
+
+class Cart(BaseModel):
+    """
+    A cart to price with the coupon codes to apply.
+    """
+
+    items: list[CartItem]
+    codes: list[str] = []
+
+
+class CartPrice(BaseModel):
+    """
+    The price of a cart after applying its coupons.
+
+    Percentage discounts are summed up (capped at 100%) and applied first, then the fixed discounts are subtracted.
+    The final price never goes below zero.
+    """
+
+    subtotal: int
+    discount: int
+    total: int
+    applied: list[str]
+    rejected: list[str]
+
+
+class BestCouponQuery(BaseModel):
+    """
+    A cart total to find the best coupons of a customer for.
+    """
+
+    subtotal: int = Field(ge=0)
+    # The number of coupons the cart accepts at once.
+    max_coupons: int = Field(default=1, ge=1, le=100)
+
+
+class BestCoupons(BaseModel):
+    """
+    The coupons giving the largest discount on a cart, priced as `CartPrice`.
+
+    The fewest coupons reaching the largest discount are chosen.
+    """
+
+    codes: list[str]
+    subtotal: int
+    discount: int
+    total: int
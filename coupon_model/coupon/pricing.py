@@ -0,0 +1,142 @@
+from bisect import bisect_left
+from datetime import datetime
+from itertools import accumulate
+from typing import NamedTuple
+
+import numpy as np
+
+from .model import BestCoupons, Cart, CartPrice, DiscountType
+
+
+class Discount(NamedTuple):
+    """
+    The pricing-relevant columns of a coupon.
+    """
+
+    code: str
+    discount: int
+    discount_type: DiscountType
+    is_active: bool
+    valid_from: datetime
+    valid_until: datetime
+
+    def is_available(self, now: datetime) -> bool:
+        """
+        Whether the coupon can be applied at the given time.
+        """
+        return self.is_active and self.valid_from <= now < self.valid_until
+
+
+def price_carts(carts: list[Cart], discounts: dict[str, Discount], now: datetime) -> list[CartPrice]:
+    """
+    Prices a batch of carts in one vectorized pass.
+
+    The line items and the applicable codes of all the carts are flattened into arrays indexed by cart, so the
+    subtotals and the discount sums are computed with one `bincount` each instead of a Python loop per cart.
+
+    Arguments:
+        carts: The carts to price.
+        discounts: The known coupons by code.
+        now: The time of the validity check.
+    """
+    cart_count = len(carts)
+
+    item_carts = np.fromiter((i for i, cart in enumerate(carts) for _ in cart.items), dtype=np.int64)
+    item_amounts = np.fromiter(
+        (item.price * item.quantity for cart in carts for item in cart.items), dtype=np.int64, count=len(item_carts)
+    )
+    subtotals = np.bincount(item_carts, weights=item_amounts, minlength=cart_count).astype(np.int64)
+
+    # Check the availability of each known coupon once instead of once per cart.
+    available = {
+        code: (discount.discount, discount.discount_type == DiscountType.percentage)
+        for code, discount in discounts.items()
+        if discount.is_available(now)
+    }
+
+    applied: list[list[str]] = [[] for _ in carts]
+    rejected: list[list[str]] = [[] for _ in carts]
+    code_carts: list[int] = []
+    code_values: list[int] = []
+    code_is_percentage: list[bool] = []
+    for i, cart in enumerate(carts):
+        # The same code applies only once per cart.
+        for code in dict.fromkeys(cart.codes):
+            if code not in available:
+                rejected[i].append(code)
+                continue
+            value, percentage = available[code]
+            applied[i].append(code)
+            code_carts.append(i)
+            code_values.append(value)
+            code_is_percentage.append(percentage)
+
+    cart_indexes = np.array(code_carts, dtype=np.int64)
+    values = np.array(code_values, dtype=np.int64)
+    is_percentage = np.array(code_is_percentage, dtype=bool)
+
+    percentages = np.bincount(cart_indexes, weights=np.where(is_percentage, values, 0), minlength=cart_count)
+    fixed = np.bincount(cart_indexes, weights=np.where(is_percentage, 0, values), minlength=cart_count)
+
+    percentages = np.clip(percentages, 0, 100).astype(np.int64)
+    totals = subtotals * (100 - percentages) // 100 - fixed.astype(np.int64)
+    totals = np.clip(totals, 0, None)
+
+    # The values are computed here, so the response models skip validation.
+    return [
+        CartPrice.construct(
+            subtotal=subtotal, discount=subtotal - total, total=total, applied=applied[i], rejected=rejected[i]
+        )
+        for i, (subtotal, total) in enumerate(zip(subtotals.tolist(), totals.tolist()))
+    ]
+
+
+def discounted_total(subtotal: int, percentage: int, fixed: int) -> int:
+    """
+    Returns the price of a cart after percentage and fixed discounts, as computed by `price_carts()`.
+    """
+    return max(0, subtotal * (100 - min(percentage, 100)) // 100 - fixed)
+
+
+def best_coupons(subtotal: int, discounts: list[Discount], max_coupons: int) -> BestCoupons:
+    """
+    Chooses the available coupons giving the largest discount on a cart, with at most `max_coupons` coupons.
+
+    The best choice with `p` percentage coupons takes the `p` largest percentages and the largest fixed amounts, so
+    the coupons of each type are sorted once and every split between the two types is checked with prefix sums. For a
+    split, the fewest fixed coupons reaching its best total are found by a binary search. The run time is
+    O(n log n) for n coupons.
+
+    Arguments:
+        subtotal: The cart total before the discounts.
+        discounts: The coupons that can be chosen, the ones not available at the moment are ignored.
+        max_coupons: The maximum number of coupons applied at once.
+    """
+    now = datetime.utcnow()
+    available = [discount for discount in discounts if discount.is_available(now)]
+    percentages = sorted(
+        (discount for discount in available if discount.discount_type == DiscountType.percentage),
+        key=lambda discount: discount.discount,
+        reverse=True,
+    )
+    fixed = sorted(
+        (discount for discount in available if discount.discount_type != DiscountType.percentage),
+        key=lambda discount: discount.discount,
+        reverse=True,
+    )
+    percentage_sums = [0, *accumulate(discount.discount for discount in percentages)]
+    fixed_sums = [0, *accumulate(discount.discount for discount in fixed)]
+
+    # (total, coupon count, percentage coupons, fixed coupons), the smallest is the best.
+    best = (subtotal, 0, 0, 0)
+    for p in range(min(max_coupons, len(percentages)) + 1):
+        max_fixed = min(max_coupons - p, len(fixed))
+        after_percentages = discounted_total(subtotal, percentage_sums[p], 0)
+        # The total stops decreasing once the fixed amounts cover the rest of the price.
+        f = min(max_fixed, bisect_left(fixed_sums, after_percentages, hi=max_fixed + 1))
+        total = max(0, after_percentages - fixed_sums[f])
+        best = min(best, (total, p + f, p, f))
+
+    total, _, p, f = best
+    codes = [discount.code for discount in percentages[:p]] + [discount.code for discount in fixed[:f]]
+    return BestCoupons(codes=codes, subtotal=subtotal, discount=subtotal - total, total=total)
@@ -1,31 +1,234 @@
-from datetime import datetime
+from collections import Counter
+from datetime import datetime, timedelta
+from itertools import zip_longest
+import time
+from uuid import uuid4
+from typing import Any, Iterable, NoReturn
+
+from sqlalchemy import bindparam, case, event, exists, func, literal, select as sql_select, update
+from sqlalchemy.engine import Row
+from sqlalchemy.sql import ColumnElement
+from sqlmodel import col, or_, select, Session
+
+from coupon_model.coupon_customer_link.model import CouponCustomerLinkArchiveTable, CouponCustomerLinkTable
+from coupon_model.reseller.service import increment_counters, REDEEMED_TASK
+from coupon_utils.bulk import bulk_write, commit_chunks
+from coupon_utils.db import (
+    chunked,
+    delete_where,
+    execute_dml,
+    IN_CHUNK_SIZE,
+    lookup,
+    projection,
+    rows_by_keys,
+    session_engine,
+    supports_returning,
+    update_returning,
+    upsert,
+)
+from coupon_utils.service import CommitFailed, NotFound, ValidationFailed
+from coupon_utils.tasks import run_tasks, TaskExecutor
+from coupon_utils.tracing import trace_methods
+
+from .model import (
+    coupon_search_index,
+    Cart,
+    CartPrice,
+    ChangeOperation,
+    CouponChange,
+    CouponChangeTable,
+    Coupon,
+    CouponBatchItem,
+    CouponBulkDelete,
+    CouponBulkUpdate,
+    CouponCreate,
+    CouponFilter,
+    CouponStatus,
+    CouponStatusResult,
+    CouponTable,
+    CouponUpdate,
+    AvailableCouponTable,
+    CouponApplied,
+    CouponArchiveTable,
+    CouponReservation,
+)
+from .pricing import Discount, price_carts
+
+# The PostgreSQL advisory lock serializing the commits of the coupon outbox.
+OUTBOX_LOCK_ID = 0x636F75706F6E
+
+# The hot lookups, built once, the primary keys are looked up with `Session.get()`.
+_BY_CODE = lookup(CouponTable, "code")
+_DISCOUNTS_BY_CODES = sql_select(
+    CouponTable.code,
+    CouponTable.discount,
+    CouponTable.discount_type,
+    CouponTable.is_active,
+    CouponTable.valid_from,
+    CouponTable.valid_until,
+).where(col(CouponTable.code).in_(bindparam("codes", expanding=True)))
+
+# The columns copied to the coupon archive.
+ARCHIVED_COLUMNS = [
+    column.name for column in CouponArchiveTable.__table__.columns if column.name != "archived_at"  # type: ignore
+]
+
+# The interval of the outbox polls of a waiting change feed request, in seconds.
+CHANGES_POLL_INTERVAL = 0.5
+
+
+def record_changes(session: Session, operation: ChangeOperation | ColumnElement, *conditions) -> None:
+    """
+    Writes a change of each coupon matching the conditions to the outbox, within the current transaction.
 
-from sqlmodel import select, Session
+    The changes get their sequence number when the transaction commits, see `assign_change_sequence()`.
 
-from coupon_utils.service import CommitFailed, NotFound, ValidationFailed
+    Arguments:
+        session: The session instance.
+        operation: A `ChangeOperation` or an SQL expression of one.
+        conditions: The conditions of the changed coupons.
+    """
+    table = CouponChangeTable.__table__  # type: ignore
+    if isinstance(operation, ChangeOperation):
+        operation = literal(operation, table.c.operation.type)
+    source = sql_select(CouponTable.id, CouponTable.code, operation, literal(datetime.utcnow())).where(*conditions)
+    session.execute(table.insert().from_select(["coupon_id", "code", "operation", "created_at"], source))
+    session.info["coupon_changes"] = True
+
+
+@event.listens_for(Session, "before_commit")
+def assign_change_sequence(session: Session) -> None:
+    """
+    Numbers the outbox rows of the committing transaction after the changes committed before it.
+
+    On PostgreSQL, an advisory lock serializes the numbering with the end of the commit, so a consumer reading after
+    its last sequence number never skips a change committed late. The lock is the last one taken by a transaction,
+    after its row locks, so it cannot deadlock with them, and it is only held while the transaction commits.
+    SQLite serializes the writing transactions already.
+    """
+    if not session.info.pop("coupon_changes", False):
+        return
+    table = CouponChangeTable.__table__  # type: ignore
+    if session.get_bind().dialect.name == "postgresql":
+        session.execute(sql_select(func.pg_advisory_xact_lock(OUTBOX_LOCK_ID)))
+    # The rows of the transaction keep their order, the gaps left by the other transactions do not matter.
+    last_seq = sql_select(func.coalesce(func.max(table.c.seq), 0)).scalar_subquery()
+    first_id = sql_select(func.min(table.c.id)).where(table.c.seq.is_(None)).scalar_subquery()
+    session.execute(table.update().where(table.c.seq.is_(None)).values(seq=table.c.id - first_id + last_seq + 1))
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_change_sequence(session: Session) -> None:
+    session.info.pop("coupon_changes", None)
+
+
+def remove_available_coupons(session: Session, *conditions) -> None:
+    """
+    Removes the coupons matching the conditions from the available coupons of the customers.
+
+    Arguments:
+        session: The session instance.
+        conditions: The conditions of the coupons.
+    """
+    table = AvailableCouponTable.__table__  # type: ignore
+    session.execute(table.delete().where(table.c.coupon_id.in_(select(CouponTable.id).where(*conditions))))
 
-from .model import CouponCreate, CouponStatus, CouponTable, CouponUpdate, CouponApplied
 
+def count_by_reseller(session: Session, *conditions) -> tuple[Counter[int], Counter[int]]:
+    """
+    Counts the issued and redeemed coupons matching the conditions by reseller.
+
+    Arguments:
+        session: The session instance.
+        conditions: The conditions of the coupons.
+
+    Returns:
+        The issued and the redeemed counts by reseller ID.
+    """
+    rows = session.execute(
+        sql_select(CouponTable.reseller_id, func.count(), func.count(CouponTable.redeemed_at))
+        .where(*conditions, col(CouponTable.reseller_id).is_not(None))
+        .group_by(CouponTable.reseller_id)
+    ).all()
+    return (
+        Counter({reseller_id: issued for reseller_id, issued, _ in rows}),
+        Counter({reseller_id: redeemed for reseller_id, _, redeemed in rows if redeemed}),
+    )
+
+
+def decrement_counters(session: Session, *conditions) -> None:
+    """
+    Removes the coupons matching the conditions from the issuance counters of their resellers, before they are deleted.
+
+    Arguments:
+        session: The session instance.
+        conditions: The conditions of the coupons.
+    """
+    issued, redeemed = count_by_reseller(session, *conditions)
+    increment_counters(session, "issued_count", {reseller_id: -count for reseller_id, count in issued.items()})
+    increment_counters(session, "redeemed_count", {reseller_id: -count for reseller_id, count in redeemed.items()})
+
+
+def refresh_available_coupons(session: Session, *conditions, customer_id: int | None = None) -> None:
+    """
+    Rebuilds the available coupons of the customers from the coupons matching the conditions and their links.
 
+    Arguments:
+        session: The session instance.
+        conditions: The conditions of the coupons.
+        customer_id: Only rebuilds the available coupons of this customer.
+    """
+    table = AvailableCouponTable.__table__  # type: ignore
+    stale = [table.c.coupon_id.in_(select(CouponTable.id).where(*conditions))]
+    link_conditions = []
+    if customer_id is not None:
+        stale.append(table.c.customer_id == customer_id)
+        link_conditions.append(CouponCustomerLinkTable.customer_id == customer_id)
+    session.execute(table.delete().where(*stale))
+    source = (
+        sql_select(
+            CouponCustomerLinkTable.customer_id,
+            CouponTable.id,
+            CouponTable.code,
+            CouponTable.discount,
+            CouponTable.discount_type,
+            CouponTable.valid_from,
+            CouponTable.valid_until,
+        )
+        .join(CouponTable, CouponTable.id == CouponCustomerLinkTable.coupon_id)
+        .where(*conditions, *link_conditions, CouponTable.is_active, col(CouponTable.redeemed_at).is_(None))
+    )
+    columns = ["customer_id", "coupon_id", "code", "discount", "discount_type", "valid_from", "valid_until"]
+    session.execute(table.insert().from_select(columns, source))
+
+
+@trace_methods
 class CouponService:
     """
     Coupon-related services.
     """
 
-    __slots__ = "_session"
+    __slots__ = ("_session", "_tasks", "_counters")
 
-    def __init__(self, session: Session) -> None:
+    def __init__(self, session: Session, tasks: TaskExecutor | None = None, counters: Session | None = None) -> None:
         """
         Initialization.
 
         Arguments:
             session: The session instance.
+            tasks: Runs the side effects of the redemptions after their commit. Without one, they run within the
+                transaction of the redemption.
+            counters: The session of the database of the reseller counters if it is not the database of the
+                coupons, e.g. of a coupon shard. The creations and the redemptions are counted there, and it is
+                committed right after the coupons.
         """
         self._session = session
+        self._tasks = tasks
+        self._counters = session if counters is None else counters
 
     def create_many(self, data: list[CouponCreate]) -> None:
         """
-        Creates many new coupon.
+        Creates many new coupon and counts them as issued by their resellers.
 
         Arguments:
             data: Creation data.
@@ -37,13 +240,72 @@ class CouponService:
 
         session.add_all([CouponTable.from_orm(coupon) for coupon in data])
         try:
-            session.commit()
+            session.flush()
+            for codes in chunked([coupon.code for coupon in data], IN_CHUNK_SIZE):
+                record_changes(session, ChangeOperation.created, col(CouponTable.code).in_(codes))
+            increment_counters(
+                self._counters, "issued_count", Counter(coupon.reseller_id for coupon in data if coupon.reseller_id)
+            )
+            self._commit()
         except Exception:
+            self._rollback()
             raise CommitFailed("Failed to create the coupons.")
 
+    def upsert_many(self, rows: list[dict[str, Any]]) -> None:
+        """
+        Creates the coupons or updates the existing ones with the same code in one statement.
+
+        Arguments:
+            rows: Validated `CouponCreate` values.
+
+        Raises:
+            CommitFailed: If the service fails to commit the coupons.
+        """
+        session = self._session
+        codes = [row["code"] for row in rows]
+
+        def counts() -> tuple[Counter[int], Counter[int]]:
+            issued: Counter[int] = Counter()
+            redeemed: Counter[int] = Counter()
+            for chunk in chunked(codes, IN_CHUNK_SIZE):
+                chunk_issued, chunk_redeemed = count_by_reseller(session, col(CouponTable.code).in_(chunk))
+                issued.update(chunk_issued)
+                redeemed.update(chunk_redeemed)
+            return issued, redeemed
+
+        now = datetime.utcnow()
+        try:
+            # The counters move by the difference, so inserted coupons and coupons moved to another reseller count.
+            issued_before, redeemed_before = counts()
+            upsert(
+                session,
+                CouponTable,
+                [{**row, "created_at": now, "updated_at": now, "version": 1} for row in rows],
+                index_elements=["code"],
+                exclude_from_update=("created_at", "version"),
+                update_values={"version": CouponTable.version + 1},
+            )
+            operation_type = CouponChangeTable.__table__.c.operation.type  # type: ignore
+            operation: ColumnElement = case(
+                (CouponTable.version == 1, literal(ChangeOperation.created, operation_type)),
+                else_=literal(ChangeOperation.updated, operation_type),
+            )
+            issued, redeemed = counts()
+            issued.subtract(issued_before)
+            redeemed.subtract(redeemed_before)
+            increment_counters(session, "issued_count", {id: count for id, count in issued.items() if count})
+            increment_counters(session, "redeemed_count", {id: count for id, count in redeemed.items() if count})
+            for chunk in chunked(codes, IN_CHUNK_SIZE):
+                record_changes(session, operation, col(CouponTable.code).in_(chunk))
+                refresh_available_coupons(session, col(CouponTable.code).in_(chunk))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise CommitFailed("Failed to upsert the coupons.")
+
     def delete_by_id(self, id: int) -> None:
         """
-        Deletes the coupon by ID.
+        Deletes the coupon by ID, with its customer links, and removes it from the counters of its reseller.
 
         Arguments:
             id: Coupon database ID.
@@ -54,30 +316,108 @@ class CouponService:
         """
         session = self._session
 
-        item = self.get_by_id(id)
-        if item is None:
-            raise NotFound("Coupon not found.")
-
-        session.delete(item)
         try:
+            record_changes(session, ChangeOperation.deleted, CouponTable.id == id)
+            remove_available_coupons(session, CouponTable.id == id)
+            delete_where(session, CouponCustomerLinkTable, CouponCustomerLinkTable.coupon_id == id)
+            decrement_counters(session, CouponTable.id == id)
+            deleted = delete_where(session, CouponTable, CouponTable.id == id)
             session.commit()
         except Exception:
+            session.rollback()
             raise CommitFailed("Failed to delete the coupon.")
 
+        if not deleted:
+            raise NotFound("Coupon not found.")
+
     def get_all(self, offset: int, limit: int) -> list[CouponTable]:
         """
         Returns all coupons from the database with pagination.
         """
         return self._session.exec(select(CouponTable).offset(offset).limit(limit)).all()
 
-    def get_by_id(self, id: int) -> CouponTable | None:
+    def get_rows(self, offset: int, limit: int, fields: Iterable[str]) -> list[Row]:
+        """
+        Returns the given fields of all coupons with pagination, as plain rows for read-only use.
+        """
+        statement = projection(CouponTable, fields).order_by(CouponTable.id).offset(offset).limit(limit)
+        return self._session.execute(statement).all()
+
+    def search(self, q: str, limit: int, after: str | None) -> tuple[list[CouponTable], str | None]:
+        """
+        Returns a page of the coupons best matching the search text.
+
+        Arguments:
+            q: The search text.
+            limit: The maximum number of coupons.
+            after: The cursor returned with the previous page.
+
+        Returns:
+            The coupons and the cursor of the next page.
+
+        Raises:
+            ValidationFailed: If the cursor is malformed.
+        """
+        return coupon_search_index.search(self._session, q, limit, after)
+
+    def get_by_id(self, id: int) -> CouponTable | CouponArchiveTable | None:
         """
-        Returns the coupon with the given ID if it exists.
+        Returns the coupon with the given ID if it exists, looking in the archive if it is not in the coupons table.
 
         Arguments:
             id: Coupon database ID.
         """
-        return self._session.get(CouponTable, id)
+        coupon = self._session.get(CouponTable, id)
+        if coupon is None:
+            return self._session.get(CouponArchiveTable, id)
+        return coupon
+
+    def get_row(self, id: int, fields: Iterable[str]) -> Row | None:
+        """
+        Returns the given fields of the coupon with the given ID as a plain row, looking in the archive too.
+
+        Arguments:
+            id: Coupon database ID.
+            fields: The names of the selected columns.
+        """
+        fields = list(fields)
+        for model in (CouponTable, CouponArchiveTable):
+            row = self._session.execute(projection(model, fields).where(model.id == id)).first()
+            if row is not None:
+                return row
+        return None
+
+    def get_many(self, ids: list[int], codes: list[str]) -> list[CouponBatchItem]:
+        """
+        Returns the coupons with the given IDs and codes.
+
+        The coupons are resolved with one `IN` query per `IN_CHUNK_SIZE` IDs and codes, as plain rows, the ones missing
+        from the coupons table are then looked up in the archive. The archive can hold several coupons with the same
+        code, the last archived one wins.
+
+        Arguments:
+            ids: Coupon database IDs.
+            codes: Coupon codes.
+
+        Returns:
+            The coupons of the requested IDs, then of the requested codes, in request order.
+        """
+        fields = list(Coupon.__fields__)
+        by_id: dict[int, CouponBatchItem] = {}
+        by_code: dict[str, CouponBatchItem] = {}
+        for model in (CouponTable, CouponArchiveTable):
+            missing_ids = set(ids) - by_id.keys()
+            missing_codes = set(codes) - by_code.keys()
+            for row in rows_by_keys(self._session, model, fields, id=missing_ids, code=missing_codes):
+                item = CouponBatchItem(id=row.id, code=row.code, coupon=Coupon.from_orm(row))
+                if row.id in missing_ids:
+                    by_id[row.id] = item
+                if row.code in missing_codes:
+                    by_code[row.code] = item
+
+        return [by_id.get(id) or CouponBatchItem(id=id, code=None, coupon=None) for id in ids] + [
+            by_code.get(code) or CouponBatchItem(id=None, code=code, coupon=None) for code in codes
+        ]
 
     def get_by_code(self, code: str) -> CouponTable | None:
         """
@@ -86,7 +426,32 @@ class CouponService:
         Arguments:
             code: Coupon code.
         """
-        return self._session.exec(select(CouponTable).where(CouponTable.code == code)).first()
+        return self._session.exec(_BY_CODE, params={"code": code}).first()
+
+    def get_discounts_by_codes(self, codes: set[str]) -> dict[str, Discount]:
+        """
+        Returns the pricing-relevant columns of the coupons with the given codes.
+
+        The coupons are fetched with one `IN` query per `IN_CHUNK_SIZE` codes.
+
+        Arguments:
+            codes: Coupon codes.
+        """
+        discounts: dict[str, Discount] = {}
+        for chunk in chunked(codes, IN_CHUNK_SIZE):
+            for row in self._session.execute(_DISCOUNTS_BY_CODES, {"codes": chunk}):
+                discounts[row.code] = Discount(*row)
+        return discounts
+
+    def price_carts(self, carts: list[Cart]) -> list[CartPrice]:
+        """
+        Computes the final prices of the given carts with their coupons without applying the coupons.
+
+        Arguments:
+            carts: The carts to price.
+        """
+        discounts = self.get_discounts_by_codes({code for cart in carts for code in cart.codes})
+        return price_carts(carts, discounts, datetime.utcnow())
 
     def update(self, id: int, data: CouponUpdate) -> CouponTable:
         """
@@ -102,23 +467,104 @@ class CouponService:
         """
         session = self._session
 
-        db_item = self.get_by_id(id)
-        if db_item is None:
-            raise NotFound("Coupon not found.")
-
-        changes = data.dict(exclude_unset=True)
-        for key, value in changes.items():
-            setattr(db_item, key, value)
-
-        session.add(db_item)
+        changes = data.dict(exclude_unset=True) | {"updated_at": datetime.utcnow(), "version": CouponTable.version + 1}
         try:
+            db_item = update_returning(session, CouponTable, id, changes)
+            if db_item is not None:
+                record_changes(session, ChangeOperation.updated, CouponTable.id == id)
+                refresh_available_coupons(session, CouponTable.id == id)
             session.commit()
         except Exception:
+            session.rollback()
             raise CommitFailed("Failed to update the coupon.")
 
-        session.refresh(db_item)
+        if db_item is None:
+            raise NotFound("Coupon not found.")
+
         return db_item
 
+    def bulk_update(self, data: CouponBulkUpdate) -> int:
+        """
+        Updates the coupons selected by IDs or by a filter in chunks, each chunk is committed on its own.
+
+        Arguments:
+            data: The selection and the update data.
+
+        Returns:
+            The number of updated coupons.
+
+        Raises:
+            CommitFailed: If a chunk fails to commit, the previous chunks stay updated.
+        """
+        values = data.changes.dict(exclude_unset=True) | {
+            "updated_at": datetime.utcnow(),
+            "version": CouponTable.version + 1,
+        }
+        counts = bulk_write(
+            self._session,
+            CouponTable,
+            ids=data.ids,
+            conditions=self._filter_conditions(data.filter),
+            values=values,
+            before_write=lambda where: record_changes(self._session, ChangeOperation.updated, *where),
+            after_write=lambda ids: refresh_available_coupons(self._session, CouponTable.id.in_(ids)),  # type: ignore
+        )
+        return commit_chunks(self._session, counts, "Failed to update the coupons.")
+
+    def bulk_delete(self, data: CouponBulkDelete) -> int:
+        """
+        Deletes the coupons selected by IDs or by a filter in chunks, each chunk is committed on its own.
+        The coupons are removed from the counters of their resellers in the same transactions.
+
+        Arguments:
+            data: The selection.
+
+        Returns:
+            The number of deleted coupons.
+
+        Raises:
+            CommitFailed: If a chunk fails to commit, the previous chunks stay deleted.
+        """
+
+        def before_delete(where: tuple) -> None:
+            record_changes(self._session, ChangeOperation.deleted, *where)
+            remove_available_coupons(self._session, *where)
+            delete_where(
+                self._session,
+                CouponCustomerLinkTable,
+                col(CouponCustomerLinkTable.coupon_id).in_(select(CouponTable.id).where(*where)),
+            )
+            decrement_counters(self._session, *where)
+
+        counts = bulk_write(
+            self._session,
+            CouponTable,
+            ids=data.ids,
+            conditions=self._filter_conditions(data.filter),
+            before_write=before_delete,
+        )
+        return commit_chunks(self._session, counts, "Failed to delete the coupons.")
+
+    @staticmethod
+    def _filter_conditions(filter: CouponFilter | None) -> tuple:
+        """
+        Returns the conditions of the coupons matching the filter.
+        """
+        if filter is None:
+            return ()
+        conditions = []
+        if filter.is_active is not None:
+            conditions.append(CouponTable.is_active == filter.is_active)
+        if filter.discount_type is not None:
+            conditions.append(CouponTable.discount_type == filter.discount_type)
+        if filter.reseller_id is not None:
+            conditions.append(CouponTable.reseller_id == filter.reseller_id)
+        if filter.valid_until_before is not None:
+            conditions.append(CouponTable.valid_until < filter.valid_until_before)
+        if filter.valid_until_after is not None:
+            conditions.append(CouponTable.valid_until >= filter.valid_until_after)
+        return tuple(conditions)
+
     def status_by_id(self, id: int) -> CouponStatus:
         """
         Returns the current status of the coupon with the given ID.
@@ -135,23 +581,405 @@ class CouponService:
         is_valid = True if coupon.valid_from <= datetime.utcnow() < coupon.valid_until else False
         return CouponStatus(is_active=coupon.is_active, is_valid=is_valid)
 
-    def apply_by_code(self, code: str) -> CouponApplied:
+    def status_many(self, ids: list[int], codes: list[str]) -> list[CouponStatusResult]:
+        """
+        Returns the current status of the coupons with the given IDs and codes.
+
+        The coupons are resolved with one `IN` query per `IN_CHUNK_SIZE` IDs and codes, the ones missing from the
+        coupons table are then looked up in the archive.
+
+        Arguments:
+            ids: Coupon database IDs.
+            codes: Coupon codes.
+
+        Returns:
+            The statuses of the requested IDs, then the requested codes, in request order.
+        """
+        now = datetime.utcnow()
+        by_id: dict[int, CouponStatusResult] = {}
+        by_code: dict[str, CouponStatusResult] = {}
+        self._statuses(CouponTable, set(ids), set(codes), now, by_id, by_code)
+        self._statuses(CouponArchiveTable, set(ids) - by_id.keys(), set(codes) - by_code.keys(), now, by_id, by_code)
+
+        return [by_id.get(id) or CouponStatusResult(id=id, code=None, status=None) for id in ids] + [
+            by_code.get(code) or CouponStatusResult(id=None, code=code, status=None) for code in codes
+        ]
+
+    def _statuses(
+        self,
+        model: type[CouponTable] | type[CouponArchiveTable],
+        ids: set[int],
+        codes: set[str],
+        now: datetime,
+        by_id: dict[int, CouponStatusResult],
+        by_code: dict[str, CouponStatusResult],
+    ) -> None:
+        """
+        Adds the statuses of the coupons of a table with the given IDs and codes to `by_id` and `by_code`.
+
+        Only the given IDs and codes are added, the archive can hold several coupons with the same code, the last
+        archived one wins.
+        """
+        columns = (model.id, model.code, model.is_active, model.valid_from, model.valid_until)
+        for id_chunk, code_chunk in zip_longest(chunked(ids, IN_CHUNK_SIZE), chunked(codes, IN_CHUNK_SIZE)):
+            condition = or_(model.id.in_(id_chunk or []), model.code.in_(code_chunk or []))  # type: ignore
+            for id, code, is_active, valid_from, valid_until in self._session.execute(
+                sql_select(*columns).where(condition).order_by(model.id)
+            ):
+                is_valid = valid_from <= now < valid_until
+                result = CouponStatusResult(
+                    id=id, code=code, status=CouponStatus(is_active=is_active, is_valid=is_valid)
+                )
+                if id in ids:
+                    by_id[id] = result
+                if code in codes:
+                    by_code[code] = result
+
+    def apply_by_code(self, code: str, customer_id: int | None = None) -> CouponApplied:
+        """
+        Apply a coupon and count it as redeemed by its reseller.
+
+        The availability and the ownership are checked by the conditional `UPDATE` that redeems the coupon,
+        so a coupon is applied exactly once even by concurrent requests. The reseller counter is incremented by a
+        task after the commit when the service has a task executor.
+
+        Arguments:
+            code: Coupon code.
+            customer_id: If given, the coupon must be linked to this customer.
+
+        Raises:
+            CommitFailed: If the service fails to apply the coupon.
+            NotFound: If the coupon with the given code does not exist.
+            ValidationFailed: If the coupon is not active, not valid, reserved or not linked to the customer.
         """
-        Apply a coupon.
+        now = datetime.utcnow()
+        applied = self._update_by_code(
+            code,
+            self._available(code, customer_id, now),
+            {"is_active": False, "redeemed_at": now},
+            now,
+        )
+        if applied is None:
+            self._raise_unavailable(code, "Coupon is not available.")
+        return self._redeemed(code, applied, "Failed to apply the coupon.")
+
+    def reserve(self, code: str, ttl: float, customer_id: int | None = None) -> CouponReservation:
+        """
+        Holds a coupon for a pending redemption, until it is confirmed or released, or the lease expires.
+
+        The lease is taken by one conditional `UPDATE` in a short transaction, no row lock is held while it runs.
+        An expired lease can be taken over at once, the sweeper only clears the leftovers.
+
+        Arguments:
+            code: Coupon code.
+            ttl: The duration of the lease in seconds.
+            customer_id: If given, the coupon must be linked to this customer.
+
+        Raises:
+            CommitFailed: If the service fails to reserve the coupon.
+            NotFound: If the coupon with the given code does not exist.
+            ValidationFailed: If the coupon is not available or reserved by someone else.
+        """
+        now = datetime.utcnow()
+        token = uuid4().hex
+        expires_at = now + timedelta(seconds=ttl)
+        reserved = self._update_by_code(
+            code,
+            self._available(code, customer_id, now),
+            {"reservation_token": token, "reserved_until": expires_at},
+            now,
+        )
+        if reserved is None:
+            self._raise_unavailable(code, "Coupon is not available.")
+
+        record_changes(self._session, ChangeOperation.reserved, CouponTable.code == code)
+        try:
+            self._session.commit()
+        except Exception:
+            self._session.rollback()
+            raise CommitFailed("Failed to reserve the coupon.")
+
+        discount, discount_type, _ = reserved
+        return CouponReservation(
+            code=code, token=token, expires_at=expires_at, discount=discount, discount_type=discount_type
+        )
+
+    def confirm(self, code: str, token: str) -> CouponApplied:
+        """
+        Redeems a reserved coupon and counts it as redeemed by its reseller.
+
+        The coupon must still be active and valid, it can be deactivated or expire while it is reserved.
+
+        Arguments:
+            code: Coupon code.
+            token: The token of the reservation.
+
+        Raises:
+            CommitFailed: If the service fails to apply the coupon.
+            NotFound: If the coupon with the given code does not exist.
+            ValidationFailed: If the coupon is not reserved with the token, the lease expired, or the coupon is no
+                longer active or valid.
+        """
+        now = datetime.utcnow()
+        conditions = (
+            CouponTable.code == code,
+            CouponTable.reservation_token == token,
+            col(CouponTable.reserved_until) > now,
+            CouponTable.is_active,
+            CouponTable.valid_from <= now,
+            CouponTable.valid_until > now,
+        )
+        values = {"is_active": False, "redeemed_at": now, "reservation_token": None, "reserved_until": None}
+        applied = self._update_by_code(code, conditions, values, now)
+        if applied is None:
+            self._raise_unavailable(code, "Coupon is not reserved with this token.")
+        return self._redeemed(code, applied, "Failed to confirm the coupon.")
+
+    def release(self, code: str, token: str) -> None:
+        """
+        Releases a reserved coupon, so it is available again.
+
+        Arguments:
+            code: Coupon code.
+            token: The token of the reservation.
+
+        Raises:
+            CommitFailed: If the service fails to release the coupon.
+            NotFound: If the coupon with the given code does not exist.
+            ValidationFailed: If the coupon is not reserved with the token.
+        """
+        now = datetime.utcnow()
+        conditions = (CouponTable.code == code, CouponTable.reservation_token == token)
+        released = self._update_by_code(code, conditions, {"reservation_token": None, "reserved_until": None}, now)
+        if released is None:
+            self._raise_unavailable(code, "Coupon is not reserved with this token.")
+
+        record_changes(self._session, ChangeOperation.released, CouponTable.code == code)
+        try:
+            self._session.commit()
+        except Exception:
+            self._session.rollback()
+            raise CommitFailed("Failed to release the coupon.")
+
+    def release_expired(self, batch_size: int = IN_CHUNK_SIZE) -> int:
+        """
+        Clears the expired leases in batches, each batch is committed on its own.
+
+        Arguments:
+            batch_size: The maximum number of leases cleared by a statement.
+
+        Returns:
+            The number of cleared leases.
+
+        Raises:
+            CommitFailed: If a batch fails to commit, the previous batches stay cleared.
+        """
+        now = datetime.utcnow()
+        counts = bulk_write(
+            self._session,
+            CouponTable,
+            conditions=(col(CouponTable.reserved_until) <= now,),
+            values={"reservation_token": None, "reserved_until": None, "updated_at": now},
+            chunk_size=batch_size,
+            before_write=lambda where: record_changes(self._session, ChangeOperation.released, *where),
+        )
+        return commit_chunks(self._session, counts, "Failed to release the expired reservations.")
+
+    def rebuild_available(self) -> None:
+        """
+        Rebuilds the available coupons of all the customers, e.g. after links were written around the services.
+
+        Raises:
+            CommitFailed: If the service fails to commit the rebuilt projection.
         """
         session = self._session
 
-        db_item = self.get_by_code(code)
-        if db_item is None:
-            raise NotFound(f"Coupon: {id}")
-        elif db_item.is_active and db_item.valid_from <= datetime.utcnow() < db_item.valid_until:
-            setattr(db_item, "is_active", False)
-        else:
-            raise ValidationFailed("Coupon is not available.")
-        session.add(db_item)
+        refresh_available_coupons(session)
         try:
             session.commit()
         except Exception:
-            raise CommitFailed("Failed to apply the coupon.")
+            session.rollback()
+            raise CommitFailed("Failed to rebuild the available coupons.")
+
+    def archive(self, before: datetime, chunk_size: int = IN_CHUNK_SIZE) -> int:
+        """
+        Moves the coupons expired or redeemed before the given time to the archive, with their customer links.
+
+        Each chunk is copied to the archive tables and deleted from the hot tables in one transaction, committed on
+        its own. The archived coupons are still returned by `get_by_id()` and `status_many()`, and they stay in the
+        counters of their resellers, which count issuance history. A coupon whose ID is already archived, reused by a table created without `AUTOINCREMENT`, is kept in the coupons table.
+
+        Arguments:
+            before: Coupons expired or redeemed before this time are archived.
+            chunk_size: The maximum number of coupons moved by a transaction.
+
+        Returns:
+            The number of archived coupons.
+
+        Raises:
+            CommitFailed: If a chunk fails to commit, the previous chunks stay archived.
+        """
+        coupons = CouponTable.__table__  # type: ignore
+        links = CouponCustomerLinkTable.__table__  # type: ignore
+
+        now = datetime.utcnow()
+
+        def copy(where: tuple) -> None:
+            remove_available_coupons(self._session, *where)
+            source = sql_select(*(coupons.c[name] for name in ARCHIVED_COLUMNS), literal(now)).where(*where)
+            self._session.execute(
+                CouponArchiveTable.__table__.insert().from_select(  # type: ignore
+                    [*ARCHIVED_COLUMNS, "archived_at"], source
+                )
+            )
+            linked = links.c.coupon_id.in_(select(coupons.c.id).where(*where))
+            self._session.execute(
+                CouponCustomerLinkArchiveTable.__table__.insert().from_select(  # type: ignore
+                    ["coupon_id", "customer_id"], select(links.c.coupon_id, links.c.customer_id).where(linked)
+                )
+            )
+            self._session.execute(links.delete().where(linked))
+            record_changes(self._session, ChangeOperation.archived, *where)
+
+        counts = bulk_write(
+            self._session,
+            CouponTable,
+            conditions=(
+                or_(CouponTable.valid_until < before, col(CouponTable.redeemed_at) < before),
+                ~exists().where(CouponArchiveTable.id == CouponTable.id).where(CouponArchiveTable.archived_at < now),
+            ),
+            chunk_size=chunk_size,
+            before_write=copy,
+        )
+        return commit_chunks(self._session, counts, "Failed to archive the coupons.")
+
+    @staticmethod
+    def _available(code: str, customer_id: int | None, now: datetime) -> tuple:
+        """
+        Returns the conditions of a coupon that can be applied or reserved now.
+        """
+        conditions = (
+            CouponTable.code == code,
+            CouponTable.is_active,
+            CouponTable.valid_from <= now,
+            CouponTable.valid_until > now,
+            or_(CouponTable.reserved_until.is_(None), CouponTable.reserved_until <= now),  # type: ignore
+        )
+        if customer_id is None:
+            return conditions
+        # A semi-join on the primary key of the link table.
+        return conditions + (
+            exists()
+            .where(CouponCustomerLinkTable.coupon_id == CouponTable.id)
+            .where(CouponCustomerLinkTable.customer_id == customer_id),
+        )
+
+    def _update_by_code(self, code: str, conditions: tuple, values: dict[str, Any], now: datetime):
+        """
+        Updates the coupon with a conditional `UPDATE` and returns its discount and reseller.
+
+        Returns:
+            The `(discount, discount_type, reseller_id)` of the coupon, or `None` if the conditions do not match.
+        """
+        session = self._session
+
+        statement = (
+            update(CouponTable)
+            .where(*conditions)
+            .values(values | {"updated_at": now, "version": CouponTable.version + 1})
+            .execution_options(synchronize_session=False)
+        )
+        columns = (CouponTable.discount, CouponTable.discount_type, CouponTable.reseller_id)
+        if supports_returning(session):
+            return session.execute(statement.returning(*columns)).first()
+        if execute_dml(session, statement).rowcount:
+            return session.execute(sql_select(*columns).where(CouponTable.code == code)).first()
+        return None
+
+    def _commit(self) -> None:
+        """
+        Commits the session, then the session of the counters if it is another one.
+        """
+        self._session.commit()
+        if self._counters is not self._session:
+            self._counters.commit()
+
+    def _rollback(self) -> None:
+        """
+        Rolls back the session and the session of the counters.
+        """
+        self._session.rollback()
+        if self._counters is not self._session:
+            self._counters.rollback()
+
+    def _raise_unavailable(self, code: str, message: str) -> NoReturn:
+        """
+        Raises `NotFound` if the coupon does not exist, `ValidationFailed` with the message otherwise.
+        """
+        if self.get_by_code(code) is None:
+            raise NotFound(f"Coupon: {code}")
+        raise ValidationFailed(message)
+
+    def _redeemed(self, code: str, applied, error: str) -> CouponApplied:
+        """
+        Records a redemption and commits it, then submits its side effects to the task executor of the service.
+        """
+        session = self._session
+
+        discount, discount_type, reseller_id = applied
+        record_changes(session, ChangeOperation.applied, CouponTable.code == code)
+        remove_available_coupons(session, CouponTable.code == code)
+        side_effects = [] if reseller_id is None else [(REDEEMED_TASK, {"reseller_id": reseller_id})]
+        if self._tasks is None:
+            run_tasks(self._counters, side_effects)
+        try:
+            self._commit()
+        except Exception:
+            self._rollback()
+            raise CommitFailed(error)
+
+        if self._tasks is not None:
+            for name, payload in side_effects:
+                self._tasks.submit(session_engine(self._counters), name, payload)
+        return CouponApplied(discount=discount, discount_type=discount_type)
+
+    def changes(self, after: int, limit: int) -> list[CouponChange]:
+        """
+        Returns the coupon changes following a sequence number, with the current state of the coupons.
+
+        Arguments:
+            after: The sequence number of the last known change.
+            limit: The maximum number of changes.
+        """
+        statement = (
+            select(CouponChangeTable, CouponTable)
+            .outerjoin(CouponTable, CouponTable.id == CouponChangeTable.coupon_id)  # type: ignore
+            .where(CouponChangeTable.seq > after)  # type: ignore
+            .order_by(CouponChangeTable.seq)
+            .limit(limit)
+        )
+        return [
+            CouponChange(**change.dict(exclude={"id"}), coupon=None if coupon is None else Coupon.from_orm(coupon))
+            for change, coupon in self._session.exec(statement).all()
+        ]
+
+    def wait_for_changes(self, after: int, limit: int, timeout: float) -> list[CouponChange]:
+        """
+        Returns the coupon changes following a sequence number, waiting for one if there is none yet.
 
-        return CouponApplied(discount=db_item.discount, discount_type=db_item.discount_type)
+        Arguments:
+            after: The sequence number of the last known change.
+            limit: The maximum number of changes.
+            timeout: The maximum waiting time in seconds.
+
+        Returns:
+            The changes, empty if none happened before the timeout.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            items = self.changes(after, limit)
+            # End the transaction, so the next poll sees the changes committed meanwhile.
+            self._session.rollback()
+            if items or time.monotonic() >= deadline:
+                return items
+            time.sleep(min(CHANGES_POLL_INTERVAL, max(0.0, deadline - time.monotonic())))
@@ -0,0 +1,338 @@
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from heapq import merge
+from itertools import islice
+from typing import Any, Callable, Iterable, Iterator, Sequence, TypeVar
+
+from sqlalchemy import func, select as sql_select
+from sqlalchemy.engine import Row
+from sqlmodel import col, select, Session, SQLModel
+
+from coupon_model.coupon_customer_link.model import CouponCustomerLinkCreate, CouponCustomerLinkTable
+from coupon_model.coupon_customer_link.service import CouponCustomerLinkService
+from coupon_model.customer.model import CustomerTable
+from coupon_model.reseller.model import ResellerTable
+from coupon_utils.db import projection, upsert
+from coupon_utils.service import NotFound
+from coupon_utils.sharding import shard_index
+from coupon_utils.tasks import TaskExecutor
+
+from .model import ChangeOperation, CouponApplied, CouponCreate, CouponReservation, CouponTable
+from .service import CouponService, record_changes, refresh_available_coupons, remove_available_coupons
+
+T = TypeVar("T")
+
+SessionFactory = Callable[[], Session]
+
+# The number of coupons read from a shard at once by the exports.
+EXPORT_PAGE_SIZE = 1000
+
+# The reseller counters, left at zero in the copies of the resellers on the shards.
+COUNTERS = ("issued_count", "redeemed_count")
+
+
+def _copy_missing(
+    source: Session, target: Session, model: type[SQLModel], ids: Iterable[int], reset: tuple[str, ...] = ()
+) -> None:
+    """
+    Copies the rows with the given IDs the target database misses from the source database, with their IDs.
+
+    Arguments:
+        source: The session of the source database.
+        target: The session of the target database.
+        model: The table model, it must have an integer `id` primary key.
+        ids: The IDs of the rows.
+        reset: Columns left to their default value in the copies.
+    """
+    table = model.__table__  # type: ignore
+    missing = set(ids) - set(target.execute(select(table.c.id).where(table.c.id.in_(set(ids)))).scalars())
+    if not missing:
+        return
+    rows = source.execute(select(table).where(table.c.id.in_(missing))).all()
+    target.execute(
+        table.insert(), [{key: value for key, value in row._mapping.items() if key not in reset} for row in rows]
+    )
+    if target.get_bind().dialect.name == "postgresql":
+        # The copies took IDs without the sequence, move it past them.
+        target.execute(
+            sql_select(
+                func.setval(
+                    func.pg_get_serial_sequence(table.name, "id"), sql_select(func.max(table.c.id)).scalar_subquery()
+                )
+            )
+        )
+
+
+class ShardedCouponService:
+    """
+    Coupon services over coupons spread across several databases by the hash of their code.
+
+    The operations on one code hit one shard, the listings query every shard in parallel and merge the results
+    by code. Every shard has the full schema, but coupon IDs are only unique within a shard.
+
+    The customers, the resellers and their counters are kept in the shared application database. A shard stores its
+    coupons with their customer links, and copies of the resellers and customers they reference, so that its foreign
+    keys and customer checks hold; the counters of the copies stay at zero.
+    """
+
+    __slots__ = ("_shards", "_shared", "_tasks")
+
+    def __init__(
+        self, shards: Sequence[SessionFactory], shared: SessionFactory, tasks: TaskExecutor | None = None
+    ) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            shards: Session factories of the shard databases, in a fixed order.
+            shared: Session factory of the application database, with the customers and the resellers.
+            tasks: The executor of the side effects of the redemptions, see `CouponService`. It must watch the
+                application database, where the redemptions are counted.
+        """
+        self._shards = shards
+        self._shared = shared
+        self._tasks = tasks
+
+    def shard_of(self, code: str) -> int:
+        """
+        Returns the index of the shard of a coupon code.
+        """
+        return shard_index(code, len(self._shards))
+
+    def _fan_out(self, function: Callable[[Session], T]) -> list[T]:
+        """
+        Calls the function with a session of each shard in parallel.
+        """
+
+        def call(make_session: SessionFactory) -> T:
+            with make_session() as session:
+                return function(session)
+
+        with ThreadPoolExecutor(len(self._shards)) as executor:
+            return list(executor.map(call, self._shards))
+
+    def create_many(self, data: list[CouponCreate]) -> None:
+        """
+        Creates many new coupons, each on the shard of its code, and counts them in the application database.
+
+        The shards commit on their own, so a failure can leave the coupons of the other shards created.
+
+        Arguments:
+            data: Creation data.
+
+        Raises:
+            CommitFailed: If a shard fails to commit its coupons.
+        """
+        by_shard: defaultdict[int, list[CouponCreate]] = defaultdict(list)
+        for coupon in data:
+            by_shard[self.shard_of(coupon.code)].append(coupon)
+
+        def create(index: int) -> None:
+            coupons = by_shard[index]
+            with self._shards[index]() as session, self._shared() as shared:
+                resellers = {coupon.reseller_id for coupon in coupons if coupon.reseller_id is not None}
+                _copy_missing(shared, session, ResellerTable, resellers, reset=COUNTERS)
+                CouponService(session, counters=shared).create_many(coupons)
+
+        with ThreadPoolExecutor(len(by_shard) or 1) as executor:
+            for future in [executor.submit(create, index) for index in by_shard]:
+                future.result()
+
+    def _on_shard(self, code: str, function: Callable[[CouponService], T]) -> T:
+        """
+        Calls the function with a coupon service of the shard of a code.
+        """
+        with self._shards[self.shard_of(code)]() as session, self._shared() as shared:
+            return function(CouponService(session, self._tasks, shared))
+
+    def get_by_code(self, code: str) -> CouponTable | None:
+        """
+        Returns the coupon with the given code if it exists.
+        """
+        return self._on_shard(code, lambda service: service.get_by_code(code))
+
+    def apply_by_code(self, code: str, customer_id: int | None = None) -> CouponApplied:
+        """
+        Applies a coupon on the shard of its code, see `CouponService.apply_by_code()`.
+        """
+        return self._on_shard(code, lambda service: service.apply_by_code(code, customer_id))
+
+    def reserve(self, code: str, ttl: float, customer_id: int | None = None) -> CouponReservation:
+        """
+        Reserves a coupon on the shard of its code, see `CouponService.reserve()`.
+        """
+        return self._on_shard(code, lambda service: service.reserve(code, ttl, customer_id))
+
+    def confirm(self, code: str, token: str) -> CouponApplied:
+        """
+        Confirms a reservation on the shard of its code, see `CouponService.confirm()`.
+        """
+        return self._on_shard(code, lambda service: service.confirm(code, token))
+
+    def release(self, code: str, token: str) -> None:
+        """
+        Releases a reservation on the shard of its code, see `CouponService.release()`.
+        """
+        return self._on_shard(code, lambda service: service.release(code, token))
+
+    def link_customer(self, code: str, customer_id: int) -> None:
+        """
+        Links a coupon to a customer on the shard of its code, so only this customer can apply it.
+
+        Arguments:
+            code: The coupon code.
+            customer_id: The ID of the customer in the application database.
+
+        Raises:
+            NotFound: If the coupon or the customer does not exist.
+            CommitFailed: If the shard fails to commit the link.
+        """
+        with self._shards[self.shard_of(code)]() as session, self._shared() as shared:
+            if shared.get(CustomerTable, customer_id) is None:
+                raise NotFound(f"Customer: {customer_id}")
+            coupon_id = session.exec(select(CouponTable.id).where(CouponTable.code == code)).first()
+            if coupon_id is None:
+                raise NotFound(f"Coupon: {code}")
+            _copy_missing(shared, session, CustomerTable, {customer_id})
+            CouponCustomerLinkService(session).create(
+                CouponCustomerLinkCreate(coupon_id=coupon_id, customer_id=customer_id)
+            )
+
+    def get_all(self, offset: int, limit: int) -> list[CouponTable]:
+        """
+        Returns a page of the coupons of all the shards ordered by code.
+        """
+
+        def first(session: Session) -> list[CouponTable]:
+            return session.exec(select(CouponTable).order_by(CouponTable.code).limit(offset + limit)).all()
+
+        pages = self._fan_out(first)
+        return list(islice(merge(*pages, key=lambda coupon: coupon.code), offset, offset + limit))
+
+    def get_rows(self, offset: int, limit: int, fields: Iterable[str]) -> list[Row]:
+        """
+        Returns the given fields of a page of the coupons of all the shards ordered by code, as plain rows.
+        """
+        columns = list(dict.fromkeys(["code", *fields]))
+
+        def first(session: Session) -> list[Row]:
+            statement = projection(CouponTable, columns).order_by(CouponTable.code).limit(offset + limit)
+            return session.execute(statement).all()
+
+        pages = self._fan_out(first)
+        return list(islice(merge(*pages, key=lambda row: row.code), offset, offset + limit))
+
+    def export(self) -> Iterator[CouponTable]:
+        """
+        Streams the coupons of all the shards ordered by code.
+
+        Every shard is read by pages with a keyset on the code, the next page of each shard is fetched in the
+        background while the current one is merged.
+        """
+        with ThreadPoolExecutor(len(self._shards)) as executor:
+            streams = [self._export_shard(executor, make_session) for make_session in self._shards]
+            yield from merge(*streams, key=lambda coupon: coupon.code)
+
+    @staticmethod
+    def _export_shard(executor: ThreadPoolExecutor, make_session: SessionFactory) -> Iterator[CouponTable]:
+        def fetch(after: str | None) -> list[CouponTable]:
+            statement = select(CouponTable).order_by(CouponTable.code).limit(EXPORT_PAGE_SIZE)
+            if after is not None:
+                statement = statement.where(CouponTable.code > after)
+            with make_session() as session:
+                return session.exec(statement).all()
+
+        page: Future[list[CouponTable]] = executor.submit(fetch, None)
+        while coupons := page.result():
+            if len(coupons) == EXPORT_PAGE_SIZE:
+                page = executor.submit(fetch, coupons[-1].code)
+            yield from coupons
+            if len(coupons) < EXPORT_PAGE_SIZE:
+                return
+
+    def rebalance(self, chunk_size: int = 1000) -> int:
+        """
+        Moves the coupons stored on another shard than the shard of their code, after shards were added.
+
+        A chunk of coupons is copied to its new shard with its customer links and committed before it is deleted from
+        the old one, so an interrupted rebalance loses nothing and can be run again. The copies get new IDs. The
+        customers and resellers referenced by the coupons are copied to the new shard if it misses them, and the
+        available coupons of the customers follow the coupons. The counters of the application database are kept.
+
+        Arguments:
+            chunk_size: The number of coupons read from a shard at once.
+
+        Returns:
+            The number of moved coupons.
+        """
+        table = CouponTable.__table__  # type: ignore
+        links = CouponCustomerLinkTable.__table__  # type: ignore
+        moved = 0
+        for source, make_session in enumerate(self._shards):
+            with make_session() as session:
+                last_id = 0
+                while rows := session.execute(
+                    select(table).where(table.c.id > last_id).order_by(table.c.id).limit(chunk_size)
+                ).all():
+                    last_id = rows[-1].id
+
+                    by_target: defaultdict[int, list[Row]] = defaultdict(list)
+                    for row in rows:
+                        target = self.shard_of(row.code)
+                        if target != source:
+                            by_target[target].append(row)
+                    if not by_target:
+                        continue
+
+                    for target, target_rows in by_target.items():
+                        with self._shards[target]() as target_session:
+                            self._copy(session, target_session, target_rows)
+                            target_session.commit()
+
+                    ids = [row.id for target_rows in by_target.values() for row in target_rows]
+                    record_changes(session, ChangeOperation.deleted, col(CouponTable.id).in_(ids))
+                    remove_available_coupons(session, col(CouponTable.id).in_(ids))
+                    session.execute(links.delete().where(links.c.coupon_id.in_(ids)))
+                    session.execute(table.delete().where(table.c.id.in_(ids)))
+                    session.commit()
+                    moved += len(ids)
+        return moved
+
+    def _copy(self, source: Session, target: Session, rows: list[Row]) -> None:
+        """
+        Copies coupons of the source shard to the target shard with their links, without committing.
+
+        A coupon already copied by an interrupted rebalance is overwritten.
+        """
+        links = CouponCustomerLinkTable.__table__  # type: ignore
+        codes = {row.id: row.code for row in rows}
+        linked = source.execute(
+            select(links.c.coupon_id, links.c.customer_id).where(links.c.coupon_id.in_(codes))
+        ).all()
+        _copy_missing(
+            source,
+            target,
+            ResellerTable,
+            {row.reseller_id for row in rows if row.reseller_id is not None},
+            reset=COUNTERS,
+        )
+        _copy_missing(source, target, CustomerTable, {link.customer_id for link in linked})
+
+        values: list[dict[str, Any]] = [
+            {key: value for key, value in row._mapping.items() if key != "id"} for row in rows
+        ]
+        upsert(target, CouponTable, values, index_elements=["code"])
+        new_ids = dict(
+            target.execute(
+                select(CouponTable.code, CouponTable.id).where(col(CouponTable.code).in_(codes.values()))
+            ).all()
+        )
+
+        target.execute(links.delete().where(links.c.coupon_id.in_(new_ids.values())))
+        if linked:
+            target.execute(
+                links.insert(),
+                [{"coupon_id": new_ids[codes[link.coupon_id]], "customer_id": link.customer_id} for link in linked],
+            )
+        refresh_available_coupons(target, col(CouponTable.id).in_(new_ids.values()))
+        record_changes(target, ChangeOperation.created, col(CouponTable.id).in_(new_ids.values()))
@@ -0,0 +1,59 @@
+from datetime import datetime
+
+from fastapi import APIRouter, Depends
+from sqlmodel import Session
+from typing_extensions import Annotated
+
+from coupon_app.settings import get_settings, Settings
+from coupon_app.typings import SessionContextProvider
+
+from .model import CouponSummary, DiscountDistribution
+from .service import CouponAnalyticsService
+
+
+def make_routes(*, session_provider: SessionContextProvider) -> APIRouter:
+    """
+    Analytics `APIRouter` factory.
+
+    Arguments:
+        session_provider: Session context provider dependency.
+    """
+
+    router = APIRouter(
+        prefix="/analytics",
+        tags=["analytics"],
+    )
+
+    def service_provider(
+        session: Annotated[Session, Depends(session_provider)], settings: Annotated[Settings, Depends(get_settings)]
+    ) -> CouponAnalyticsService:
+        """
+        FastAPI dependency that creates an analytics service instance with an up-to-date snapshot for the API.
+        """
+        service = CouponAnalyticsService(session)
+        service.refresh(settings.analytics_refresh_seconds, settings.analytics_rebuild_seconds)
+        return service
+
+    ServiceProvider = Annotated[CouponAnalyticsService, Depends(service_provider)]
+
+    @router.get("/coupons/summary", response_model=CouponSummary)
+    def coupon_summary(*, service: ServiceProvider, at: datetime | None = None):
+        """
+        Count the coupons by discount type: all, active, valid and both active and valid.
+
+        Arguments:
+        - **at**: The time of the validity check, defaults to now
+        """
+        return service.summary(at or datetime.utcnow())
+
+    @router.get("/coupons/discounts", response_model=list[DiscountDistribution])
+    def discount_distribution(*, service: ServiceProvider, active_only: bool = False):
+        """
+        Return the distribution of the discount amounts by discount type.
+
+        Arguments:
+        - **active_only**: Only include active coupons
+        """
+        return service.discounts(active_only)
+
+    return router
@@ -0,0 +1,4 @@
+metadata = {
+    "name": "analytics",
+    "description": "Aggregates over an in-memory snapshot of the coupons.",
+}
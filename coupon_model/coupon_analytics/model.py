@@ -0,0 +1,42 @@
+from datetime import datetime
+
+from pydantic import BaseModel
+
+from coupon_model.coupon.model import DiscountType
+
+
+class TypeSummary(BaseModel):
+    """
+    Coupon counts of a discount type.
+    """
+
+    discount_type: DiscountType
+    total: int
+    active: int
+    valid: int
+    active_and_valid: int
+
+
+class CouponSummary(BaseModel):
+    """
+    Coupon counts by discount type at a point in time.
+    """
+
+    at: datetime
+    snapshot_size: int
+    types: list[TypeSummary]
+
+
+class DiscountDistribution(BaseModel):
+    """
+    The distribution of the discount amounts of a discount type, the statistics are null without coupons.
+    """
+
+    discount_type: DiscountType
+    count: int
+    min: int | None
+    max: int | None
+    mean: float | None
+    p50: int | None
+    p90: int | None
+    p99: int | None
@@ -0,0 +1,353 @@
+from calendar import timegm
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+import time
+from typing import NamedTuple
+
+import numpy as np
+from sqlalchemy import BigInteger, cast, extract, func, Integer, select, String, type_coerce
+from sqlmodel import col, Session
+
+from coupon_model.coupon.model import CouponTable, DiscountType
+from coupon_utils.tracing import trace_methods
+
+from .model import CouponSummary, DiscountDistribution, TypeSummary
+
+# Discount types by their code in the snapshot.
+DISCOUNT_TYPES = list(DiscountType)
+
+# Modified rows are re-read with this overlap, so updates committed out of `updated_at` order are not missed.
+UPDATE_OVERLAP = timedelta(seconds=10)
+
+LOAD_CHUNK_SIZE = 50_000
+
+
+def to_epoch(value: datetime) -> int:
+    """
+    Returns the UNIX time of a datetime, naive datetimes are treated as UTC.
+    """
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return timegm(value.timetuple())
+
+
+def epoch(session: Session, column):
+    """
+    Returns an expression converting a naive UTC datetime column to UNIX time in the database.
+
+    Parsing millions of datetimes in Python would dominate the load time of the snapshot.
+    """
+    if session.get_bind().dialect.name == "sqlite":
+        return cast(func.strftime("%s", column), Integer)
+    return cast(extract("epoch", column), BigInteger)
+
+
+def percentile(values: np.ndarray, fraction: float) -> int:
+    """
+    Returns the value at the given fraction of sorted, non-empty values.
+    """
+    return int(values[min(len(values) - 1, int(fraction * len(values)))])
+
+
+class Group(NamedTuple):
+    """
+    Sorted columns of the coupons with the same discount type and activity.
+    """
+
+    # The validity bounds of the coupons with a non-empty validity period.
+    valid_from: np.ndarray
+    valid_until: np.ndarray
+    discount: np.ndarray
+
+    def valid_count(self, at: int) -> int:
+        """
+        Counts the coupons valid at the given UNIX time.
+        """
+        # A coupon valid until `at` started before it, so the difference counts the coupons valid at `at`.
+        return int(np.searchsorted(self.valid_from, at, "right") - np.searchsorted(self.valid_until, at, "right"))
+
+
+class CouponSnapshot:
+    """
+    A columnar in-memory copy of the coupon columns used by the analytics.
+
+    The columns are NumPy arrays ordered by coupon ID, 30 bytes per coupon plus spare capacity. New coupons are
+    appended by ID watermark and modified coupons are patched by `updated_at` watermark, deleted coupons only leave
+    with a full rebuild. The validity bounds are 64-bit UNIX times, so any date stored in the database fits.
+    The aggregates are served from sorted per-group copies of the columns built on the first query after a change,
+    so a query costs a few binary searches.
+    """
+
+    __slots__ = (
+        "_lock",
+        "_size",
+        "_ids",
+        "_discount",
+        "_discount_type",
+        "_is_active",
+        "_valid_from",
+        "_valid_until",
+        "_last_id",
+        "_last_updated_at",
+        "_refreshed_at",
+        "_rebuilt_at",
+        "_groups",
+    )
+
+    def __init__(self) -> None:
+        """
+        Initialization.
+        """
+        self._lock = Lock()
+        self._clear()
+
+    def _clear(self) -> None:
+        self._size = 0
+        self._ids = np.empty(0, dtype=np.int64)
+        self._discount = np.empty(0, dtype=np.int32)
+        self._discount_type = np.empty(0, dtype=np.uint8)
+        self._is_active = np.empty(0, dtype=np.bool_)
+        self._valid_from = np.empty(0, dtype=np.int64)
+        self._valid_until = np.empty(0, dtype=np.int64)
+        self._last_id = 0
+        self._last_updated_at: datetime | None = None
+        self._refreshed_at: float | None = None
+        self._rebuilt_at: float | None = None
+        self._groups: dict[tuple[int, bool], Group] | None = None
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The memory used by the columns, including the unused capacity.
+        """
+        columns = (self._ids, self._discount, self._discount_type, self._is_active, self._valid_from, self._valid_until)
+        return sum(column.nbytes for column in columns)
+
+    def refresh(self, session: Session, *, max_age: float = 0.0, rebuild_after: float | None = None) -> None:
+        """
+        Loads the coupons created or modified since the last refresh.
+
+        Arguments:
+            session: The session instance.
+            max_age: Skip the refresh if the last one is more recent, in seconds.
+            rebuild_after: Reload everything if the last full load is older, in seconds.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._refreshed_at is not None and now - self._refreshed_at < max_age:
+                return
+            if self._rebuilt_at is None or (rebuild_after is not None and now - self._rebuilt_at >= rebuild_after):
+                self._clear()
+                self._rebuilt_at = now
+            self._load(session)
+            self._refreshed_at = now
+
+    def _load(self, session: Session) -> None:
+        columns = (
+            CouponTable.id,
+            CouponTable.discount,
+            # Skip the enum conversion, the names are mapped to codes in bulk.
+            type_coerce(col(CouponTable.discount_type), String),
+            CouponTable.is_active,
+            epoch(session, CouponTable.valid_from),
+            epoch(session, CouponTable.valid_until),
+        )
+        last_id, last_updated_at = self._last_id, self._last_updated_at
+
+        # Taken before reading, so the rows modified meanwhile are read again by the next refresh.
+        self._last_updated_at = session.execute(select(func.max(CouponTable.updated_at))).scalar_one()
+
+        if last_updated_at is not None:
+            modified = (
+                select(*columns)
+                .where(col(CouponTable.id) <= last_id, col(CouponTable.updated_at) > last_updated_at - UPDATE_OVERLAP)
+                .order_by(CouponTable.id)
+            )
+            for rows in session.execute(modified.execution_options(yield_per=LOAD_CHUNK_SIZE)).partitions():
+                self._patch(rows)
+
+        created = select(*columns).where(col(CouponTable.id) > last_id).order_by(CouponTable.id)
+        for rows in session.execute(created.execution_options(yield_per=LOAD_CHUNK_SIZE)).partitions():
+            self._append(rows)
+
+    @staticmethod
+    def _columns(rows) -> tuple[np.ndarray, ...]:
+        ids, discount, discount_type, is_active, valid_from, valid_until = zip(*rows)
+        names = np.array(discount_type)
+        type_codes = np.zeros(len(names), dtype=np.uint8)
+        for code, type in enumerate(DISCOUNT_TYPES):
+            type_codes[names == type.name] = code
+        return (
+            np.array(ids, dtype=np.int64),
+            np.array(discount, dtype=np.int32),
+            type_codes,
+            np.array(is_active, dtype=np.bool_),
+            np.array(valid_from, dtype=np.int64),
+            np.array(valid_until, dtype=np.int64),
+        )
+
+    def _append(self, rows) -> None:
+        values = self._columns(rows)
+        size, count = self._size, len(values[0])
+        if size + count > len(self._ids):
+            # Grow geometrically, so appending stays amortized O(1) per coupon.
+            capacity = max(size + count, 2 * len(self._ids))
+            for name in ("_ids", "_discount", "_discount_type", "_is_active", "_valid_from", "_valid_until"):
+                column = getattr(self, name)
+                grown = np.empty(capacity, dtype=column.dtype)
+                grown[:size] = column[:size]
+                setattr(self, name, grown)
+        for column, value in zip(self._arrays(), values):
+            column[size : size + count] = value
+        self._size += count
+        self._last_id = int(values[0][-1])
+        self._groups = None
+
+    def _patch(self, rows) -> None:
+        ids, *values = self._columns(rows)
+        positions = np.searchsorted(self._ids[: self._size], ids)
+        found = positions < self._size
+        found[found] = self._ids[positions[found]] == ids[found]
+        for column, value in zip(self._arrays()[1:], values):
+            column[positions[found]] = value[found]
+        self._groups = None
+
+    def _arrays(self) -> tuple[np.ndarray, ...]:
+        return self._ids, self._discount, self._discount_type, self._is_active, self._valid_from, self._valid_until
+
+    def _get_groups(self) -> dict[tuple[int, bool], Group]:
+        if self._groups is None:
+            size = self._size
+            discount_type, is_active = self._discount_type[:size], self._is_active[:size]
+            valid_from, valid_until = self._valid_from[:size], self._valid_until[:size]
+            non_empty = valid_from < valid_until
+            self._groups = {}
+            for type_code in range(len(DISCOUNT_TYPES)):
+                for active in (False, True):
+                    mask = (discount_type == type_code) & (is_active == active)
+                    self._groups[type_code, active] = Group(
+                        valid_from=np.sort(valid_from[mask & non_empty]),
+                        valid_until=np.sort(valid_until[mask & non_empty]),
+                        discount=np.sort(self._discount[:size][mask]),
+                    )
+        return self._groups
+
+    def summary(self, at: datetime) -> CouponSummary:
+        """
+        Counts the coupons by discount type, activity and validity at the given time.
+
+        Arguments:
+            at: The time of the validity check.
+        """
+        epoch = to_epoch(at)
+        with self._lock:
+            groups = self._get_groups()
+            types = []
+            for type_code, discount_type in enumerate(DISCOUNT_TYPES):
+                inactive, active = groups[type_code, False], groups[type_code, True]
+                active_and_valid = active.valid_count(epoch)
+                types.append(
+                    TypeSummary(
+                        discount_type=discount_type,
+                        total=len(inactive.discount) + len(active.discount),
+                        active=len(active.discount),
+                        valid=inactive.valid_count(epoch) + active_and_valid,
+                        active_and_valid=active_and_valid,
+                    )
+                )
+            return CouponSummary(at=at, snapshot_size=self._size, types=types)
+
+    def discounts(self, active_only: bool) -> list[DiscountDistribution]:
+        """
+        Returns the distribution of the discount amounts by discount type.
+
+        Arguments:
+            active_only: Only include active coupons.
+        """
+        with self._lock:
+            groups = self._get_groups()
+            distributions = []
+            for type_code, discount_type in enumerate(DISCOUNT_TYPES):
+                parts = [groups[type_code, True].discount]
+                if not active_only:
+                    parts.append(groups[type_code, False].discount)
+                discount = np.sort(np.concatenate(parts)) if len(parts) > 1 else parts[0]
+
+                count = len(discount)
+                if not count:
+                    distributions.append(
+                        DiscountDistribution(
+                            discount_type=discount_type,
+                            count=0,
+                            min=None,
+                            max=None,
+                            mean=None,
+                            p50=None,
+                            p90=None,
+                            p99=None,
+                        )
+                    )
+                    continue
+
+                distributions.append(
+                    DiscountDistribution(
+                        discount_type=discount_type,
+                        count=count,
+                        min=int(discount[0]),
+                        max=int(discount[-1]),
+                        mean=float(discount.mean()),
+                        p50=percentile(discount, 0.5),
+                        p90=percentile(discount, 0.9),
+                        p99=percentile(discount, 0.99),
+                    )
+                )
+            return distributions
+
+
+# The snapshot shared by the requests of the process.
+snapshot = CouponSnapshot()
+
+
+@trace_methods
+class CouponAnalyticsService:
+    """
+    Coupon analytics services.
+    """
+
+    __slots__ = "_session", "_snapshot"
+
+    def __init__(self, session: Session, snapshot: CouponSnapshot = snapshot) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            session: The session instance.
+            snapshot: The coupon snapshot.
+        """
+        self._session = session
+        self._snapshot = snapshot
+
+    def refresh(self, max_age: float, rebuild_after: float) -> None:
+        """
+        Brings the snapshot up to date if it is older than `max_age` seconds.
+
+        Arguments:
+            max_age: The maximum age of the snapshot in seconds.
+            rebuild_after: The maximum age of the last full load in seconds.
+        """
+        self._snapshot.refresh(self._session, max_age=max_age, rebuild_after=rebuild_after)
+
+    def summary(self, at: datetime) -> CouponSummary:
+        """
+        Returns the coupon counts by discount type at the given time.
+        """
+        return self._snapshot.summary(at)
+
+    def discounts(self, active_only: bool) -> list[DiscountDistribution]:
+        """
+        Returns the discount distributions by discount type.
+        """
+        return self._snapshot.discounts(active_only)
@@ -1,4 +1,4 @@
-from sqlmodel import Field, SQLModel
+from sqlmodel import Column, Field, ForeignKey, Integer, SQLModel
 
 
 class BaseCouponCustomerLink(SQLModel):
@@ -7,7 +7,7 @@ class BaseCouponCustomerLink(SQLModel):
     """
 
     coupon_id: int = Field(foreign_key="coupons.id", primary_key=True)
-    customer_id: int = Field(foreign_key="customers.id", primary_key=True)
+    customer_id: int = Field(foreign_key="customers.id", primary_key=True, index=True)
 
 
 class CouponCustomerLinkTable(BaseCouponCustomerLink, table=True):
@@ -17,6 +17,23 @@ class CouponCustomerLinkTable(BaseCouponCustomerLink, table=True):
 
     __tablename__ = "coupon_customer_link"
 
+    # The links are deleted with their coupon or customer by the database.
+    coupon_id: int = Field(sa_column=Column(Integer, ForeignKey("coupons.id", ondelete="CASCADE"), primary_key=True))
+    customer_id: int = Field(
+        sa_column=Column(Integer, ForeignKey("customers.id", ondelete="CASCADE"), primary_key=True, index=True)
+    )
+
+
+class CouponCustomerLinkArchiveTable(SQLModel, table=True):
+    """
+    Coupon-customer link archive DB table, the links of the archived coupons.
+    """
+
+    __tablename__ = "coupon_customer_link_archive"
+
+    coupon_id: int = Field(primary_key=True, sa_column_kwargs={"autoincrement": False})
+    customer_id: int = Field(primary_key=True, index=True, sa_column_kwargs={"autoincrement": False})
+
 
 class CouponCustomerLink(BaseCouponCustomerLink):
     """
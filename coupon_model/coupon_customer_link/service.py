@@ -1,10 +1,15 @@
 from sqlmodel import select, Session
 
+from coupon_model.coupon.model import AvailableCouponTable, CouponTable
+from coupon_model.coupon.service import refresh_available_coupons
+from coupon_utils.db import delete_where, insert_returning
 from coupon_utils.service import CommitFailed, NotFound
+from coupon_utils.tracing import trace_methods
 
 from .model import CouponCustomerLinkCreate, CouponCustomerLinkTable
 
 
+@trace_methods
 class CouponCustomerLinkService:
     """
     Coupon-customer-link-related services.
@@ -33,13 +38,12 @@ class CouponCustomerLinkService:
         """
         session = self._session
 
-        db_item = CouponCustomerLinkTable.from_orm(data)
-        session.add(db_item)
         try:
+            db_item = insert_returning(session, CouponCustomerLinkTable.from_orm(data))
+            refresh_available_coupons(session, CouponTable.id == data.coupon_id, customer_id=data.customer_id)
             session.commit()
         except Exception:
             raise CommitFailed("Failed to create the link.")
-        session.refresh(db_item)
         return db_item
 
     def delete_by_ids(self, coupon_id: int, customer_id: int) -> None:
@@ -55,11 +59,21 @@ class CouponCustomerLinkService:
         """
         session = self._session
 
-        item = self.get_by_ids(coupon_id=coupon_id, customer_id=customer_id)
-        if item is None:
+        deleted = delete_where(
+            session,
+            CouponCustomerLinkTable,
+            CouponCustomerLinkTable.coupon_id == coupon_id,
+            CouponCustomerLinkTable.customer_id == customer_id,
+        )
+        if not deleted:
             raise NotFound("Link not found.")
+        delete_where(
+            session,
+            AvailableCouponTable,
+            AvailableCouponTable.coupon_id == coupon_id,
+            AvailableCouponTable.customer_id == customer_id,
+        )
 
-        session.delete(item)
         try:
             session.commit()
         except Exception:
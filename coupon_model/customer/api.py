@@ -1,11 +1,32 @@
-from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, status
 from sqlmodel import Session
 from typing_extensions import Annotated
 
 from coupon_app.typings import SessionContextProvider
-from coupon_utils.service import CommitFailed, NotFound
+from coupon_utils.bulk import BulkResult
+from coupon_utils.http import (
+    conditional_response,
+    entity_tag,
+    json_response,
+    row_fields,
+    select_fields,
+    split_keys,
+    VALIDATOR_FIELDS,
+    weak_list_tag,
+)
+from coupon_utils.service import CommitFailed, NotFound, ValidationFailed
 
-from .model import Customer, CustomerCreate, CustomerUpdate
+from coupon_model.coupon.model import AvailableCoupon, BestCouponQuery, BestCoupons
+
+from .model import (
+    Customer,
+    CustomerBatchItem,
+    CustomerBulkDelete,
+    CustomerBulkUpdate,
+    CustomerCreate,
+    CustomerSearchPage,
+    CustomerUpdate,
+)
 from .service import CustomerService
 
 
@@ -30,22 +51,117 @@ def make_routes(*, session_provider: SessionContextProvider) -> APIRouter:
 
     ServiceProvider = Annotated[CustomerService, Depends(service_provider)]
 
-    @router.get("/", response_model=list[Customer])
-    def get_all(*, service: ServiceProvider, offset: int = 0, limit: int = Query(default=20, lte=50)):
+    @router.get("/", response_model=list[Customer], responses={304: {"description": "Not modified."}})
+    def get_all(
+        *,
+        service: ServiceProvider,
+        response: Response,
+        offset: int = 0,
+        limit: int = Query(default=20, lte=50),
+        fields: str | None = Query(default=None, description="Comma-separated fields to return, all by default."),
+        if_none_match: Annotated[str | None, Header()] = None,
+    ):
         """
         Return all the customers.
+
+        Pass `fields` to get only some fields of the customers, the `id` is always returned.
+        The response has a weak `ETag`, send it in `If-None-Match` to get _304 Not Modified_ if the page is unchanged.
+        """
+        selected = select_fields(fields, Customer)
+        customers = service.get_rows(offset, limit, [*selected, *VALIDATOR_FIELDS])
+        etag = weak_list_tag((customer.id, customer.version) for customer in customers)
+        last_modified = max((customer.updated_at for customer in customers), default=None)
+        return conditional_response(response, etag, last_modified, if_none_match) or json_response(
+            response, [row_fields(customer, selected) for customer in customers]
+        )
+
+    @router.get("/search", response_model=CustomerSearchPage)
+    def search(
+        *,
+        service: ServiceProvider,
+        q: str = Query(min_length=1, max_length=100),
+        limit: int = Query(default=20, lte=50),
+        after: str | None = None,
+    ):
+        """
+        Search customers by name or username prefix.
+
+        The best matches come first.
+        Pass the returned `next` cursor as `after` to get the next page.
+        """
+        try:
+            items, next = service.search(q, limit, after)
+        except ValidationFailed as exception:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=exception.args)
+        return {"items": items, "next": next}
+
+    @router.get("/batch", response_model=list[CustomerBatchItem])
+    def get_many(
+        *,
+        service: ServiceProvider,
+        ids: str | None = Query(default=None, description="Comma-separated customer IDs."),
+        usernames: str | None = Query(default=None, description="Comma-separated usernames."),
+    ):
+        """
+        Return many customers at once.
+
+        The customers of the IDs come first, then the ones of the usernames, in request order.
+        A customer that does not exist is returned with a null `customer`.
         """
-        return service.get_all(offset, limit)
+        try:
+            keys = split_keys(ids, int), split_keys(usernames, str)
+        except ValueError as exception:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=exception.args)
+        return service.get_many(*keys)
 
-    @router.get("/{id}", response_model=Customer)
-    def get_by_id(*, service: ServiceProvider, id: int):
+    @router.get("/{id}", response_model=Customer, responses={304: {"description": "Not modified."}})
+    def get_by_id(
+        *,
+        service: ServiceProvider,
+        response: Response,
+        id: int,
+        fields: str | None = Query(default=None, description="Comma-separated fields to return, all by default."),
+        if_none_match: Annotated[str | None, Header()] = None,
+    ):
         """
         Return a customer by ID.
+
+        The response has an `ETag` and a `Last-Modified` header.
+        Send the `ETag` in `If-None-Match` to get _304 Not Modified_ if the customer is unchanged.
+        Pass `fields` to get only some fields of the customer, the `id` is always returned.
         """
-        customer = service.get_by_id(id)
+        selected = select_fields(fields, Customer)
+        customer = service.get_row(id, [*selected, *VALIDATOR_FIELDS])
         if customer is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Customer not found.")
-        return customer
+        etag = entity_tag(customer.id, customer.version)
+        return conditional_response(response, etag, customer.updated_at, if_none_match) or json_response(
+            response, row_fields(customer, selected)
+        )
+
+    @router.get("/{id}/available-coupons", response_model=list[AvailableCoupon])
+    def available_coupons(*, service: ServiceProvider, id: int):
+        """
+        Return the active, unredeemed and currently valid coupons linked to a customer.
+
+        An unknown customer has no coupons.
+        """
+        return service.available_coupons(id)
+
+    @router.post("/{id}/best-coupon", response_model=BestCoupons)
+    def best_coupon(*, service: ServiceProvider, id: int, data: BestCouponQuery):
+        """
+        Choose the available coupons of a customer giving the largest discount on a cart.
+
+        The coupons are priced as by `POST /coupons/price`: the percentages are summed up (capped at 100%) and
+        applied first, then the fixed amounts are subtracted. The fewest coupons reaching the largest discount
+        are returned, nothing is applied.
+
+        Arguments:
+        - **subtotal**: The cart total before the discounts
+        - **max_coupons**: The number of coupons the cart accepts at once, 1 by default
+        """
+        return service.best_coupons(id, data)
 
     @router.post(
         "/",
@@ -69,6 +185,41 @@ def make_routes(*, session_provider: SessionContextProvider) -> APIRouter:
                 detail=exception.args,
             )
 
+    @router.post("/bulk-update", response_model=BulkResult)
+    def bulk_update(*, service: ServiceProvider, data: CustomerBulkUpdate):
+        """
+        Update many customers selected by IDs or by a filter.
+
+        The customers are updated in chunks of at most 1000 and every chunk is committed on its own,
+        so a large update never holds long locks. If a chunk fails, the previous chunks stay updated.
+
+        Arguments:
+        - **ids**: The IDs of the customers, or
+        - **filter**: The attributes of the customers
+        - **changes**: The new values, as in the update of one customer
+        """
+        try:
+            return BulkResult(count=service.bulk_update(data))
+        except CommitFailed as exception:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=exception.args)
+
+    @router.post("/bulk-delete", response_model=BulkResult)
+    def bulk_delete(*, service: ServiceProvider, data: CustomerBulkDelete):
+        """
+        Delete many customers selected by IDs or by a filter.
+
+        The customers are deleted in chunks and every chunk is committed on its own.
+        If a chunk fails, the previous chunks stay deleted.
+
+        Arguments:
+        - **ids**: The IDs of the customers, or
+        - **filter**: The attributes of the customers
+        """
+        try:
+            return BulkResult(count=service.bulk_delete(data))
+        except CommitFailed as exception:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=exception.args)
+
     @router.delete("/{id}")
     def delete_by_id(*, service: ServiceProvider, id: int):
         """
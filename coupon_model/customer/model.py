@@ -1,9 +1,12 @@
 from typing import TYPE_CHECKING
 
 from datetime import datetime
+from pydantic import BaseModel
 from sqlmodel import Column, DateTime, Field, Relationship, SQLModel
 
 from coupon_model.coupon_customer_link.model import CouponCustomerLinkTable
+from coupon_utils.bulk import BulkFilter, BulkSelection
+from coupon_utils.search import SearchIndex
 
 if TYPE_CHECKING:
     from coupon_model.coupon.model import CouponTable
@@ -33,10 +36,17 @@ class CustomerTable(CustomerBase, table=True):
     created_at: datetime | None = Field(
         default_factory=datetime.utcnow, sa_column=Column(DateTime(timezone=True), nullable=False)
     )
+    updated_at: datetime | None = Field(
+        default_factory=datetime.utcnow, sa_column=Column(DateTime(timezone=True), nullable=False)
+    )
+    version: int = Field(default=1, sa_column_kwargs={"server_default": "1"})
 
     coupons: list["CouponTable"] = Relationship(back_populates="customers", link_model=CouponCustomerLinkTable)
 
 
+customer_search_index = SearchIndex(CustomerTable, trigram_columns=("name",), prefix_columns=("username",))
+
+
 class Customer(CustomerBase):
     """
     Customer
@@ -47,6 +57,25 @@ class Customer(CustomerBase):
     created_at: datetime
 
 
+class CustomerBatchItem(BaseModel):
+    """
+    A customer requested by ID or username, `customer` is null if the customer does not exist.
+    """
+
+    id: int | None
+    username: str | None
+    customer: Customer | None
+
+
+class CustomerSearchPage(BaseModel):
+    """
+    A page of customer search results, `next` is the cursor of the next page.
+    """
+
+    items: list[Customer]
+    next: str | None
+
+
 class CustomerCreate(CustomerBase):
     """
     Customer creation model.
@@ -68,3 +97,30 @@ class CustomerUpdate(SQLModel):
     """
 
     name: str | None
+
+
+class CustomerFilter(BulkFilter):
+    """
+    Selects customers by their attributes, the unset attributes match every customer.
+    """
+
+    username_prefix: str | None = None
+    created_before: datetime | None = None
+    created_after: datetime | None = None
+
+
+class CustomerBulkUpdate(BulkSelection):
+    """
+    Bulk customer update request model, the customers are selected by `ids` or `filter`.
+    """
+
+    filter: CustomerFilter | None = None
+    changes: CustomerUpdate
+
+
+class CustomerBulkDelete(BulkSelection):
+    """
+    Bulk customer delete request model, the customers are selected by `ids` or `filter`.
+    """
+
+    filter: CustomerFilter | None = None
@@ -1,10 +1,43 @@
-from sqlmodel import select, Session
+from datetime import datetime
+from typing import Any, Iterable
 
+from sqlalchemy import bindparam
+from sqlalchemy.engine import Row
+from sqlmodel import col, select, Session
+
+from coupon_model.coupon.model import AvailableCouponTable, BestCouponQuery, BestCoupons
+from coupon_model.coupon.pricing import best_coupons, Discount
+from coupon_model.coupon_customer_link.model import CouponCustomerLinkTable
+from coupon_utils.bulk import bulk_write, commit_chunks
+from coupon_utils.db import delete_where, insert_returning, projection, rows_by_keys, update_returning, upsert
 from coupon_utils.service import CommitFailed, NotFound
+from coupon_utils.tracing import trace_methods
+
+from .model import (
+    customer_search_index,
+    Customer,
+    CustomerBatchItem,
+    CustomerBulkDelete,
+    CustomerBulkUpdate,
+    CustomerCreate,
+    CustomerFilter,
+    CustomerTable,
+    CustomerUpdate,
+)
 
-from .model import CustomerCreate, CustomerTable, CustomerUpdate
+# The hot lookup, built once.
+_AVAILABLE_COUPONS = (
+    select(AvailableCouponTable)
+    .where(
+        AvailableCouponTable.customer_id == bindparam("customer_id"),
+        AvailableCouponTable.valid_from <= bindparam("now"),
+        AvailableCouponTable.valid_until > bindparam("now"),
+    )
+    .order_by(AvailableCouponTable.coupon_id)
+)
 
 
+@trace_methods
 class CustomerService:
     """
     Customer-related services.
@@ -33,18 +66,43 @@ class CustomerService:
         """
         session = self._session
 
-        db_item = CustomerTable.from_orm(data)
-        session.add(db_item)
         try:
+            db_item = insert_returning(session, CustomerTable.from_orm(data))
             session.commit()
         except Exception:
             raise CommitFailed("Failed to create the customer.")
-        session.refresh(db_item)
         return db_item
 
+    def upsert_many(self, rows: list[dict[str, Any]]) -> None:
+        """
+        Creates the customers or updates the existing ones with the same username in one statement.
+
+        Arguments:
+            rows: Validated `CustomerCreate` values.
+
+        Raises:
+            CommitFailed: If the service fails to commit the customers.
+        """
+        session = self._session
+
+        now = datetime.utcnow()
+        try:
+            upsert(
+                session,
+                CustomerTable,
+                [{**row, "created_at": now, "updated_at": now, "version": 1} for row in rows],
+                index_elements=["username"],
+                exclude_from_update=("created_at", "version"),
+                update_values={"version": CustomerTable.version + 1},
+            )
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise CommitFailed("Failed to upsert the customers.")
+
     def delete_by_id(self, id: int) -> None:
         """
-        Deletes the customer by ID.
+        Deletes the customer by ID, with its coupon links and its available coupons.
 
         Arguments:
             id: Customer database ID.
@@ -55,22 +113,48 @@ class CustomerService:
         """
         session = self._session
 
-        item = self.get_by_id(id)
-        if item is None:
-            raise NotFound("Customer not found.")
-
-        session.delete(item)
         try:
+            delete_where(session, AvailableCouponTable, AvailableCouponTable.customer_id == id)
+            delete_where(session, CouponCustomerLinkTable, CouponCustomerLinkTable.customer_id == id)
+            deleted = delete_where(session, CustomerTable, CustomerTable.id == id)
             session.commit()
         except Exception:
+            session.rollback()
             raise CommitFailed("Failed to delete the customer.")
 
+        if not deleted:
+            raise NotFound("Customer not found.")
+
     def get_all(self, offset: int, limit: int) -> list[CustomerTable]:
         """
         Returns all customers from the database with pagination.
         """
         return self._session.exec(select(CustomerTable).offset(offset).limit(limit)).all()
 
+    def get_rows(self, offset: int, limit: int, fields: Iterable[str]) -> list[Row]:
+        """
+        Returns the given fields of all customers with pagination, as plain rows for read-only use.
+        """
+        statement = projection(CustomerTable, fields).order_by(CustomerTable.id).offset(offset).limit(limit)
+        return self._session.execute(statement).all()
+
+    def search(self, q: str, limit: int, after: str | None) -> tuple[list[CustomerTable], str | None]:
+        """
+        Returns a page of the customers best matching the search text.
+
+        Arguments:
+            q: The search text.
+            limit: The maximum number of customers.
+            after: The cursor returned with the previous page.
+
+        Returns:
+            The customers and the cursor of the next page.
+
+        Raises:
+            ValidationFailed: If the cursor is malformed.
+        """
+        return customer_search_index.search(self._session, q, limit, after)
+
     def get_by_id(self, id: int) -> CustomerTable | None:
         """
         Returns the customer with the given ID if it exists.
@@ -80,6 +164,67 @@ class CustomerService:
         """
         return self._session.get(CustomerTable, id)
 
+    def get_row(self, id: int, fields: Iterable[str]) -> Row | None:
+        """
+        Returns the given fields of the customer with the given ID as a plain row.
+
+        Arguments:
+            id: Customer database ID.
+            fields: The names of the selected columns.
+        """
+        return self._session.execute(projection(CustomerTable, fields).where(CustomerTable.id == id)).first()
+
+    def get_many(self, ids: list[int], usernames: list[str]) -> list[CustomerBatchItem]:
+        """
+        Returns the customers with the given IDs and usernames.
+
+        The customers are resolved with one `IN` query per `IN_CHUNK_SIZE` IDs and usernames, as plain rows.
+
+        Arguments:
+            ids: Customer database IDs.
+            usernames: Customer usernames.
+
+        Returns:
+            The customers of the requested IDs, then of the requested usernames, in request order.
+        """
+        by_id: dict[int, CustomerBatchItem] = {}
+        by_username: dict[str, CustomerBatchItem] = {}
+        for row in rows_by_keys(self._session, CustomerTable, Customer.__fields__, id=ids, username=usernames):
+            item = CustomerBatchItem(id=row.id, username=row.username, customer=Customer.from_orm(row))
+            by_id[row.id] = by_username[row.username] = item
+
+        return [by_id.get(id) or CustomerBatchItem(id=id, username=None, customer=None) for id in ids] + [
+            by_username.get(username) or CustomerBatchItem(id=None, username=username, customer=None)
+            for username in usernames
+        ]
+
+    def available_coupons(self, id: int) -> list[AvailableCouponTable]:
+        """
+        Returns the coupons the customer with the given ID can use now.
+
+        The coupons are read from their projection with one range scan of its primary key.
+
+        Arguments:
+            id: Customer database ID.
+        """
+        return self._session.exec(_AVAILABLE_COUPONS, params={"customer_id": id, "now": datetime.utcnow()}).all()
+
+    def best_coupons(self, id: int, data: BestCouponQuery) -> BestCoupons:
+        """
+        Chooses the coupons of the customer with the given ID giving the largest discount on a cart.
+
+        The candidates are the available coupons of the customer, read with one query, see `available_coupons()`.
+
+        Arguments:
+            id: Customer database ID.
+            data: The cart total and the maximum number of coupons.
+        """
+        discounts = [
+            Discount(coupon.code, coupon.discount, coupon.discount_type, True, coupon.valid_from, coupon.valid_until)
+            for coupon in self.available_coupons(id)
+        ]
+        return best_coupons(data.subtotal, discounts, data.max_coupons)
+
     def update(self, id: int, data: CustomerUpdate) -> CustomerTable:
         """
         Update a customer with the given ID.
@@ -94,19 +239,85 @@ class CustomerService:
         """
         session = self._session
 
-        db_item = self.get_by_id(id)
-        if db_item is None:
-            raise NotFound("Coupon not found.")
-
-        changes = data.dict(exclude_unset=True)
-        for key, value in changes.items():
-            setattr(db_item, key, value)
-
-        session.add(db_item)
+        changes = data.dict(exclude_unset=True) | {
+            "updated_at": datetime.utcnow(),
+            "version": CustomerTable.version + 1,
+        }
         try:
+            db_item = update_returning(session, CustomerTable, id, changes)
             session.commit()
         except Exception:
+            session.rollback()
             raise CommitFailed("Failed to update the customer.")
 
-        session.refresh(db_item)
+        if db_item is None:
+            raise NotFound("Customer not found.")
+
         return db_item
+
+    def bulk_update(self, data: CustomerBulkUpdate) -> int:
+        """
+        Updates the customers selected by IDs or by a filter in chunks, each chunk is committed on its own.
+
+        Arguments:
+            data: The selection and the update data.
+
+        Returns:
+            The number of updated customers.
+
+        Raises:
+            CommitFailed: If a chunk fails to commit, the previous chunks stay updated.
+        """
+        values = data.changes.dict(exclude_unset=True) | {
+            "updated_at": datetime.utcnow(),
+            "version": CustomerTable.version + 1,
+        }
+        counts = bulk_write(
+            self._session, CustomerTable, ids=data.ids, conditions=self._filter_conditions(data.filter), values=values
+        )
+        return commit_chunks(self._session, counts, "Failed to update the customers.")
+
+    def bulk_delete(self, data: CustomerBulkDelete) -> int:
+        """
+        Deletes the customers selected by IDs or by a filter in chunks, each chunk is committed on its own.
+        The coupon links and the available coupons of the customers are deleted with them.
+
+        Arguments:
+            data: The selection.
+
+        Returns:
+            The number of deleted customers.
+
+        Raises:
+            CommitFailed: If a chunk fails to commit, the previous chunks stay deleted.
+        """
+
+        def before_delete(where: tuple) -> None:
+            deleted = select(CustomerTable.id).where(*where)
+            delete_where(self._session, AvailableCouponTable, col(AvailableCouponTable.customer_id).in_(deleted))
+            delete_where(self._session, CouponCustomerLinkTable, col(CouponCustomerLinkTable.customer_id).in_(deleted))
+
+        counts = bulk_write(
+            self._session,
+            CustomerTable,
+            ids=data.ids,
+            conditions=self._filter_conditions(data.filter),
+            before_write=before_delete,
+        )
+        return commit_chunks(self._session, counts, "Failed to delete the customers.")
+
+    @staticmethod
+    def _filter_conditions(filter: CustomerFilter | None) -> tuple:
+        """
+        Returns the conditions of the customers matching the filter.
+        """
+        if filter is None:
+            return ()
+        conditions = []
+        if filter.username_prefix is not None:
+            conditions.append(col(CustomerTable.username).startswith(filter.username_prefix, autoescape=True))
+        if filter.created_before is not None:
+            conditions.append(col(CustomerTable.created_at) < filter.created_before)
+        if filter.created_after is not None:
+            conditions.append(col(CustomerTable.created_at) >= filter.created_after)
+        return tuple(conditions)
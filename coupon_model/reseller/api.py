@@ -1,11 +1,22 @@
-from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, status
 from sqlmodel import Session
 from typing_extensions import Annotated
 
 from coupon_app.typings import SessionContextProvider
+from coupon_utils.bulk import BulkResult
+from coupon_utils.http import conditional_response, entity_tag, split_keys, weak_list_tag
 from coupon_utils.service import CommitFailed, NotFound
 
-from .model import Reseller, ResellerCreate, ResellerUpdate
+from .model import (
+    Reseller,
+    ResellerBatchItem,
+    ResellerBulkDelete,
+    ResellerBulkUpdate,
+    ResellerCreate,
+    ResellerRanking,
+    ResellerStats,
+    ResellerUpdate,
+)
 from .service import ResellerService
 
 
@@ -30,22 +41,70 @@ def make_routes(*, session_provider: SessionContextProvider) -> APIRouter:
 
     ServiceProvider = Annotated[ResellerService, Depends(service_provider)]
 
-    @router.get("/", response_model=list[Reseller])
-    def get_all(*, service: ServiceProvider, offset: int = 0, limit: int = Query(default=20, lte=50)):
+    @router.get("/", response_model=list[Reseller], responses={304: {"description": "Not modified."}})
+    def get_all(
+        *,
+        service: ServiceProvider,
+        response: Response,
+        offset: int = 0,
+        limit: int = Query(default=20, lte=50),
+        if_none_match: Annotated[str | None, Header()] = None,
+    ):
         """
         Return all the resellers.
+
+        The response has a weak `ETag`, send it in `If-None-Match` to get _304 Not Modified_ if the page is unchanged.
+        """
+        resellers = service.get_all(offset, limit)
+        etag = weak_list_tag((reseller.id, reseller.version) for reseller in resellers)
+        last_modified = max(filter(None, (reseller.updated_at for reseller in resellers)), default=None)
+        return conditional_response(response, etag, last_modified, if_none_match) or resellers
+
+    @router.get("/top", response_model=list[ResellerStats])
+    def top(
+        *,
+        service: ServiceProvider,
+        k: int = Query(default=10, gt=0, lte=100),
+        by: ResellerRanking = ResellerRanking.issued,
+    ):
+        """
+        Return the leaderboard of the resellers by issued or redeemed coupons.
+        """
+        return service.top(k, by)
+
+    @router.get("/batch", response_model=list[ResellerBatchItem])
+    def get_many(
+        *,
+        service: ServiceProvider,
+        ids: str | None = Query(default=None, description="Comma-separated reseller IDs."),
+    ):
         """
-        return service.get_all(offset, limit)
+        Return many resellers at once.
 
-    @router.get("/{id}", response_model=Reseller)
-    def get_by_id(*, service: ServiceProvider, id: int):
+        The resellers are in request order.
+        A reseller that does not exist is returned with a null `reseller`.
+        """
+        try:
+            keys = split_keys(ids, int)
+        except ValueError as exception:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=exception.args)
+        return service.get_many(keys)
+
+    @router.get("/{id}", response_model=Reseller, responses={304: {"description": "Not modified."}})
+    def get_by_id(
+        *, service: ServiceProvider, response: Response, id: int, if_none_match: Annotated[str | None, Header()] = None
+    ):
         """
         Return a reseller by ID.
+
+        The response has an `ETag` and a `Last-Modified` header.
+        Send the `ETag` in `If-None-Match` to get _304 Not Modified_ if the reseller is unchanged.
         """
         reseller = service.get_by_id(id)
         if reseller is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Reseller not found.")
-        return reseller
+        etag = entity_tag(reseller.id, reseller.version)
+        return conditional_response(response, etag, reseller.updated_at, if_none_match) or reseller
 
     @router.post(
         "/",
@@ -68,6 +127,41 @@ def make_routes(*, session_provider: SessionContextProvider) -> APIRouter:
                 detail=exception.args,
             )
 
+    @router.post("/bulk-update", response_model=BulkResult)
+    def bulk_update(*, service: ServiceProvider, data: ResellerBulkUpdate):
+        """
+        Update many resellers selected by IDs or by a filter.
+
+        The resellers are updated in chunks of at most 1000 and every chunk is committed on its own,
+        so a large update never holds long locks. If a chunk fails, the previous chunks stay updated.
+
+        Arguments:
+        - **ids**: The IDs of the resellers, or
+        - **filter**: The attributes of the resellers
+        - **changes**: The new values, as in the update of one reseller
+        """
+        try:
+            return BulkResult(count=service.bulk_update(data))
+        except CommitFailed as exception:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=exception.args)
+
+    @router.post("/bulk-delete", response_model=BulkResult)
+    def bulk_delete(*, service: ServiceProvider, data: ResellerBulkDelete):
+        """
+        Delete many resellers selected by IDs or by a filter.
+
+        The resellers are deleted in chunks and every chunk is committed on its own.
+        If a chunk fails, the previous chunks stay deleted.
+
+        Arguments:
+        - **ids**: The IDs of the resellers, or
+        - **filter**: The attributes of the resellers
+        """
+        try:
+            return BulkResult(count=service.bulk_delete(data))
+        except CommitFailed as exception:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=exception.args)
+
     @router.delete("/{id}")
     def delete_by_id(*, service: ServiceProvider, id: int):
         """
@@ -102,4 +196,14 @@ def make_routes(*, session_provider: SessionContextProvider) -> APIRouter:
         except CommitFailed:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Failed to update reseller: {id}.")
 
+    @router.get("/{id}/stats", response_model=ResellerStats)
+    def reseller_stats(*, service: ServiceProvider, id: int):
+        """
+        Returns the number of coupons issued and redeemed by the reseller with the given ID.
+        """
+        try:
+            return service.stats_by_id(id)
+        except NotFound:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Reseller not found: {id}.")
+
     return router
@@ -1,6 +1,10 @@
 from datetime import datetime
+from enum import Enum
+from pydantic import BaseModel
 from sqlmodel import Column, DateTime, Field, SQLModel
 
+from coupon_utils.bulk import BulkFilter, BulkSelection
+
 
 class ResellerBase(SQLModel):
     """
@@ -25,6 +29,14 @@ class ResellerTable(ResellerBase, table=True):
     created_at: datetime | None = Field(
         default_factory=datetime.utcnow, sa_column=Column(DateTime(timezone=True), nullable=False)
     )
+    updated_at: datetime | None = Field(
+        default_factory=datetime.utcnow, sa_column=Column(DateTime(timezone=True), nullable=False)
+    )
+    version: int = Field(default=1, sa_column_kwargs={"server_default": "1"})
+
+    # Maintained incrementally by the coupon service, never computed by scanning the coupons.
+    issued_count: int = Field(default=0, index=True, sa_column_kwargs={"server_default": "0"})
+    redeemed_count: int = Field(default=0, index=True, sa_column_kwargs={"server_default": "0"})
 
 
 class Reseller(ResellerBase):
@@ -37,6 +49,15 @@ class Reseller(ResellerBase):
     created_at: datetime
 
 
+class ResellerBatchItem(BaseModel):
+    """
+    A reseller requested by ID, `reseller` is null if the reseller does not exist.
+    """
+
+    id: int
+    reseller: Reseller | None
+
+
 class ResellerCreate(ResellerBase):
     """
     Reseller creation model.
@@ -57,3 +78,51 @@ class ResellerUpdate(SQLModel):
     """
 
     name: str | None
+
+
+class ResellerFilter(BulkFilter):
+    """
+    Selects resellers by their attributes, the unset attributes match every reseller.
+    """
+
+    name_prefix: str | None = None
+    created_before: datetime | None = None
+    created_after: datetime | None = None
+
+
+class ResellerBulkUpdate(BulkSelection):
+    """
+    Bulk reseller update request model, the resellers are selected by `ids` or `filter`.
+    """
+
+    filter: ResellerFilter | None = None
+    changes: ResellerUpdate
+
+
+class ResellerBulkDelete(BulkSelection):
+    """
+    Bulk reseller delete request model, the resellers are selected by `ids` or `filter`.
+    """
+
+    filter: ResellerFilter | None = None
+
+
+class ResellerStats(BaseModel):
+    """
+    Reseller
+    Issuance statistics.
+    """
+
+    id: int
+    name: str
+    issued: int
+    redeemed: int
+
+
+class ResellerRanking(str, Enum):
+    """
+    Reseller leaderboard ranking enum.
+    """
+
+    issued = "issued"
+    redeemed = "redeemed"
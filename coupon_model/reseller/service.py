@@ -1,10 +1,65 @@
-from sqlmodel import select, Session
+from collections import Counter
+from datetime import datetime
+from typing import Any
 
+from sqlalchemy import bindparam, func, select as sql_select, update
+from sqlmodel import col, select, Session
+
+from coupon_model.coupon.model import CouponArchiveTable, CouponTable
+from coupon_utils.bulk import bulk_write, commit_chunks
+from coupon_utils.db import delete_where, insert_returning, rows_by_keys, update_returning
 from coupon_utils.service import CommitFailed, NotFound
+from coupon_utils.tasks import handler
+from coupon_utils.tracing import trace_methods
+
+from .model import (
+    Reseller,
+    ResellerBatchItem,
+    ResellerBulkDelete,
+    ResellerBulkUpdate,
+    ResellerCreate,
+    ResellerFilter,
+    ResellerRanking,
+    ResellerStats,
+    ResellerTable,
+    ResellerUpdate,
+)
+
+# The task counting a redemption of a coupon of a reseller.
+REDEEMED_TASK = "reseller.redeemed"
+
+
+def increment_counters(session: Session, counter: str, counts: dict[int, int]) -> None:
+    """
+    Increments an issuance counter of the given resellers within the current transaction.
+
+    Arguments:
+        session: The session instance.
+        counter: The counter column, `issued_count` or `redeemed_count`.
+        counts: The increments by reseller ID.
+    """
+    if not counts:
+        return
+    column = getattr(ResellerTable, counter)
+    statement = (
+        update(ResellerTable)
+        .where(ResellerTable.id == bindparam("reseller_id"))
+        .values({counter: column + bindparam("increment")})
+    )
+    session.connection().execute(
+        statement, [{"reseller_id": id, "increment": increment} for id, increment in counts.items()]
+    )
+
 
-from .model import ResellerCreate, ResellerTable, ResellerUpdate
+@handler(REDEEMED_TASK)
+def count_redemptions(session: Session, payloads: list[dict[str, Any]]) -> None:
+    """
+    Counts a batch of redemptions with one increment per reseller, see `REDEEMED_TASK`.
+    """
+    increment_counters(session, "redeemed_count", Counter(payload["reseller_id"] for payload in payloads))
 
 
+@trace_methods
 class ResellerService:
     """
     Reseller-related services.
@@ -33,13 +88,11 @@ class ResellerService:
         """
         session = self._session
 
-        db_item = ResellerTable.from_orm(data)
-        session.add(db_item)
         try:
+            db_item = insert_returning(session, ResellerTable.from_orm(data))
             session.commit()
         except Exception:
             raise CommitFailed("Failed to create the reseller.")
-        session.refresh(db_item)
         return db_item
 
     def delete_by_id(self, id: int) -> None:
@@ -55,16 +108,16 @@ class ResellerService:
         """
         session = self._session
 
-        item = self.get_by_id(id)
-        if item is None:
-            raise NotFound("Reseller not found.")
-
-        session.delete(item)
         try:
+            deleted = delete_where(session, ResellerTable, ResellerTable.id == id)
             session.commit()
         except Exception:
+            session.rollback()
             raise CommitFailed("Failed to delete the reseller.")
 
+        if not deleted:
+            raise NotFound("Reseller not found.")
+
     def get_all(self, offset: int, limit: int) -> list[ResellerTable]:
         """
         Returns all resellers from the database with pagination.
@@ -80,6 +133,22 @@ class ResellerService:
         """
         return self._session.get(ResellerTable, id)
 
+    def get_many(self, ids: list[int]) -> list[ResellerBatchItem]:
+        """
+        Returns the resellers with the given IDs.
+
+        The resellers are resolved with one `IN` query per `IN_CHUNK_SIZE` IDs, as plain rows.
+
+        Arguments:
+            ids: Reseller database IDs.
+
+        Returns:
+            The resellers of the requested IDs, in request order.
+        """
+        rows = rows_by_keys(self._session, ResellerTable, Reseller.__fields__, id=ids)
+        by_id = {row.id: Reseller.from_orm(row) for row in rows}
+        return [ResellerBatchItem(id=id, reseller=by_id.get(id)) for id in ids]
+
     def update(self, id: int, data: ResellerUpdate) -> ResellerTable:
         """
         Update a reseller with the given ID.
@@ -94,19 +163,134 @@ class ResellerService:
         """
         session = self._session
 
-        db_item = self.get_by_id(id)
+        changes = data.dict(exclude_unset=True) | {
+            "updated_at": datetime.utcnow(),
+            "version": ResellerTable.version + 1,
+        }
+        try:
+            db_item = update_returning(session, ResellerTable, id, changes)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise CommitFailed("Failed to update the reseller.")
+
         if db_item is None:
             raise NotFound("Reseller not found.")
 
-        changes = data.dict(exclude_unset=True)
-        for key, value in changes.items():
-            setattr(db_item, key, value)
+        return db_item
+
+    def bulk_update(self, data: ResellerBulkUpdate) -> int:
+        """
+        Updates the resellers selected by IDs or by a filter in chunks, each chunk is committed on its own.
+
+        Arguments:
+            data: The selection and the update data.
+
+        Returns:
+            The number of updated resellers.
+
+        Raises:
+            CommitFailed: If a chunk fails to commit, the previous chunks stay updated.
+        """
+        values = data.changes.dict(exclude_unset=True) | {
+            "updated_at": datetime.utcnow(),
+            "version": ResellerTable.version + 1,
+        }
+        counts = bulk_write(
+            self._session, ResellerTable, ids=data.ids, conditions=self._filter_conditions(data.filter), values=values
+        )
+        return commit_chunks(self._session, counts, "Failed to update the resellers.")
 
-        session.add(db_item)
+    def bulk_delete(self, data: ResellerBulkDelete) -> int:
+        """
+        Deletes the resellers selected by IDs or by a filter in chunks, each chunk is committed on its own.
+
+        Arguments:
+            data: The selection.
+
+        Returns:
+            The number of deleted resellers.
+
+        Raises:
+            CommitFailed: If a chunk fails to commit, the previous chunks stay deleted.
+        """
+        counts = bulk_write(self._session, ResellerTable, ids=data.ids, conditions=self._filter_conditions(data.filter))
+        return commit_chunks(self._session, counts, "Failed to delete the resellers.")
+
+    @staticmethod
+    def _filter_conditions(filter: ResellerFilter | None) -> tuple:
+        """
+        Returns the conditions of the resellers matching the filter.
+        """
+        if filter is None:
+            return ()
+        conditions = []
+        if filter.name_prefix is not None:
+            conditions.append(col(ResellerTable.name).startswith(filter.name_prefix, autoescape=True))
+        if filter.created_before is not None:
+            conditions.append(col(ResellerTable.created_at) < filter.created_before)
+        if filter.created_after is not None:
+            conditions.append(col(ResellerTable.created_at) >= filter.created_after)
+        return tuple(conditions)
+
+    def stats_by_id(self, id: int) -> ResellerStats:
+        """
+        Returns the issuance statistics of the reseller with the given ID.
+
+        Arguments:
+            id: Reseller database ID.
+
+        Raises:
+            NotFound: If the reseller with the given id does not exist.
+        """
+        reseller = self.get_by_id(id)
+        if reseller is None:
+            raise NotFound(f"Reseller: {id}")
+        return self._stats(reseller)
+
+    def top(self, k: int, by: ResellerRanking) -> list[ResellerStats]:
+        """
+        Returns the leading resellers by issued or redeemed coupons using the index of the counter.
+
+        Arguments:
+            k: The number of resellers.
+            by: The ranking counter.
+        """
+        column = ResellerTable.issued_count if by == ResellerRanking.issued else ResellerTable.redeemed_count
+        statement = select(ResellerTable).order_by(column.desc(), ResellerTable.id).limit(k)  # type: ignore
+        return [self._stats(reseller) for reseller in self._session.exec(statement)]
+
+    def recount(self) -> None:
+        """
+        Recomputes the issuance counters of all the resellers from the coupons, archived ones included.
+
+        Only needed after the coupons were written past the coupon service.
+
+        Raises:
+            CommitFailed: If the service fails to commit the counters.
+        """
+        session = self._session
+
+        def counts(table: type[CouponTable] | type[CouponArchiveTable]) -> tuple[Any, Any]:
+            issued = sql_select(func.count()).select_from(table).where(table.reseller_id == ResellerTable.id)
+            redeemed = issued.where(col(table.redeemed_at).is_not(None))
+            return issued.scalar_subquery(), redeemed.scalar_subquery()
+
+        issued, redeemed = counts(CouponTable)
+        archived_issued, archived_redeemed = counts(CouponArchiveTable)
+        session.execute(
+            update(ResellerTable).values(
+                issued_count=issued + archived_issued, redeemed_count=redeemed + archived_redeemed
+            )
+        )
         try:
             session.commit()
         except Exception:
-            raise CommitFailed("Failed to update the reseller.")
+            raise CommitFailed("Failed to recount the reseller counters.")
 
-        session.refresh(db_item)
-        return db_item
+    @staticmethod
+    def _stats(reseller: ResellerTable) -> ResellerStats:
+        # The values are read from the database, so the response model skips validation.
+        return ResellerStats.construct(
+            id=reseller.id, name=reseller.name, issued=reseller.issued_count, redeemed=reseller.redeemed_count
+        )
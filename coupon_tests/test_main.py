@@ -1,16 +1,53 @@
+from itertools import combinations
 import json
 import pytest
-from typing import Callable, Generator
-from datetime import datetime
+import time
+from pathlib import Path
+from typing import Any, Callable, Generator
+from datetime import datetime, timedelta
 
 from fastapi.testclient import TestClient
-from sqlmodel import Session, SQLModel, create_engine
+from sqlalchemy import event, update
+from sqlmodel import select, Session, SQLModel, create_engine
 from sqlmodel.pool import StaticPool
 
-from coupon_app.main import create_app, get_db_session
+from coupon_app.database import create_engines, create_shard_engines, create_slow_query_log, Engines
+from coupon_app.main import create_app, get_db_session, get_task_executor
+from coupon_app.settings import Settings
+from coupon_bench.main import make_codes, seed_coupons
+from coupon_bench.stress import stress_redemptions
 from coupon_app.settings import get_settings
+from coupon_cli.importer import FileFormat, ImportKind, run_import
+from coupon_cli.server import worker_pool_size
 from coupon_model import init_models  # noqa
+from coupon_model.coupon.model import (
+    AvailableCouponTable,
+    Cart,
+    CartItem,
+    CouponArchiveTable,
+    CouponBulkUpdate,
+    CouponCreate,
+    CouponFilter,
+    CouponTable,
+    CouponUpdate,
+    DiscountType,
+)
+from coupon_model.coupon.pricing import best_coupons, Discount, price_carts
+from coupon_model.coupon.service import CouponService
+from coupon_model.coupon.sharding import ShardedCouponService
+from coupon_model.coupon_analytics.service import CouponSnapshot
+from coupon_model.coupon_customer_link.model import CouponCustomerLinkArchiveTable, CouponCustomerLinkTable
 from coupon_model.customer.model import CustomerTable
+from coupon_model.customer.service import CustomerService
+from coupon_model.reseller.model import ResellerCreate, ResellerTable
+from coupon_model.reseller.service import ResellerService
+from coupon_utils.bulk import bulk_write
+from coupon_utils.db import session_engine, supports_returning
+from coupon_utils.service import NotFound, ValidationFailed
+from coupon_utils.sharding import shard_index
+from coupon_utils.slow_queries import normalize, read_log, summarize
+from coupon_utils.tasks import handler, TaskDeadLetterTable, TaskExecutor, TaskTable
+from coupon_utils.tracing import instrument_sqlalchemy, MemoryExporter, tracer
 
 app = create_app()
 client = TestClient(app)
@@ -33,10 +70,26 @@ def client_fixture(session: Session) -> Generator[TestClient, None, None]:
     app = create_app()
 
     app.dependency_overrides[get_db_session] = lambda: session
+    # The tasks run right after their commit, no thread shares the connection of the session.
+    tasks = TaskExecutor(workers=0)
+    app.dependency_overrides[get_task_executor] = lambda: tasks
     yield TestClient(app)
     app.dependency_overrides.clear()
 
 
+@pytest.fixture(name="statements")
+def statements_fixture(session: Session) -> Generator[list[str], None, None]:
+    statements: list[str] = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = session.get_bind()
+    event.listen(engine, "before_cursor_execute", record)
+    yield statements
+    event.remove(engine, "before_cursor_execute", record)
+
+
 @pytest.fixture(name="prefix_url")
 def prefix_url_fixture() -> Callable[[str], str]:
     settings = get_settings()
@@ -151,3 +204,1210 @@ def test_crud_customer(client: TestClient, prefix_url: Callable[[str], str]):
 
     response = client.get(url)
     assert response.status_code == 404
+
+
+def test_import_customers(session: Session, tmp_path: Path):
+    path = tmp_path / "customers.ndjson"
+    rows = [{"username": f"customer{i}", "name": f"Customer {i}"} for i in range(10)] + [{"username": "x", "name": "X"}]
+    # A malformed line is rejected without aborting the import.
+    path.write_text("\n".join(json.dumps(row) for row in rows) + '\n{"username": "broken"\n')
+
+    def import_customers(resume: bool) -> tuple[int, int]:
+        return run_import(
+            session_engine(session),
+            ImportKind.customers,
+            path,
+            file_format=FileFormat.ndjson,
+            chunk_size=4,
+            workers=1,
+            resume=resume,
+            report=lambda message: None,
+        )
+
+    assert import_customers(resume=True) == (10, 2)
+    assert session.query(CustomerTable).count() == 10
+    rejected = [json.loads(line) for line in (tmp_path / "customers.ndjson.rejected.ndjson").read_text().splitlines()]
+    assert rejected[0]["row"]["username"] == "x"
+    assert rejected[1]["line"] == '{"username": "broken"' and rejected[1]["error"].startswith("Malformed JSON")
+    assert not (tmp_path / "customers.ndjson.checkpoint").exists()
+
+    # A failed run resumes after the last committed chunk.
+    (tmp_path / "customers.ndjson.checkpoint").write_text(json.dumps({"rows": 8}))
+    assert import_customers(resume=True) == (2, 2)
+    assert session.query(CustomerTable).count() == 10
+
+
+def test_price_carts(client: TestClient, prefix_url: Callable[[str], str]):
+    now = datetime.utcnow()
+    coupons = [
+        {"code": "FIXED100", "discount": 100, "discount_type": "fixed", "is_active": True},
+        {"code": "PERCENT1", "discount": 10, "discount_type": "percentage", "is_active": True},
+        {"code": "INACTIVE", "discount": 50, "discount_type": "percentage", "is_active": False},
+    ]
+    for coupon in coupons:
+        coupon |= {
+            "description": "Test",
+            "valid_from": (now - timedelta(days=1)).isoformat(),
+            "valid_until": (now + timedelta(days=1)).isoformat(),
+        }
+    response = client.post(prefix_url("/coupons"), json=coupons)
+    assert response.status_code == 201
+
+    carts = [
+        {"items": [{"price": 1000, "quantity": 2}, {"price": 500}], "codes": ["PERCENT1", "FIXED100"]},
+        {"items": [{"price": 50}], "codes": ["FIXED100", "INACTIVE", "UNKNOWN1"]},
+        {"items": [], "codes": []},
+    ]
+    response = client.post(prefix_url("/coupons/price"), json=carts)
+    result = response.json()
+
+    assert response.status_code == 200
+    assert result[0] == {
+        "subtotal": 2500,
+        "discount": 350,
+        "total": 2150,
+        "applied": ["PERCENT1", "FIXED100"],
+        "rejected": [],
+    }
+    assert result[1] == {
+        "subtotal": 50,
+        "discount": 50,
+        "total": 0,
+        "applied": ["FIXED100"],
+        "rejected": ["INACTIVE", "UNKNOWN1"],
+    }
+    assert result[2] == {"subtotal": 0, "discount": 0, "total": 0, "applied": [], "rejected": []}
+
+
+def test_coupon_statuses(client: TestClient, prefix_url: Callable[[str], str]):
+    now = datetime.utcnow()
+    coupons = [
+        {
+            "code": code,
+            "description": "Test",
+            "discount": 10,
+            "discount_type": "fixed",
+            "is_active": True,
+            "valid_from": (now - timedelta(days=1)).isoformat(),
+            "valid_until": valid_until.isoformat(),
+        }
+        for code, valid_until in [("ACTIVE01", now + timedelta(days=1)), ("EXPIRED1", now - timedelta(hours=1))]
+    ]
+    response = client.post(prefix_url("/coupons"), json=coupons)
+    assert response.status_code == 201
+
+    coupon_id = client.get(prefix_url("/coupons")).json()[0]["id"]
+
+    response = client.post(
+        prefix_url("/coupons/status"),
+        json={"ids": [coupon_id, 404], "codes": ["EXPIRED1", "UNKNOWN1", "ACTIVE01"]},
+    )
+    result = response.json()
+
+    assert response.status_code == 200
+    assert [(item["id"], item["code"]) for item in result] == [
+        (coupon_id, "ACTIVE01"),
+        (404, None),
+        (coupon_id + 1, "EXPIRED1"),
+        (None, "UNKNOWN1"),
+        (coupon_id, "ACTIVE01"),
+    ]
+    assert [item["status"] for item in result] == [
+        {"is_active": True, "is_valid": True},
+        None,
+        {"is_active": True, "is_valid": False},
+        None,
+        {"is_active": True, "is_valid": True},
+    ]
+
+
+def test_conditional_get_customer(client: TestClient, prefix_url: Callable[[str], str]):
+    response = client.post(prefix_url("/customers"), json={"username": "testname", "name": "Test Name"})
+    url = prefix_url(f"/customers/{response.json()['id']}")
+
+    response = client.get(url)
+    etag = response.headers["ETag"]
+    assert response.status_code == 200
+    assert "Last-Modified" in response.headers
+
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.content == b""
+
+    response = client.get(prefix_url("/customers"))
+    list_etag = response.headers["ETag"]
+    assert list_etag.startswith("W/")
+    assert client.get(prefix_url("/customers"), headers={"If-None-Match": list_etag}).status_code == 304
+
+    # -- An update changes the validators
+
+    client.patch(url, json={"name": "New Name"})
+
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json()["name"] == "New Name"
+    assert client.get(prefix_url("/customers"), headers={"If-None-Match": list_etag}).status_code == 200
+
+
+def test_sparse_fields(session: Session, client: TestClient, prefix_url: Callable[[str], str]):
+    for username in ("testname1", "testname2"):
+        client.post(prefix_url("/customers"), json={"username": username, "name": "Test Name"})
+    session.expunge_all()
+
+    response = client.get(prefix_url("/customers"), params={"fields": "username"})
+    assert response.status_code == 200
+    assert response.json() == [{"id": 1, "username": "testname1"}, {"id": 2, "username": "testname2"}]
+    assert response.headers["ETag"].startswith("W/")
+    # The rows are not loaded as table model instances.
+    assert len(session.identity_map) == 0
+
+    response = client.get(prefix_url("/customers/2"), params={"fields": "name,created_at"})
+    assert response.json().keys() == {"id", "name", "created_at"}
+    assert response.headers["ETag"] == '"2-1"'
+    assert client.get(prefix_url("/customers/2")).json().keys() == {"id", "username", "name", "created_at"}
+
+    assert client.get(prefix_url("/customers"), params={"fields": "version"}).status_code == 400
+    assert client.get(prefix_url("/coupons"), params={"fields": "code,password"}).status_code == 400
+    assert client.get(prefix_url("/coupons"), params={"fields": "code"}).json() == []
+
+
+def test_multi_get(session: Session, client: TestClient, prefix_url: Callable[[str], str], statements: list[str]):
+    for username in ("testname1", "testname2", "testname3"):
+        client.post(prefix_url("/customers"), json={"username": username, "name": "Test Name"})
+    reseller_id = client.post(prefix_url("/resellers"), json={"name": "Reseller"}).json()["id"]
+    now = datetime.utcnow()
+    coupon = {
+        "code": "MULTI001",
+        "description": "Test",
+        "discount": 10,
+        "discount_type": "fixed",
+        "is_active": True,
+        "valid_from": (now - timedelta(days=1)).isoformat(),
+        "valid_until": (now + timedelta(days=1)).isoformat(),
+    }
+    client.post(prefix_url("/coupons"), json=[coupon])
+
+    statements.clear()
+    response = client.get(prefix_url("/customers/batch"), params={"ids": "3,404,1", "usernames": "nobody,testname2"})
+    assert response.status_code == 200
+    result = response.json()
+    assert [(item["id"], item["username"]) for item in result] == [
+        (3, "testname3"),
+        (404, None),
+        (1, "testname1"),
+        (None, "nobody"),
+        (2, "testname2"),
+    ]
+    assert [item["customer"] and item["customer"]["username"] for item in result] == [
+        "testname3",
+        None,
+        "testname1",
+        None,
+        "testname2",
+    ]
+    # The IDs and the usernames are resolved by one query.
+    assert len([statement for statement in statements if statement.startswith("SELECT")]) == 1
+
+    result = client.get(prefix_url("/resellers/batch"), params={"ids": f"404,{reseller_id}"}).json()
+    assert [(item["id"], item["reseller"] and item["reseller"]["name"]) for item in result] == [
+        (404, None),
+        (reseller_id, "Reseller"),
+    ]
+
+    result = client.get(prefix_url("/coupons/batch"), params={"codes": "MULTI001,UNKNOWN1"}).json()
+    assert [(item["code"], item["coupon"] and item["coupon"]["discount"]) for item in result] == [
+        ("MULTI001", 10),
+        ("UNKNOWN1", None),
+    ]
+
+    assert client.get(prefix_url("/customers/batch")).json() == []
+    assert client.get(prefix_url("/customers/batch"), params={"ids": "1,x"}).status_code == 400
+    too_many = ",".join(map(str, range(1001)))
+    assert client.get(prefix_url("/resellers/batch"), params={"ids": too_many}).status_code == 400
+
+    # Large inputs are resolved by chunks.
+    ids = [3, *range(10_000, 12_500), 1]
+    items = CustomerService(session).get_many(ids, [])
+    assert [item.id for item in items] == ids
+    assert [item.customer is not None for item in items] == [True] + [False] * 2500 + [True]
+
+
+def test_search_customers(client: TestClient, prefix_url: Callable[[str], str]):
+    for username, name in [
+        ("johnd", "John Doe"),
+        ("jane.doe", "Jane Doe"),
+        ("doe-family", "Family Account"),
+        ("smith", "John Smith"),
+    ]:
+        client.post(prefix_url("/customers"), json={"username": username, "name": name})
+
+    response = client.get(prefix_url("/customers/search"), params={"q": "doe", "limit": 2})
+    result = response.json()
+
+    assert response.status_code == 200
+    assert len(result["items"]) == 2
+    assert result["next"] is not None
+
+    response = client.get(prefix_url("/customers/search"), params={"q": "doe", "limit": 2, "after": result["next"]})
+    next_result = response.json()
+
+    assert response.status_code == 200
+    usernames = {item["username"] for item in result["items"] + next_result["items"]}
+    assert usernames == {"johnd", "jane.doe", "doe-family"}
+
+    response = client.get(prefix_url("/customers/search"), params={"q": "jo smi"})
+    assert [item["username"] for item in response.json()["items"]] == ["smith"]
+
+    response = client.get(prefix_url("/customers/search"), params={"q": "doe", "after": "invalid"})
+    assert response.status_code == 400
+
+
+def test_reseller_counters(session: Session, client: TestClient, prefix_url: Callable[[str], str]):
+    resellers = [client.post(prefix_url("/resellers"), json={"name": name}).json() for name in ("First", "Second")]
+
+    now = datetime.utcnow()
+    coupons = [
+        {
+            "code": f"RESELL0{i}",
+            "description": "Test",
+            "discount": 10,
+            "discount_type": "fixed",
+            "is_active": True,
+            "valid_from": (now - timedelta(days=1)).isoformat(),
+            "valid_until": (now + timedelta(days=1)).isoformat(),
+            "reseller_id": resellers[0]["id"] if i < 3 else resellers[1]["id"],
+        }
+        for i in range(5)
+    ]
+    assert client.post(prefix_url("/coupons"), json=coupons).status_code == 201
+    assert client.patch(prefix_url("/coupons/apply/RESELL04")).status_code == 200
+
+    response = client.get(prefix_url(f"/resellers/{resellers[1]['id']}/stats"))
+    assert response.status_code == 200
+    assert response.json() == {"id": resellers[1]["id"], "name": "Second", "issued": 2, "redeemed": 1}
+
+    response = client.get(prefix_url("/resellers/top"), params={"k": 1})
+    assert [item["name"] for item in response.json()] == ["First"]
+    response = client.get(prefix_url("/resellers/top"), params={"by": "redeemed"})
+    assert [(item["name"], item["redeemed"]) for item in response.json()] == [("Second", 1), ("First", 0)]
+    response = client.get(prefix_url("/tasks/metrics"))
+    assert response.json() == {"queued": 0, "stored": 0, "processed": 1, "failed": 0, "dead": 0, "lag_seconds": 0.0}
+
+    # Recounting from the coupons gives the same counters.
+    ResellerService(session).recount()
+    response = client.get(prefix_url("/resellers/top"))
+    assert [(item["issued"], item["redeemed"]) for item in response.json()] == [(3, 0), (2, 1)]
+
+    # Deleted coupons leave the counters, archived coupons stay in them, as they would in a recount.
+    ids = {coupon.code: coupon.id for coupon in session.exec(select(CouponTable)).all()}
+    client.delete(prefix_url(f"/coupons/{ids['RESELL04']}"))
+    client.post(prefix_url("/coupons/bulk-delete"), json={"ids": [ids["RESELL00"]]})
+    client.patch(prefix_url("/coupons/apply/RESELL01"))
+    CouponService(session).archive(datetime.utcnow() + timedelta(seconds=1))
+
+    def counters() -> list[tuple[str, int, int]]:
+        response = client.get(prefix_url("/resellers/top"))
+        return sorted((item["name"], item["issued"], item["redeemed"]) for item in response.json())
+
+    assert counters() == [("First", 2, 1), ("Second", 1, 0)]
+    ResellerService(session).recount()
+    assert counters() == [("First", 2, 1), ("Second", 1, 0)]
+
+    # Upserted coupons count when inserted, and move their count when they move to another reseller.
+    imported = CouponCreate(**{**coupons[0], "code": "IMPORT01"}).dict()
+    CouponService(session).upsert_many([imported])
+    assert counters() == [("First", 3, 1), ("Second", 1, 0)]
+    CouponService(session).upsert_many([imported, {**imported, "code": "RESELL02", "reseller_id": resellers[1]["id"]}])
+    assert counters() == [("First", 2, 1), ("Second", 2, 0)]
+    ResellerService(session).recount()
+    assert counters() == [("First", 2, 1), ("Second", 2, 0)]
+
+
+def test_apply_coupon_by_customer(client: TestClient, prefix_url: Callable[[str], str]):
+    owner, other = [
+        client.post(prefix_url("/customers"), json={"username": username, "name": "Test"}).json()["id"]
+        for username in ("owner", "other")
+    ]
+    now = datetime.utcnow()
+    coupon = {
+        "code": "OWNED001",
+        "description": "Test",
+        "discount": 15,
+        "discount_type": "percentage",
+        "is_active": True,
+        "valid_from": (now - timedelta(days=1)).isoformat(),
+        "valid_until": (now + timedelta(days=1)).isoformat(),
+    }
+    client.post(prefix_url("/coupons"), json=[coupon])
+    coupon_id = client.get(prefix_url("/coupons")).json()[0]["id"]
+    client.post(prefix_url("/coupon-customer-link"), json={"coupon_id": coupon_id, "customer_id": owner})
+
+    url = prefix_url("/coupons/apply/OWNED001")
+    assert client.patch(url, params={"customer_id": other}).status_code == 403
+    assert client.patch(prefix_url("/coupons/apply/UNKNOWN1"), params={"customer_id": owner}).status_code == 404
+
+    response = client.patch(url, params={"customer_id": owner})
+    assert response.status_code == 200
+    assert response.json() == {"discount": 15, "discount_type": "percentage"}
+
+    # A coupon is applied only once.
+    assert client.patch(url, params={"customer_id": owner}).status_code == 403
+    assert client.get(prefix_url(f"/coupons/{coupon_id}/status")).json() == {"is_active": False, "is_valid": True}
+
+
+def test_failed_writes(session: Session, client: TestClient, prefix_url: Callable[[str], str]):
+    customer = client.post(prefix_url("/customers"), json={"username": "failed", "name": "Test"}).json()["id"]
+    now = datetime.utcnow()
+    coupon = {
+        "code": "FAILED01",
+        "description": "Test",
+        "discount": 10,
+        "discount_type": "fixed",
+        "is_active": True,
+        "valid_from": now.isoformat(),
+        "valid_until": (now + timedelta(days=1)).isoformat(),
+    }
+    client.post(prefix_url("/coupons"), json=[coupon])
+    coupon_id = client.get(prefix_url("/coupons")).json()[0]["id"]
+    client.post(prefix_url("/coupon-customer-link"), json={"coupon_id": coupon_id, "customer_id": customer})
+
+    # A constraint violated by an update is a client error, the transaction is rolled back.
+    assert client.patch(prefix_url(f"/coupons/{coupon_id}"), json={"description": None}).status_code == 400
+    assert client.patch(prefix_url(f"/customers/{customer}"), json={"name": None}).status_code == 400
+    assert client.get(prefix_url(f"/coupons/{coupon_id}")).json()["description"] == "Test"
+    assert client.patch(prefix_url("/coupons/0"), json={"discount": 20}).status_code == 404
+
+    # The links of a deleted coupon are deleted with it.
+    assert client.delete(prefix_url(f"/coupons/{coupon_id}")).status_code == 204
+    assert session.exec(select(CouponCustomerLinkTable)).all() == []
+    assert client.delete(prefix_url(f"/coupons/{coupon_id}")).status_code == 404
+
+
+def test_coupon_snapshot(session: Session, client: TestClient, prefix_url: Callable[[str], str]):
+    now = datetime.utcnow()
+    coupons = [
+        {
+            "code": f"SNAPSH{i:02d}",
+            "description": "Test",
+            "discount": 10 * (i + 1),
+            "discount_type": "percentage" if i % 2 else "fixed",
+            "is_active": i < 4,
+            "valid_from": (now - timedelta(days=1)).isoformat(),
+            "valid_until": (now + timedelta(days=3 if i < 2 else 10)).isoformat(),
+        }
+        for i in range(6)
+    ]
+    client.post(prefix_url("/coupons"), json=coupons)
+
+    snapshot = CouponSnapshot()
+    snapshot.refresh(session)
+    assert len(snapshot) == 6
+
+    summary = {item.discount_type: item for item in snapshot.summary(now + timedelta(days=7)).types}
+    assert summary[DiscountType.percentage].dict() == {
+        "discount_type": DiscountType.percentage,
+        "total": 3,
+        "active": 2,
+        "valid": 2,
+        "active_and_valid": 1,
+    }
+
+    # Incremental refresh picks up new and modified coupons.
+    client.patch(prefix_url("/coupons/apply/SNAPSH03"))
+    client.post(prefix_url("/coupons"), json=[coupons[0] | {"code": "SNAPSH99", "discount_type": "percentage"}])
+    snapshot.refresh(session)
+    assert len(snapshot) == 7
+
+    summary = {item.discount_type: item for item in snapshot.summary(now).types}
+    assert (summary[DiscountType.percentage].total, summary[DiscountType.percentage].active) == (4, 2)
+
+    response = client.get(prefix_url("/analytics/coupons/discounts"), params={"active_only": True})
+    result = {item["discount_type"]: item for item in response.json()}
+    assert response.status_code == 200
+    assert result["fixed"] | {"mean": None} == {
+        "discount_type": "fixed",
+        "count": 2,
+        "min": 10,
+        "max": 30,
+        "mean": None,
+        "p50": 30,
+        "p90": 30,
+        "p99": 30,
+    }
+
+    # Validity bounds past 2106, the end of unsigned 32-bit UNIX time, are kept.
+    client.post(prefix_url("/coupons"), json=[coupons[0] | {"code": "SNAPSH98", "valid_until": "2200-01-01T00:00:00"}])
+    snapshot.refresh(session)
+    summary = {item.discount_type: item for item in snapshot.summary(datetime(2150, 1, 1)).types}
+    assert summary[DiscountType.fixed].active_and_valid == 1
+
+
+def test_write_statement_counts(
+    session: Session, client: TestClient, prefix_url: Callable[[str], str], statements: list[str]
+):
+    def count(method: Callable, url: str, **kwargs) -> list[str]:
+        statements.clear()
+        response = method(prefix_url(url), **kwargs)
+        assert response.status_code < 300
+        return [statement.split()[0] for statement in statements]
+
+    # Without RETURNING, SQLite reads an updated row back in the same transaction.
+    updated = ["UPDATE"] if supports_returning(session) else ["UPDATE", "SELECT"]
+
+    reseller = client.post(prefix_url("/resellers"), json={"name": "Test"}).json()
+    assert count(client.patch, f"/resellers/{reseller['id']}", json={"name": "New"}) == updated
+    assert count(client.delete, f"/resellers/{reseller['id']}") == ["DELETE"]
+
+    assert count(client.post, "/customers", json={"username": "testname", "name": "Test"}) == ["INSERT"]
+    customer = client.get(prefix_url("/customers")).json()[0]
+    assert count(client.patch, f"/customers/{customer['id']}", json={"name": "New"}) == updated
+
+    # A primary key lookup is served by the identity map once the item is loaded.
+    session.expire_all()
+    statements.clear()
+    assert CustomerService(session).get_by_id(customer["id"]) is CustomerService(session).get_by_id(customer["id"])
+    assert [statement.split()[0] for statement in statements] == ["SELECT"]
+
+    now = datetime.utcnow()
+    coupon = {
+        "code": "COUNTED1",
+        "description": "Test",
+        "discount": 10,
+        "discount_type": "fixed",
+        "is_active": True,
+        "valid_from": now.isoformat(),
+        "valid_until": (now + timedelta(days=1)).isoformat(),
+    }
+    client.post(prefix_url("/coupons"), json=[coupon])
+    coupon_id = client.get(prefix_url("/coupons")).json()[0]["id"]
+    # Coupon changes are also written to the outbox and to the available coupons of the customers.
+    # The outbox rows are numbered at the commit.
+    assert count(client.patch, f"/coupons/{coupon_id}", json={"discount": 20}) == updated + [
+        "INSERT",
+        "DELETE",
+        "INSERT",
+        "UPDATE",
+    ]
+
+    link = {"coupon_id": coupon_id, "customer_id": customer["id"]}
+    assert count(client.post, "/coupon-customer-link", json=link) == ["INSERT", "DELETE", "INSERT"]
+    assert count(client.delete, f"/coupon-customer-link/{coupon_id}/{customer['id']}") == ["DELETE", "DELETE"]
+
+    # A deleted coupon is counted by reseller first, to decrement their counters.
+    assert count(client.delete, f"/coupons/{coupon_id}") == ["INSERT", "DELETE", "DELETE", "SELECT", "DELETE", "UPDATE"]
+    assert count(client.delete, f"/customers/{customer['id']}") == ["DELETE", "DELETE", "DELETE"]
+    assert client.delete(prefix_url(f"/customers/{customer['id']}")).status_code == 404
+
+
+def test_bulk_coupons(session: Session, client: TestClient, prefix_url: Callable[[str], str]):
+    now = datetime.utcnow()
+    coupons = [
+        {
+            "code": f"BULK{i:04d}",
+            "description": "Test",
+            "discount": 10,
+            "discount_type": "fixed",
+            "is_active": True,
+            "valid_from": (now - timedelta(days=10)).isoformat(),
+            "valid_until": (now + timedelta(days=i - 3)).isoformat(),
+        }
+        for i in range(5)
+    ]
+    client.post(prefix_url("/coupons"), json=coupons)
+
+    response = client.post(prefix_url("/coupons/bulk-delete"), json={"filter": {"valid_until_before": now.isoformat()}})
+    assert response.status_code == 200
+    assert response.json() == {"count": 3}
+
+    ids = [coupon["id"] for coupon in client.get(prefix_url("/coupons")).json()]
+    assert len(ids) == 2
+    response = client.post(
+        prefix_url("/coupons/bulk-update"), json={"ids": ids + [999], "changes": {"is_active": False}}
+    )
+    assert response.json() == {"count": 2}
+    for id in ids:
+        coupon = client.get(prefix_url(f"/coupons/{id}"))
+        assert coupon.json()["is_active"] is False
+        assert coupon.headers["ETag"] == f'"{id}-2"'
+
+    invalid: list[dict[str, Any]] = [
+        {"filter": {}, "ids": ids},
+        {},
+        {"filter": {}},
+        {"filter": {"is_active": None}},
+        {"filter": {"is_active": True, "code": "BULK"}},
+    ]
+    for data in invalid:
+        assert client.post(prefix_url("/coupons/bulk-delete"), json=data).status_code == 422
+
+    for username in ("alpha1", "alpha2", "alpha3", "bravo1"):
+        client.post(prefix_url("/customers"), json={"username": username, "name": "Old"})
+    counts = bulk_write(
+        session,
+        CustomerTable,
+        conditions=(CustomerTable.username.startswith("alpha"),),
+        values={"name": "New"},
+        chunk_size=2,
+    )
+    assert list(counts) == [2, 1]
+    session.commit()
+
+    response = client.post(
+        prefix_url("/customers/bulk-update"), json={"filter": {"username_prefix": "bravo"}, "changes": {"name": "New"}}
+    )
+    assert response.json() == {"count": 1}
+    assert {customer["name"] for customer in client.get(prefix_url("/customers")).json()} == {"New"}
+
+
+def test_concurrent_redemptions(tmp_path: Path):
+    # A file database, so the threads race on their own connections instead of one shared connection.
+    engine = create_engine(f"sqlite:///{tmp_path / 'stress.db'}")
+    SQLModel.metadata.create_all(engine)
+    with engine.connect() as connection:
+        connection.exec_driver_sql("PRAGMA journal_mode=WAL")
+    codes = make_codes(20)
+    seed_coupons(engine, codes)
+
+    report = stress_redemptions(lambda: Session(engine), codes, attempts=4, workers=8)
+    assert report.violations == []
+    assert report.outcomes == {"applied": 20, "unavailable": 60}
+
+
+def test_sqlite_production_mode(tmp_path: Path):
+    engines = create_engines(Settings(database_url=f"sqlite:///{tmp_path / 'production.db'}", sqlite_production=True))
+    assert engines.reader is not None
+    SQLModel.metadata.create_all(engines.writer)
+
+    with engines.reader.connect() as connection:
+
+        def pragma(name: str) -> Any:
+            return connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+
+        assert (pragma("journal_mode"), pragma("synchronous"), pragma("foreign_keys")) == ("wal", 1, 1)
+        assert (pragma("busy_timeout"), pragma("query_only")) == (5000, 1)
+
+    codes = make_codes(20)
+    seed_coupons(engines.writer, codes)
+
+    statements: list[tuple[str, str]] = []
+    for name, engine in zip(("writer", "reader"), engines):
+
+        def record(conn, cursor, statement, parameters, context, executemany, name=name):
+            statements.append((name, statement if statement.startswith("BEGIN") else statement.split()[0]))
+
+        event.listen(engine, "before_cursor_execute", record)
+    with engines.session() as session:
+        service = CouponService(session)
+        assert service.get_by_code(codes[0]) is not None
+        service.apply_by_code(codes[0])
+        coupon = service.get_by_code(codes[0])
+        assert coupon is not None and coupon.redeemed_at is not None
+    # Reads go to the readers, except the reads of a transaction that wrote, which must see its writes.
+    assert statements == [
+        ("reader", "BEGIN"),
+        ("reader", "SELECT"),
+        ("writer", "BEGIN IMMEDIATE"),
+        ("writer", "UPDATE"),
+        ("writer", "SELECT"),
+        ("writer", "INSERT"),
+        ("writer", "DELETE"),
+        ("writer", "UPDATE"),
+        ("reader", "BEGIN"),
+        ("reader", "SELECT"),
+    ]
+
+    report = stress_redemptions(engines.session, codes[1:], attempts=4, workers=8)
+    assert report.violations == []
+    assert report.outcomes == {"applied": 19, "unavailable": 57}
+
+
+def test_sharded_coupons(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    urls: tuple[str, ...] = ()
+    shared = create_engines(Settings(database_url=f"sqlite:///{tmp_path / 'shared.db'}"))
+    SQLModel.metadata.create_all(shared.writer)
+
+    def make_service(count: int) -> ShardedCouponService:
+        nonlocal urls
+        urls = tuple(f"sqlite:///{tmp_path / f'shard{i}.db'}" for i in range(count))
+        shards = create_shard_engines(Settings(coupon_shard_urls=urls))
+        for engines in shards:
+            SQLModel.metadata.create_all(engines.writer)
+        return ShardedCouponService([engines.session for engines in shards], shared.session)
+
+    def shard_codes() -> list[set[str]]:
+        stored = []
+        for engines in create_shard_engines(Settings(coupon_shard_urls=urls)):
+            with engines.session() as session:
+                stored.append(set(session.exec(select(CouponTable.code)).all()))
+        return stored
+
+    def counters(engines: Engines) -> tuple[int, int]:
+        with engines.session() as session:
+            reseller = session.exec(select(ResellerTable).where(ResellerTable.name == "Moving")).one()
+            return reseller.issued_count, reseller.redeemed_count
+
+    # The resellers and the customers are in the shared database.
+    with shared.session() as session:
+        reseller = ResellerTable(name="Moving")
+        customer, other = CustomerTable(username="moving", name="Moving"), CustomerTable(username="other", name="Other")
+        session.add_all([reseller, customer, other])
+        session.commit()
+        reseller_id, customer_id, other_id = reseller.id, customer.id, other.id
+    assert customer_id is not None and other_id is not None
+
+    now = datetime.utcnow()
+    codes = sorted(make_codes(300))
+    # A coupon moving to the new shard, with its reseller and its customer.
+    moving = next(code for code in codes[1:] if shard_index(code, 4) == 3)
+    service = make_service(3)
+    service.create_many(
+        [
+            CouponCreate(
+                code=code,
+                description="Test",
+                discount=10,
+                discount_type=DiscountType.fixed,
+                is_active=True,
+                valid_from=now - timedelta(days=1),
+                valid_until=now + timedelta(days=1),
+                reseller_id=reseller_id if code == moving else None,
+            )
+            for code in codes
+        ]
+    )
+    service.link_customer(moving, customer_id)
+    with pytest.raises(NotFound):
+        service.link_customer(moving, 999)
+
+    stored = shard_codes()
+    assert all(stored) and set.union(*stored) == set(codes)
+    assert all(service.shard_of(code) == i for i, shard in enumerate(stored) for code in shard)
+
+    assert [coupon.code for coupon in service.get_all(10, 20)] == codes[10:30]
+    assert [coupon.code for coupon in service.export()] == codes
+    assert service.apply_by_code(codes[0]).discount == 10
+    coupon = service.get_by_code(codes[0])
+    assert coupon is not None and not coupon.is_active
+    # The coupons are counted in the shared database, the copy of the reseller on the shard is not.
+    shards = create_shard_engines(Settings(coupon_shard_urls=urls))
+    assert counters(shared) == (1, 0) and counters(shards[service.shard_of(moving)]) == (0, 0)
+
+    service = make_service(4)
+    moved = service.rebalance(chunk_size=50)
+    stored = shard_codes()
+    # Only the coupons of the new shard move.
+    assert moved == len(stored[3]) > 0
+    assert sum(map(len, stored)) == len(codes)
+    assert all(service.shard_of(code) == i for i, shard in enumerate(stored) for code in shard)
+    coupon = service.get_by_code(codes[0])
+    assert coupon is not None and not coupon.is_active
+    assert service.rebalance() == 0
+
+    # The links and the customer moved with the coupon, the counters stayed in the shared database.
+    shards = create_shard_engines(Settings(coupon_shard_urls=urls))
+    with shards[3].session() as session:
+        coupon = session.exec(select(CouponTable).where(CouponTable.code == moving)).one()
+        assert [customer.username for customer in coupon.customers] == ["moving"]
+        assert session.exec(select(AvailableCouponTable.code)).all() == [moving]
+    assert counters(shared) == (1, 0) and counters(shards[3]) == (0, 0)
+
+    # Only the linked customer applies the coupon, the redemption is counted in the shared database.
+    with pytest.raises(ValidationFailed):
+        service.apply_by_code(moving, other_id)
+    assert service.apply_by_code(moving, customer_id).discount == 10
+    assert counters(shared) == (1, 1) and counters(shards[3]) == (0, 0)
+
+    # The HTTP API addresses coupons by their per-shard ID, it refuses to start on shards.
+    monkeypatch.setattr("coupon_app.main.get_settings", lambda: Settings(coupon_shard_urls=urls))
+    with pytest.raises(RuntimeError):
+        create_app()
+
+
+def test_coupon_changes(client: TestClient, prefix_url: Callable[[str], str]):
+    now = datetime.utcnow()
+    coupons = [
+        {
+            "code": code,
+            "description": "Test",
+            "discount": 10,
+            "discount_type": "fixed",
+            "is_active": True,
+            "valid_from": (now - timedelta(days=1)).isoformat(),
+            "valid_until": (now + timedelta(days=1)).isoformat(),
+        }
+        for code in ("CHANGE01", "CHANGE02")
+    ]
+    client.post(prefix_url("/coupons"), json=coupons)
+    # A duplicate code is rejected without a change.
+    assert client.post(prefix_url("/coupons"), json=coupons[:1]).status_code == 400
+    ids = {coupon["code"]: coupon["id"] for coupon in client.get(prefix_url("/coupons")).json()}
+    client.patch(prefix_url(f"/coupons/{ids['CHANGE01']}"), json={"discount": 20})
+    client.patch(prefix_url("/coupons/apply/CHANGE01"))
+    client.delete(prefix_url(f"/coupons/{ids['CHANGE02']}"))
+
+    page = client.get(prefix_url("/coupons/changes")).json()
+    assert [(change["code"], change["operation"]) for change in page["items"]] == [
+        ("CHANGE01", "created"),
+        ("CHANGE02", "created"),
+        ("CHANGE01", "updated"),
+        ("CHANGE01", "applied"),
+        ("CHANGE02", "deleted"),
+    ]
+    # The changes carry the current state of the coupons.
+    assert page["items"][0]["coupon"]["discount"] == 20
+    assert page["items"][1]["coupon"] is None
+
+    cursor = page["items"][2]["seq"]
+    page = client.get(prefix_url("/coupons/changes"), params={"after": cursor, "limit": 1}).json()
+    assert [change["operation"] for change in page["items"]] == ["applied"]
+    page = client.get(prefix_url("/coupons/changes"), params={"after": page["next"]}).json()
+    assert [change["operation"] for change in page["items"]] == ["deleted"]
+    assert client.get(prefix_url("/coupons/changes"), params={"after": page["next"], "wait": 0.1}).json() == {
+        "items": [],
+        "next": page["next"],
+    }
+
+    response = client.get(
+        prefix_url("/coupons/changes"), headers={"Accept": "text/event-stream", "Last-Event-ID": str(cursor)}
+    )
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = [event.splitlines() for event in response.text.split("\n\n") if event.startswith("id:")]
+    assert [event[:2] for event in events] == [
+        [f"id: {cursor + 1}", "event: applied"],
+        [f"id: {cursor + 2}", "event: deleted"],
+    ]
+    assert json.loads(events[0][2].removeprefix("data: "))["code"] == "CHANGE01"
+
+
+def test_reserve_coupons(session: Session, client: TestClient, prefix_url: Callable[[str], str]):
+    now = datetime.utcnow()
+    coupons = [
+        {
+            "code": code,
+            "description": "Test",
+            "discount": 10,
+            "discount_type": "fixed",
+            "is_active": True,
+            "valid_from": (now - timedelta(days=1)).isoformat(),
+            "valid_until": (now + timedelta(days=1)).isoformat(),
+        }
+        for code in ("RESERVE1", "RESERVE2")
+    ]
+    client.post(prefix_url("/coupons"), json=coupons)
+
+    reservation = client.patch(prefix_url("/coupons/reserve/RESERVE1")).json()
+    assert reservation["code"] == "RESERVE1" and reservation["discount"] == 10
+    token = reservation["token"]
+
+    # A reserved coupon can be neither applied nor reserved again.
+    assert client.patch(prefix_url("/coupons/apply/RESERVE1")).status_code == 403
+    assert client.patch(prefix_url("/coupons/reserve/RESERVE1")).status_code == 403
+    assert client.patch(prefix_url("/coupons/release/RESERVE1"), params={"token": "other"}).status_code == 403
+    assert client.patch(prefix_url("/coupons/confirm/UNKNOWN1"), params={"token": token}).status_code == 404
+
+    response = client.patch(prefix_url("/coupons/confirm/RESERVE1"), params={"token": token})
+    assert response.json() == {"discount": 10, "discount_type": "fixed"}
+    assert client.patch(prefix_url("/coupons/confirm/RESERVE1"), params={"token": token}).status_code == 403
+
+    # A coupon deactivated while it is reserved cannot be confirmed.
+    token = client.patch(prefix_url("/coupons/reserve/RESERVE2")).json()["token"]
+    coupon_id = session.exec(select(CouponTable.id).where(CouponTable.code == "RESERVE2")).one()
+    client.patch(prefix_url(f"/coupons/{coupon_id}"), json={"is_active": False})
+    assert client.patch(prefix_url("/coupons/confirm/RESERVE2"), params={"token": token}).status_code == 403
+    client.patch(prefix_url(f"/coupons/{coupon_id}"), json={"is_active": True})
+    assert client.patch(prefix_url("/coupons/release/RESERVE2"), params={"token": token}).status_code == 204
+
+    token = client.patch(prefix_url("/coupons/reserve/RESERVE2")).json()["token"]
+    assert client.patch(prefix_url("/coupons/release/RESERVE2"), params={"token": token}).status_code == 204
+    assert client.patch(prefix_url("/coupons/release/RESERVE2"), params={"token": token}).status_code == 403
+
+    # An expired lease can be taken over at once, or cleared by the sweeper.
+    token = client.patch(prefix_url("/coupons/reserve/RESERVE2"), params={"ttl": 0.01}).json()["token"]
+    time.sleep(0.05)
+    assert client.patch(prefix_url("/coupons/confirm/RESERVE2"), params={"token": token}).status_code == 403
+    assert client.patch(prefix_url("/coupons/reserve/RESERVE2"), params={"ttl": 0.01}).status_code == 200
+    time.sleep(0.05)
+    assert CouponService(session).release_expired() == 1
+    assert CouponService(session).release_expired() == 0
+
+    operations = [change["operation"] for change in client.get(prefix_url("/coupons/changes")).json()["items"]]
+    assert operations[2:] == [
+        "reserved",
+        "applied",
+        "reserved",
+        "updated",
+        "updated",
+        "released",
+        "reserved",
+        "released",
+        "reserved",
+        "reserved",
+        "released",
+    ]
+
+
+def test_archive_coupons(session: Session, client: TestClient, prefix_url: Callable[[str], str]):
+    now = datetime.utcnow()
+    customer = CustomerTable(username="archived", name="Archived")
+    session.add(customer)
+    session.commit()
+    coupons = [
+        CouponTable(
+            code=code,
+            description="Test",
+            discount=10,
+            discount_type=DiscountType.fixed,
+            is_active=True,
+            valid_from=now - timedelta(days=60),
+            valid_until=now + timedelta(days=days),
+            customers=[customer],
+        )
+        for code, days in (("EXPIRED1", -40), ("EXPIRED2", -1), ("CURRENT1", 10))
+    ]
+    session.add_all(coupons)
+    session.commit()
+    ids = [coupon.id for coupon in coupons]
+
+    assert CouponService(session).archive(now - timedelta(days=30), chunk_size=1) == 1
+    assert CouponService(session).archive(now - timedelta(days=30)) == 0
+
+    # The archived coupon left the hot tables with its links, but it can still be read.
+    assert session.exec(select(CouponTable.code).order_by(CouponTable.id)).all() == ["EXPIRED2", "CURRENT1"]
+    assert sorted(session.exec(select(CouponCustomerLinkTable.coupon_id)).all()) == ids[1:]
+    assert [link.coupon_id for link in session.exec(select(CouponCustomerLinkArchiveTable)).all()] == ids[:1]
+    response = client.get(prefix_url(f"/coupons/{ids[0]}"))
+    assert response.status_code == 200 and response.json()["code"] == "EXPIRED1"
+    statuses = client.post(prefix_url("/coupons/status"), json={"ids": [ids[0]], "codes": ["EXPIRED1", "UNKNOWN1"]})
+    assert [result["status"] for result in statuses.json()] == [{"is_active": True, "is_valid": False}] * 2 + [None]
+
+    # A redeemed coupon is archived once it was redeemed long enough ago.
+    assert client.patch(prefix_url("/coupons/apply/CURRENT1")).status_code == 200
+    assert CouponService(session).archive(datetime.utcnow() + timedelta(seconds=1)) == 2
+    assert session.exec(select(CouponTable)).all() == []
+
+    operations = [change["operation"] for change in client.get(prefix_url("/coupons/changes")).json()["items"]]
+    assert operations == ["archived", "applied", "archived", "archived"]
+
+    # The IDs of archived coupons are not reused, an archived code is found by ID while its new coupon is found by code.
+    reused = CouponTable(
+        code="EXPIRED1",
+        description="Test",
+        discount=10,
+        discount_type=DiscountType.fixed,
+        is_active=False,
+        valid_from=now - timedelta(days=60),
+        valid_until=now - timedelta(days=40),
+    )
+    session.add(reused)
+    session.commit()
+    assert reused.id is not None and reused.id > max(id for id in ids if id is not None)
+    statuses = client.post(prefix_url("/coupons/status"), json={"ids": [ids[0]], "codes": ["EXPIRED1"]}).json()
+    assert [(result["id"], result["code"]) for result in statuses] == [(ids[0], "EXPIRED1"), (reused.id, "EXPIRED1")]
+
+    # A coupon whose ID is already archived stays in the coupons table instead of failing the archiving.
+    session.execute(update(CouponArchiveTable).where(CouponArchiveTable.id == ids[0]).values(id=reused.id))
+    session.commit()
+    assert CouponService(session).archive(now - timedelta(days=30)) == 0
+    assert session.exec(select(CouponTable.id)).all() == [reused.id]
+
+
+def test_tracing(session: Session, client: TestClient, prefix_url: Callable[[str], str]):
+    exporter = MemoryExporter()
+    tracer.configure(1.0, exporter)
+    instrument_sqlalchemy()
+    try:
+        coupon = {
+            "code": "TRACED01",
+            "description": "Test",
+            "discount": 10,
+            "discount_type": "fixed",
+            "is_active": True,
+            "valid_from": (datetime.utcnow() - timedelta(days=1)).isoformat(),
+            "valid_until": (datetime.utcnow() + timedelta(days=1)).isoformat(),
+        }
+        client.post(prefix_url("/coupons"), json=[coupon])
+        exporter.spans.clear()
+        traceparent = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+        assert client.patch(prefix_url("/coupons/apply/TRACED01"), headers={"traceparent": traceparent}).is_success
+        tracer.configure(0.0, exporter)
+        assert client.patch(prefix_url("/coupons/apply/TRACED01")).status_code == 403
+    finally:
+        tracer.configure(0.0, None)
+
+    spans = {span.name: span for span in exporter.spans}
+    request = spans["PATCH /api/v1/coupons/apply/{code}"]
+    assert request.trace_id == "0af7651916cd43dd8448eb211c80319c" and request.parent_id == "b7ad6b7169203331"
+    assert request.attributes["http.status_code"] == 200 and request.kind == "server"
+
+    apply = spans["CouponService.apply_by_code"]
+    assert apply.parent_id == request.span_id
+    assert {"UPDATE", "INSERT"} <= {span.name for span in exporter.spans if span.parent_id == apply.span_id}
+    assert (
+        spans["session.commit"].error is None and spans["session.transaction"].attributes["db.outcome"] == "committed"
+    )
+    assert {span.trace_id for span in exporter.spans} == {request.trace_id}
+    assert all(span.start <= span.end for span in exporter.spans)
+
+    otlp = request.to_otlp()
+    assert otlp["kind"] == 2 and {"key": "http.status_code", "value": {"intValue": "200"}} in otlp["attributes"]
+
+
+def test_engine_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr("coupon_app.database.ENGINE_CACHE_SIZE", 1)
+    first, second = [Settings(database_url=f"sqlite:///{tmp_path / name}") for name in ("first.db", "second.db")]
+    engines = create_engines(first)
+    pool = engines.writer.pool
+    assert create_engines(first) is engines and engines.writer.pool is pool
+
+    # Evicted engines are disposed, which replaces their pool.
+    create_engines(second)
+    assert engines.writer.pool is not pool and create_engines(first) is not engines
+
+    # The executors and the slow-query logs only depend on their own settings.
+    assert get_task_executor(first) is get_task_executor(second)
+    logged = [settings.copy(update={"slow_query_threshold_ms": 100}) for settings in (first, second)]
+    assert create_slow_query_log(logged[0]) is create_slow_query_log(logged[1]) is not None
+    assert create_slow_query_log(first) is None
+
+
+def test_slow_query_log(tmp_path: Path):
+    settings = Settings(
+        database_url=f"sqlite:///{tmp_path / 'slow.db'}",
+        sqlite_production=True,
+        slow_query_threshold_ms=0,
+        slow_query_log_path=str(tmp_path / "slow.ndjson"),
+        slow_query_explain_interval=0,
+    )
+    engines = create_engines(settings)
+    SQLModel.metadata.create_all(engines.writer)
+    codes = make_codes(5)
+    seed_coupons(engines.writer, codes)
+
+    with engines.session() as session:
+        service = CouponService(session)
+        for code in codes:
+            service.get_by_code(code)
+        service.apply_by_code(codes[0])
+        service.search("Benchmark", 10, None)
+        service.bulk_update(
+            CouponBulkUpdate(
+                filter=CouponFilter(discount_type=DiscountType.fixed), changes=CouponUpdate(is_active=False)
+            )
+        )
+    slow_query_log = create_slow_query_log(settings)
+    assert slow_query_log is not None
+    slow_query_log.flush()
+
+    records = list(read_log(tmp_path / "slow.ndjson"))
+    assert not any(record["statement"].startswith("EXPLAIN") for record in records)
+    summaries = {
+        summary.statement.split()[0] + " " + (summary.services or [""])[0]: summary for summary in summarize(records)
+    }
+    by_code = summaries["SELECT CouponService.get_by_code"]
+    assert by_code.calls == 5 and not by_code.full_scan and "INDEX" in (by_code.plan or "")
+    assert "INDEX" in (summaries["UPDATE CouponService.apply_by_code"].plan or "")
+    assert not summaries["SELECT CouponService.search"].full_scan
+    # Filtering on a column without an index reads the whole table.
+    assert summaries["SELECT CouponService.bulk_update"].full_scan
+    assert (
+        normalize("SELECT 1 WHERE id IN (?, ?,\n ?)")
+        == normalize("SELECT 1 WHERE id IN (?, ?)")
+        == "SELECT 1 WHERE id IN (...)"
+    )
+
+
+def test_worker_pool_size():
+    assert worker_pool_size(100, 8) == 12
+    assert worker_pool_size(8, 8) == 1
+    with pytest.raises(ValueError):
+        worker_pool_size(7, 8)
+
+
+def test_available_coupons(session: Session, client: TestClient, prefix_url: Callable[[str], str]):
+    now = datetime.utcnow()
+    customer = client.post(prefix_url("/customers"), json={"username": "available", "name": "Test"}).json()
+    coupons = [
+        {
+            "code": code,
+            "description": "Test",
+            "discount": 10,
+            "discount_type": "fixed",
+            "is_active": True,
+            "valid_from": (now + timedelta(days=start)).isoformat(),
+            "valid_until": (now + timedelta(days=start + 2)).isoformat(),
+        }
+        for code, start in (("AVAIL001", -1), ("AVAIL002", -1), ("AVAIL003", -1), ("EXPIRED1", -5), ("FUTURE01", 1))
+    ]
+    client.post(prefix_url("/coupons"), json=coupons)
+    ids = {coupon.code: coupon.id for coupon in session.exec(select(CouponTable)).all()}
+    for id in ids.values():
+        client.post(prefix_url("/coupon-customer-link"), json={"coupon_id": id, "customer_id": customer["id"]})
+
+    def available() -> dict[str, int]:
+        response = client.get(prefix_url(f"/customers/{customer['id']}/available-coupons"))
+        return {coupon["code"]: coupon["discount"] for coupon in response.json()}
+
+    assert available() == {"AVAIL001": 10, "AVAIL002": 10, "AVAIL003": 10}
+
+    client.patch(prefix_url(f"/coupons/{ids['AVAIL001']}"), json={"discount": 20})
+    client.post(prefix_url("/coupons/bulk-update"), json={"ids": [ids["AVAIL002"]], "changes": {"is_active": False}})
+    client.patch(prefix_url("/coupons/apply/AVAIL003"))
+    assert available() == {"AVAIL001": 20}
+
+    client.delete(prefix_url(f"/coupon-customer-link/{ids['AVAIL001']}/{customer['id']}"))
+    assert available() == {}
+    assert client.get(prefix_url("/customers/0/available-coupons")).json() == []
+
+    # Links written around the services are picked up by a rebuild.
+    session.add(CouponCustomerLinkTable(coupon_id=ids["AVAIL001"], customer_id=customer["id"]))
+    session.commit()
+    CouponService(session).rebuild_available()
+    assert available() == {"AVAIL001": 20}
+
+    # A deleted customer leaves neither links nor available coupons.
+    other = client.post(prefix_url("/customers"), json={"username": "deleted", "name": "Test"}).json()
+    client.post(prefix_url("/coupon-customer-link"), json={"coupon_id": ids["AVAIL001"], "customer_id": other["id"]})
+    assert client.delete(prefix_url(f"/customers/{customer['id']}")).status_code == 204
+    client.post(prefix_url("/customers/bulk-delete"), json={"ids": [other["id"]]})
+    assert session.exec(select(CouponCustomerLinkTable)).all() == []
+    assert session.exec(select(AvailableCouponTable)).all() == []
+
+
+def test_best_coupons():
+    now = datetime.utcnow()
+    valid = (now - timedelta(days=1), now + timedelta(days=1))
+    discounts = [
+        Discount("PERCENT1", 10, DiscountType.percentage, True, *valid),
+        Discount("PERCENT2", 50, DiscountType.percentage, True, *valid),
+        Discount("FIXED001", 30, DiscountType.fixed, True, *valid),
+        Discount("FIXED002", 45, DiscountType.fixed, True, *valid),
+        Discount("FIXED003", 5, DiscountType.fixed, True, *valid),
+        Discount("EXPIRED1", 90, DiscountType.percentage, True, now - timedelta(days=2), now - timedelta(days=1)),
+    ]
+    assert best_coupons(100, discounts, 1).codes == ["PERCENT2"]
+    assert best_coupons(40, discounts, 1).codes == ["FIXED002"]
+    best = best_coupons(100, discounts, 2)
+    assert (best.codes, best.discount, best.total) == (["PERCENT2", "FIXED002"], 95, 5)
+    # The fewest coupons reaching the best total are chosen.
+    assert best_coupons(100, discounts, 10).codes == ["PERCENT2", "FIXED002", "FIXED001"]
+    assert best_coupons(70, discounts, 10).codes == ["FIXED002", "FIXED001"]
+    assert best_coupons(100, [], 3).codes == []
+
+    # The choice is priced like a cart with its codes.
+    cart = Cart(items=[CartItem(price=100)], codes=best.codes)
+    price = price_carts([cart], {discount.code: discount for discount in discounts}, now)[0]
+    assert (price.discount, price.total) == (best.discount, best.total)
+
+    # The choice is as good as the best combination.
+    by_code = {discount.code: discount for discount in discounts}
+    for max_coupons in (1, 2, 3):
+        for subtotal in (10, 60, 100, 1000):
+            best = best_coupons(subtotal, discounts, max_coupons)
+            cart_prices = price_carts(
+                [
+                    Cart(items=[CartItem(price=subtotal)], codes=list(codes))
+                    for count in range(max_coupons + 1)
+                    for codes in combinations(by_code, count)
+                ],
+                by_code,
+                now,
+            )
+            assert best.total == min(price.total for price in cart_prices)
+
+
+def test_best_coupon_api(session: Session, client: TestClient, prefix_url: Callable[[str], str]):
+    now = datetime.utcnow()
+    customer = client.post(prefix_url("/customers"), json={"username": "bestcoupon", "name": "Test"}).json()
+    coupons = [
+        {
+            "code": code,
+            "description": "Test",
+            "discount": discount,
+            "discount_type": discount_type,
+            "is_active": True,
+            "valid_from": (now - timedelta(days=1)).isoformat(),
+            "valid_until": (now + timedelta(days=1)).isoformat(),
+        }
+        for code, discount, discount_type in (("BEST0001", 20, "percentage"), ("BEST0002", 15, "fixed"))
+    ]
+    client.post(prefix_url("/coupons"), json=coupons)
+    for coupon in session.exec(select(CouponTable)).all():
+        client.post(prefix_url("/coupon-customer-link"), json={"coupon_id": coupon.id, "customer_id": customer["id"]})
+
+    url = prefix_url(f"/customers/{customer['id']}/best-coupon")
+    assert client.post(url, json={"subtotal": 50}).json() == {
+        "codes": ["BEST0002"],
+        "subtotal": 50,
+        "discount": 15,
+        "total": 35,
+    }
+    assert client.post(url, json={"subtotal": 50, "max_coupons": 2}).json()["codes"] == ["BEST0001", "BEST0002"]
+    assert client.post(url, json={"subtotal": -1}).status_code == 422
+
+
+def test_background_tasks(tmp_path: Path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'tasks.db'}", connect_args={"check_same_thread": False})
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        reseller_id = ResellerService(session).create(ResellerCreate(name="Reseller")).id
+    codes = make_codes(30)
+    seed_coupons(engine, codes, reseller_id)
+
+    executor = TaskExecutor(workers=2, batch_size=8, poll_interval=3600)
+    for code in codes:
+        with Session(engine) as session:
+            CouponService(session, executor).apply_by_code(code)
+    executor.flush()
+    with Session(engine) as session:
+        reseller = session.get(ResellerTable, reseller_id)
+        assert reseller is not None and reseller.redeemed_count == 30
+    metrics = executor.metrics(engine)
+    assert (metrics.queued, metrics.stored, metrics.processed, metrics.failed) == (0, 0, 30, 0)
+    executor.stop()
+
+    # -- A failed task is stored and run again from the table
+
+    calls = []
+
+    @handler("test.flaky")
+    def flaky(session: Session, payloads: list[dict]) -> None:
+        calls.append(payloads)
+        if len(calls) == 1:
+            raise RuntimeError("Unavailable")
+
+    executor = TaskExecutor(workers=0)
+    executor.submit(engine, "test.flaky", {"value": 1})
+    metrics = executor.metrics(engine)
+    assert (metrics.stored, metrics.failed) == (1, 1)
+    assert metrics.lag_seconds >= 0
+    assert executor.drain(engine) == 1
+    assert calls == [[{"value": 1}], [{"value": 1}]]
+    assert executor.metrics(engine).stored == 0
+
+    # -- A failing or unknown task does not block the others, and is given up after its last attempt
+
+    @handler("test.broken")
+    def broken(session: Session, payloads: list[dict]) -> None:
+        session.add(ResellerTable(name="Rolled back"))
+        session.flush()
+        raise RuntimeError("Broken")
+
+    executor = TaskExecutor(workers=0, max_attempts=2)
+    for name in ("test.broken", "test.unknown", "test.flaky"):
+        executor.submit(engine, name, {"value": 2})
+    assert calls[-1] == [{"value": 2}]
+    with Session(engine) as session:
+        stored = session.exec(select(TaskTable.name, TaskTable.attempts).order_by(TaskTable.id)).all()
+        assert stored == [("test.broken", 1), ("test.unknown", 1)]
+        assert session.exec(select(TaskTable.last_error).where(TaskTable.name == "test.broken")).one() == (
+            "RuntimeError('Broken')"
+        )
+    assert executor.drain(engine) == 0
+    with Session(engine) as session:
+        assert session.exec(select(ResellerTable).where(ResellerTable.name == "Rolled back")).all() == []
+        dead = session.exec(select(TaskDeadLetterTable.name, TaskDeadLetterTable.attempts)).all()
+        assert sorted(dead) == [("test.broken", 2), ("test.unknown", 2)]
+    metrics = executor.metrics(engine)
+    assert (metrics.stored, metrics.dead, metrics.processed, metrics.failed) == (0, 2, 1, 4)
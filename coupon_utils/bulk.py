@@ -0,0 +1,140 @@
+from typing import Any, Callable, Iterator
+
+from pydantic import BaseModel, Extra, root_validator
+from sqlalchemy import delete, update
+from sqlmodel import select, Session, SQLModel
+
+from coupon_utils.db import chunked, execute_dml, IN_CHUNK_SIZE
+from coupon_utils.service import CommitFailed
+
+# The maximum number of IDs of a bulk request.
+MAX_BULK_IDS = 10_000
+
+
+class BulkFilter(BaseModel):
+    """
+    Selects the items of a bulk operation by their attributes, unknown attributes are rejected.
+    """
+
+    class Config:
+        extra = Extra.forbid
+
+
+class BulkSelection(BaseModel):
+    """
+    Selects the items of a bulk operation either by ID or by a filter.
+
+    Subclasses declare the `filter` field with the filter model of their items. A filter must set at least one
+    attribute, so a bulk operation never selects every item by accident.
+    """
+
+    ids: list[int] | None = None
+    filter: BulkFilter | None = None
+
+    @root_validator(skip_on_failure=True)
+    def check_selection(cls, values):
+        if (values.get("ids") is None) == (values.get("filter") is None):
+            raise ValueError("Exactly one of ids and filter must be given.")
+        if values.get("ids") is not None and len(values["ids"]) > MAX_BULK_IDS:
+            raise ValueError(f"At most {MAX_BULK_IDS} ids can be given at once.")
+        if values.get("filter") is not None and not values["filter"].dict(exclude_none=True):
+            raise ValueError("The filter must set at least one attribute.")
+        return values
+
+
+class BulkResult(BaseModel):
+    """
+    The number of items changed by a bulk operation.
+    """
+
+    count: int
+
+
+def bulk_write(
+    session: Session,
+    model: type[SQLModel],
+    *,
+    ids: list[int] | None = None,
+    conditions: tuple = (),
+    values: dict[str, Any] | None = None,
+    chunk_size: int = IN_CHUNK_SIZE,
+    before_write: Callable[[tuple], None] | None = None,
+    after_write: Callable[[list[int]], None] | None = None,
+) -> Iterator[int]:
+    """
+    Updates or deletes the selected rows with one set-based statement per chunk of IDs.
+
+    Rows selected by conditions are walked in ID order with a keyset (`id > last`), so no chunk rescans the rows
+    already processed. The conditions are checked again by the writing statement, so a row changed since its
+    selection is skipped. The session is not committed: the caller commits after each chunk, so every chunk is a
+    short transaction.
+
+    Arguments:
+        session: The session instance.
+        model: The table model, it must have an integer `id` primary key.
+        ids: The IDs of the rows, or `None` to select the rows by the conditions.
+        conditions: The conditions the rows must match.
+        values: Column values or expressions to set, or `None` to delete the rows.
+        chunk_size: The maximum number of rows of a statement.
+        before_write: Called with the conditions of the rows of each chunk before writing them, in the same
+            transaction.
+        after_write: Called with the IDs of each chunk after writing them, in the same transaction.
+
+    Returns:
+        The number of rows changed by each chunk.
+    """
+    table = model.__table__  # type: ignore
+
+    def write(chunk: list[int]) -> int:
+        where = (table.c.id.in_(chunk), *conditions)
+        if before_write is not None:
+            before_write(where)
+        statement = delete(table) if values is None else update(table).values(values)
+        count = execute_dml(session, statement.where(*where)).rowcount
+        if after_write is not None:
+            after_write(chunk)
+        return count
+
+    if ids is not None:
+        for chunk in chunked(sorted(set(ids)), chunk_size):
+            yield write(chunk)
+        return
+
+    last_id = None
+    while True:
+        statement = select(table.c.id).where(*conditions).order_by(table.c.id).limit(chunk_size)
+        if last_id is not None:
+            statement = statement.where(table.c.id > last_id)
+        chunk = session.execute(statement).scalars().all()
+        if not chunk:
+            return
+        yield write(chunk)
+        if len(chunk) < chunk_size:
+            return
+        last_id = chunk[-1]
+
+
+def commit_chunks(session: Session, counts: Iterator[int], error: str) -> int:
+    """
+    Commits the session after each chunk of a bulk operation.
+
+    Arguments:
+        session: The session instance.
+        counts: The number of rows changed by each chunk, see `bulk_write()`.
+        error: The message of the raised exception if a chunk fails.
+
+    Returns:
+        The total number of changed rows.
+
+    Raises:
+        CommitFailed: If a chunk fails, the previous chunks stay committed.
+    """
+    count = 0
+    try:
+        for chunk_count in counts:
+            session.commit()
+            count += chunk_count
+    except Exception:
+        session.rollback()
+        raise CommitFailed(f"{error} Changed before the failure: {count}.")
+    return count
@@ -0,0 +1,223 @@
+from itertools import islice, zip_longest
+from typing import Any, cast, Iterable, Iterator, TypeVar
+
+from sqlalchemy import bindparam, delete, insert, or_, update
+from sqlalchemy.sql import Executable
+from sqlalchemy.engine import CursorResult, Engine, Row
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine.default import DefaultDialect
+from sqlmodel import select, Session, SQLModel
+
+T = TypeVar("T")
+TableModel = TypeVar("TableModel", bound=SQLModel)
+
+# The maximum number of bound parameters of an `IN` clause in one statement.
+IN_CHUNK_SIZE = 1000
+
+
+def chunked(iterable: Iterable[T], size: int) -> Iterator[list[T]]:
+    """
+    Splits an iterable into lists of at most `size` items without materializing it.
+
+    Arguments:
+        iterable: The items to split.
+        size: The maximum size of a chunk.
+    """
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def lookup(model: type[TableModel], *columns: str):
+    """
+    Builds a statement selecting the items by the given columns, compared to parameters of the same name.
+
+    Build it once and execute it with the parameter values: a reused statement skips the construction and the
+    cache key generation, SQLAlchemy finds its compiled form in the statement cache right away. Look up primary keys
+    with `Session.get()` instead, it returns an item already in the identity map without a query.
+
+    Arguments:
+        model: The table model.
+        columns: The names of the looked up columns.
+    """
+    return select(model).where(*(getattr(model, column) == bindparam(column) for column in columns))
+
+
+def projection(model: type[SQLModel], fields: Iterable[str]):
+    """
+    Builds a statement selecting the given columns of the items, loaded as plain rows.
+
+    A row is a named tuple without ORM state: it is neither added to the identity map nor tracked for changes, so
+    rows serialized right away by a read-only endpoint are much cheaper to load than table model instances.
+
+    Arguments:
+        model: The table model.
+        fields: The names of the selected columns.
+    """
+    table = model.__table__  # type: ignore
+    return select(*(table.c[field] for field in fields))
+
+
+def rows_by_keys(session: Session, model: type[SQLModel], fields: Iterable[str], **keys: Iterable) -> list[Row]:
+    """
+    Returns the rows matching any of the given values of their key columns, as plain rows of `projection()`.
+
+    Every chunk of `IN_CHUNK_SIZE` values of each key is resolved by one `IN` query, the chunks of the keys are combined
+    with `OR`. The rows are in primary key order within a chunk.
+
+    Arguments:
+        session: The session instance.
+        model: The table model.
+        fields: The names of the selected columns.
+        keys: The values of each key column, e.g. `id=[1, 2]`.
+    """
+    table = model.__table__  # type: ignore
+    statement = projection(model, fields).order_by(*table.primary_key.columns)
+    rows = []
+    for chunks in zip_longest(*(chunked(set(values), IN_CHUNK_SIZE) for values in keys.values())):
+        conditions = [table.c[name].in_(chunk) for name, chunk in zip(keys, chunks) if chunk]
+        rows.extend(session.execute(statement.where(or_(*conditions))).all())
+    return rows
+
+
+def session_engine(session: Session) -> Engine:
+    """
+    Returns the engine of the session, also when the session is bound to a connection.
+
+    Arguments:
+        session: The session instance.
+    """
+    bind = session.get_bind()
+    return bind if isinstance(bind, Engine) else bind.engine
+
+
+def execute_dml(session: Session, statement: Executable) -> CursorResult:
+    """
+    Executes an `INSERT`, `UPDATE` or `DELETE` statement and returns its cursor result, which has the row count.
+
+    Arguments:
+        session: The session instance.
+        statement: The executed statement.
+    """
+    return cast(CursorResult, session.execute(statement))
+
+
+def supports_returning(session: Session) -> bool:
+    """
+    Whether `UPDATE ... RETURNING` and `DELETE ... RETURNING` can be used with the database of the session.
+
+    SQLAlchemy 1.4 supports them on PostgreSQL but not on SQLite.
+    """
+    dialect = session.get_bind().dialect
+    return isinstance(dialect, DefaultDialect) and dialect.full_returning
+
+
+def upsert(
+    session: Session,
+    table: type[SQLModel],
+    rows: list[dict[str, Any]],
+    *,
+    index_elements: list[str],
+    exclude_from_update: tuple[str, ...] = (),
+    update_values: dict[str, Any] | None = None,
+) -> None:
+    """
+    Inserts the rows or updates the existing ones in one statement (`INSERT ... ON CONFLICT DO UPDATE`).
+
+    Only PostgreSQL and SQLite are supported. The session is not committed.
+
+    Arguments:
+        session: The session instance.
+        table: The table model.
+        rows: Column values of the rows.
+        index_elements: The columns of the unique index that identifies a row.
+        exclude_from_update: Columns that keep their value when the row already exists.
+        update_values: Additional values or expressions to set when the row already exists.
+    """
+    if not rows:
+        return
+
+    dialect_name = session.get_bind().dialect.name
+    if dialect_name == "postgresql":
+        statement = postgresql.insert(table)
+    elif dialect_name == "sqlite":
+        statement = sqlite.insert(table)
+    else:
+        raise NotImplementedError(f"Upsert is not supported by this dialect: {dialect_name}.")
+
+    # A statement must not touch the same row twice, so the last occurrence of a key wins.
+    rows = list({tuple(row[column] for column in index_elements): row for row in rows}.values())
+
+    excluded = set(index_elements).union(exclude_from_update)
+    columns = [column for column in rows[0] if column not in excluded]
+    statement = statement.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={column: statement.excluded[column] for column in columns} | (update_values or {}),
+    )
+    session.execute(statement, rows)
+
+
+def insert_returning(session: Session, item: TableModel) -> TableModel:
+    """
+    Inserts the item with one statement and returns it as stored, without a refresh query.
+
+    The item is not added to the session and the session is not committed.
+
+    Arguments:
+        session: The session instance.
+        item: A new, transient table model instance.
+    """
+    model = type(item)
+    table = model.__table__  # type: ignore
+    values = {column.name: getattr(item, column.name) for column in table.columns}
+    statement = insert(table).values({name: value for name, value in values.items() if value is not None})
+
+    if supports_returning(session):
+        return model(**session.execute(statement.returning(*table.columns)).one()._mapping)
+
+    result = execute_dml(session, statement)
+    primary_key = dict(zip((column.name for column in table.primary_key), result.inserted_primary_key))
+    return model(**(values | primary_key))
+
+
+def update_returning(session: Session, model: type[TableModel], id: int, values: dict[str, Any]) -> TableModel | None:
+    """
+    Updates the item with the given ID with one statement and returns it as stored.
+
+    On SQLite, where SQLAlchemy 1.4 cannot compile `RETURNING`, an updated item is read back in the same transaction.
+    The session is not committed.
+
+    Arguments:
+        session: The session instance.
+        model: The table model, it must have an `id` primary key.
+        id: The database ID of the item.
+        values: Column values or expressions to set.
+
+    Returns:
+        The updated item, or `None` if the item does not exist.
+    """
+    table = model.__table__  # type: ignore
+    statement = update(table).where(table.c.id == id).values(values)
+
+    if supports_returning(session):
+        row = session.execute(statement.returning(*table.columns)).first()
+    elif execute_dml(session, statement).rowcount:
+        row = session.execute(select(table).where(table.c.id == id)).first()
+    else:
+        row = None
+    return None if row is None else model(**row._mapping)
+
+
+def delete_where(session: Session, model: type[SQLModel], *conditions) -> int:
+    """
+    Deletes the matching rows with one statement. The session is not committed.
+
+    Arguments:
+        session: The session instance.
+        model: The table model.
+        conditions: The conditions of the deleted rows.
+
+    Returns:
+        The number of deleted rows.
+    """
+    return execute_dml(session, delete(model.__table__).where(*conditions)).rowcount  # type: ignore
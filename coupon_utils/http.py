@@ -0,0 +1,164 @@
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from hashlib import blake2b
+from typing import Any, Callable, Iterable, Mapping, TypeVar
+
+from fastapi import HTTPException, Response, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+T = TypeVar("T")
+
+# The maximum number of keys of a multi-get request, they must fit in the request line.
+MAX_BATCH_KEYS = 1000
+
+# The columns read with any sparse fieldset, for the validators of the response.
+VALIDATOR_FIELDS = ("version", "updated_at")
+
+
+def entity_tag(id: int | None, version: int) -> str:
+    """
+    Returns the strong entity tag of a versioned item.
+
+    Arguments:
+        id: Database ID of the item.
+        version: Version counter of the item.
+    """
+    return f'"{id}-{version}"'
+
+
+def weak_list_tag(items: Iterable[tuple[int | None, int]]) -> str:
+    """
+    Returns a weak entity tag of a list of versioned items.
+
+    Arguments:
+        items: Database ID and version counter pairs of the listed items.
+    """
+    digest = blake2b(digest_size=16)
+    for id, version in items:
+        digest.update(f"{id}-{version};".encode())
+    return f'W/"{digest.hexdigest()}"'
+
+
+def http_date(value: datetime) -> str:
+    """
+    Formats a datetime as an HTTP date. Naive datetimes are treated as UTC.
+    """
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return format_datetime(value.astimezone(timezone.utc), usegmt=True)
+
+
+def matches(if_none_match: str | None, etag: str) -> bool:
+    """
+    Whether an `If-None-Match` header matches the entity tag with the weak comparison.
+    """
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque_tag = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque_tag for tag in if_none_match.split(","))
+
+
+def conditional_response(
+    response: Response, etag: str, last_modified: datetime | None, if_none_match: str | None
+) -> Response | None:
+    """
+    Sets the validators of a read response.
+
+    Arguments:
+        response: The response of the route.
+        etag: The entity tag of the current representation.
+        last_modified: The last modification time of the current representation.
+        if_none_match: The `If-None-Match` request header.
+
+    Returns:
+        A `304 Not Modified` response to return instead of the item if the client has the current representation.
+    """
+    headers = {"ETag": etag}
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+
+    if matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    response.headers.update(headers)
+    return None
+
+
+def sparse_fields(fields: str | None, model: type[BaseModel], required: tuple[str, ...] = ("id",)) -> list[str]:
+    """
+    Returns the fields of a sparse fieldset, given as the `fields` query parameter of a read endpoint.
+
+    Arguments:
+        fields: Comma-separated field names, or `None` for all the fields of the model.
+        model: The API model of the items.
+        required: The fields always returned.
+
+    Raises:
+        ValueError: If a field is not a field of the model.
+    """
+    if fields is None:
+        return list(model.__fields__)
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in model.__fields__]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}.")
+    return list(dict.fromkeys([*required, *names]))
+
+
+def select_fields(fields: str | None, model: type[BaseModel]) -> list[str]:
+    """
+    Returns the fields of the sparse fieldset of a read request, see `sparse_fields()`.
+
+    Arguments:
+        fields: Comma-separated field names, or `None` for all the fields of the model.
+        model: The API model of the items.
+
+    Raises:
+        HTTPException: If a field is not a field of the model.
+    """
+    try:
+        return sparse_fields(fields, model)
+    except ValueError as exception:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=exception.args)
+
+
+def row_fields(row: Any, fields: Iterable[str]) -> dict[str, Any]:
+    """
+    Returns the given fields of a plain row, see `projection()`.
+    """
+    mapping: Mapping[str, Any] = row._mapping
+    return {field: mapping[field] for field in fields}
+
+
+def json_response(response: Response, content: Any) -> JSONResponse:
+    """
+    Returns the content as JSON, without the response model validation, with the headers of the route response.
+
+    Arguments:
+        response: The response of the route, e.g. with the validators set by `conditional_response()`.
+        content: Plain data, e.g. rows converted by `row_fields()`.
+    """
+    return JSONResponse(jsonable_encoder(content), headers=dict(response.headers))
+
+
+def split_keys(value: str | None, convert: Callable[[str], T]) -> list[T]:
+    """
+    Returns the keys of a comma-separated query parameter, e.g. the IDs of a multi-get request, in request order.
+
+    Arguments:
+        value: The query parameter, `None` if it is missing.
+        convert: Converts a key, e.g. `int`.
+
+    Raises:
+        ValueError: If a key cannot be converted, or there are more than `MAX_BATCH_KEYS` keys.
+    """
+    if not value:
+        return []
+    keys = [convert(key.strip()) for key in value.split(",")]
+    if len(keys) > MAX_BATCH_KEYS:
+        raise ValueError(f"At most {MAX_BATCH_KEYS} keys can be given at once.")
+    return keys
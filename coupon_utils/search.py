@@ -0,0 +1,161 @@
+import re
+from typing import Generic, TypeVar
+
+from sqlalchemy import cast, column, DDL, Float, event, func, literal_column, or_, select, table, tuple_
+from sqlmodel import Session, SQLModel
+
+from coupon_utils.service import ValidationFailed
+
+TableModel = TypeVar("TableModel", bound=SQLModel)
+
+
+class SearchIndex(Generic[TableModel]):
+    """
+    Ranked text search over some columns of a table.
+
+    On SQLite the columns are indexed by an external content FTS5 virtual table maintained by triggers,
+    on PostgreSQL by trigram GIN indexes (`pg_trgm`) and lowercase `text_pattern_ops` B-tree indexes for prefix
+    matches. The indexes are created with the table. Every word of the search text must match, case-insensitively.
+
+    Results are ordered by a score (lower is better) and the ID, pages are continued with an opaque keyset cursor.
+    """
+
+    __slots__ = "_model", "_table_name", "_fts_name", "_columns", "_trigram_columns", "_prefix_columns"
+
+    def __init__(
+        self, model: type[TableModel], *, trigram_columns: tuple[str, ...], prefix_columns: tuple[str, ...] = ()
+    ) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            model: The table model, it must have an integer `id` primary key.
+            trigram_columns: Columns matched by substrings and ranked by similarity.
+            prefix_columns: Columns matched by prefixes.
+        """
+        self._model = model
+        self._table_name: str = model.__tablename__  # type: ignore
+        self._fts_name = f"{self._table_name}_fts"
+        self._columns = trigram_columns + prefix_columns
+        self._trigram_columns = trigram_columns
+        self._prefix_columns = prefix_columns
+
+        sa_table = model.__table__  # type: ignore
+        for statement in self._sqlite_ddl():
+            event.listen(sa_table, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+        event.listen(
+            sa_table, "before_drop", DDL(f"DROP TABLE IF EXISTS {self._fts_name}").execute_if(dialect="sqlite")
+        )
+        for statement in self._postgresql_ddl():
+            event.listen(sa_table, "after_create", DDL(statement).execute_if(dialect="postgresql"))
+
+    def _sqlite_ddl(self) -> list[str]:
+        """
+        Returns the statements creating the FTS5 table and the triggers keeping it in sync.
+        """
+        name, fts, columns = self._table_name, self._fts_name, ", ".join(self._columns)
+        new_values = ", ".join(f"new.{column}" for column in self._columns)
+        old_values = ", ".join(f"old.{column}" for column in self._columns)
+        insert = f"INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {new_values});"
+        delete = f"INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ('delete', old.id, {old_values});"
+        return [
+            f"CREATE VIRTUAL TABLE {fts} USING fts5({columns}, content='{name}', content_rowid='id')",
+            f"CREATE TRIGGER {fts}_ai AFTER INSERT ON {name} BEGIN {insert} END",
+            f"CREATE TRIGGER {fts}_ad AFTER DELETE ON {name} BEGIN {delete} END",
+            f"CREATE TRIGGER {fts}_au AFTER UPDATE OF {columns} ON {name} BEGIN {delete} {insert} END",
+        ]
+
+    def _postgresql_ddl(self) -> list[str]:
+        """
+        Returns the statements creating the trigram and prefix indexes.
+        """
+        name = self._table_name
+        return (
+            ["CREATE EXTENSION IF NOT EXISTS pg_trgm"]
+            + [
+                f"CREATE INDEX ix_{name}_{column}_trgm ON {name} USING gin ({column} gin_trgm_ops)"
+                for column in self._trigram_columns
+            ]
+            + [
+                f"CREATE INDEX ix_{name}_{column}_prefix ON {name} (lower({column}) text_pattern_ops)"
+                for column in self._prefix_columns
+            ]
+        )
+
+    def search(self, session: Session, q: str, limit: int, after: str | None) -> tuple[list[TableModel], str | None]:
+        """
+        Returns a page of the best matching items.
+
+        Arguments:
+            session: The session instance.
+            q: The search text.
+            limit: The maximum number of items.
+            after: The cursor returned with the previous page.
+
+        Returns:
+            The items and the cursor of the next page if there may be more items.
+
+        Raises:
+            ValidationFailed: If the cursor is malformed.
+        """
+        model = self._model
+        dialect_name = session.get_bind().dialect.name
+        if dialect_name == "sqlite":
+            statement = self._sqlite_query(q)
+        elif dialect_name == "postgresql":
+            statement = self._postgresql_query(q)
+        else:
+            raise NotImplementedError(f"Search is not supported by this dialect: {dialect_name}.")
+        if statement is None:
+            return [], None
+
+        score = statement.selected_columns.score
+        if after is not None:
+            try:
+                after_score, after_id = after.split(":")
+                cursor = (float(after_score), int(after_id))
+            except ValueError:
+                raise ValidationFailed(f"Invalid cursor: {after}")
+            statement = statement.where(tuple_(score.element, model.id) > cursor)  # type: ignore
+
+        rows = session.execute(statement.order_by(score, model.id).limit(limit)).all()  # type: ignore
+        next_cursor = f"{rows[-1].score!r}:{rows[-1][0].id}" if len(rows) == limit else None
+        return [row[0] for row in rows], next_cursor
+
+    def _sqlite_query(self, q: str):
+        """
+        Builds the FTS5 query, every word of the search text must match the prefix of a word.
+        """
+        words = re.findall(r"\w+", q)
+        if not words:
+            return None
+        match = " ".join(f'"{word}"*' for word in words)
+        fts = table(self._fts_name, column("rowid"))
+        return (
+            select(self._model, func.bm25(literal_column(self._fts_name)).label("score"))
+            .join(fts, fts.c.rowid == self._model.id)  # type: ignore
+            .where(literal_column(self._fts_name).op("MATCH")(match))
+        )
+
+    def _postgresql_query(self, q: str):
+        """
+        Builds the trigram query, every word of the search text must match a substring of a trigram column or the
+        prefix of a prefix column, case-insensitively.
+        """
+        words = re.findall(r"\w+", q)
+        if not words:
+            return None
+        conditions = []
+        for word in words:
+            escaped = word.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            conditions.append(
+                or_(
+                    *(getattr(self._model, column).ilike(f"%{escaped}%") for column in self._trigram_columns),
+                    *(func.lower(getattr(self._model, column)).like(f"{escaped}%") for column in self._prefix_columns),
+                )
+            )
+        # Compare double precision scores, so the cursor survives the round trip exactly.
+        text = " ".join(words)
+        similarities = [cast(func.similarity(getattr(self._model, column), text), Float) for column in self._columns]
+        score = -func.greatest(*similarities) if len(similarities) > 1 else -similarities[0]
+        return select(self._model, score.label("score")).where(*conditions)
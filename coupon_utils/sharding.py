@@ -0,0 +1,31 @@
+from hashlib import blake2b
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """
+    Jump consistent hash (Lamping and Veach), maps a 64-bit key to one of the buckets.
+
+    Growing the number of buckets from N to N + 1 moves only a 1 / (N + 1) share of the keys, all to the new bucket.
+
+    Arguments:
+        key: An unsigned 64-bit integer.
+        buckets: The number of buckets.
+    """
+    bucket, next_bucket = -1, 0
+    while next_bucket < buckets:
+        bucket = next_bucket
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        next_bucket = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def shard_index(key: str, shards: int) -> int:
+    """
+    Returns the shard of a string key, stable across processes and Python versions.
+
+    Arguments:
+        key: The sharding key.
+        shards: The number of shards.
+    """
+    digest = blake2b(key.encode(), digest_size=8).digest()
+    return jump_hash(int.from_bytes(digest, "big"), shards)
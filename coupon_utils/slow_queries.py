@@ -0,0 +1,283 @@
+from collections import defaultdict
+from contextvars import ContextVar
+from datetime import datetime
+import inspect
+import json
+import logging
+from pathlib import Path
+from queue import Full, Queue
+import re
+import sys
+from threading import current_thread, Lock, Thread
+import time
+from typing import Any, Iterable, NamedTuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# The statements with a captured plan, the others are logged without one.
+EXPLAINED_STATEMENTS = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+# The longest parameter list recorded with a statement.
+MAX_PARAMETERS_LENGTH = 1000
+
+# The number of statements whose plan is kept, to log it with their next slow executions.
+MAX_PLANS = 1000
+
+# A list of placeholders, e.g. the expanded `IN` list of a statement.
+PLACEHOLDER_LIST = re.compile(r"\((?:\s*(?:\?|%\(\w+\)s|:\w+)\s*,)+\s*(?:\?|%\(\w+\)s|:\w+)\s*\)")
+
+# The plan steps reading a whole table.
+FULL_SCAN = re.compile(r"^\s*SCAN (?!.*(?:USING (?:COVERING )?INDEX|VIRTUAL TABLE))|Seq Scan", re.MULTILINE)
+
+# The qualified name of a public service method.
+SERVICE_METHOD = re.compile(r"\w+Service\.[a-z]\w*")
+
+# The scope of the current HTTP request.
+_request: ContextVar[dict | None] = ContextVar("coupon_request", default=None)
+
+
+class RequestContextMiddleware:
+    """
+    ASGI middleware keeping the current request available to the slow-query log.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = _request.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request.reset(token)
+
+
+def current_route() -> str | None:
+    """
+    Returns the method and the route of the current HTTP request.
+    """
+    scope = _request.get()
+    if scope is None:
+        return None
+    return f"{scope['method']} {getattr(scope.get('route'), 'path', scope['path'])}"
+
+
+def current_service_method() -> str | None:
+    """
+    Returns the innermost public service method of the call stack, e.g. `CouponService.apply_by_code`.
+
+    A frame is a method call when the attribute of the class of its `self` named after the code runs that code.
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        instance = frame.f_locals.get("self")
+        if instance is not None:
+            method = inspect.unwrap(getattr(type(instance), code.co_name, None))  # type: ignore
+            if getattr(method, "__code__", None) is code and SERVICE_METHOD.fullmatch(method.__qualname__):
+                return method.__qualname__
+        frame = frame.f_back  # type: ignore
+    return None
+
+
+class SlowQueryLog:
+    """
+    Logs the SQL statements slower than a threshold to a file, one JSON object per line.
+
+    A record has the statement, its parameters, its duration, and the route and service method running it. The plan
+    of a statement is captured with `EXPLAIN` (`EXPLAIN QUERY PLAN` on SQLite) by a background thread, on a connection
+    of its own. At most one plan is captured per `explain_interval` seconds, and a statement is explained once.
+    Records are dropped while the queue of the background thread is full, so the log never slows the statements down.
+    """
+
+    def __init__(self, path: Path, threshold: float, explain_interval: float, max_queued: int = 1000) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            path: The file of the log.
+            threshold: The duration of a slow statement, in seconds.
+            explain_interval: The minimum interval between two `EXPLAIN`, in seconds.
+            max_queued: The maximum number of records waiting for the background thread.
+        """
+        self.path = path
+        self.threshold = threshold
+        self.explain_interval = explain_interval
+        self.dropped = 0
+        self._queue: Queue = Queue(max_queued)
+        self._plans: dict[str, str] = {}
+        self._last_explain = float("-inf")
+        self._lock = Lock()
+        self._thread: Thread | None = None
+
+    def install(self, engine: Engine, explain_engine: Engine | None = None) -> None:
+        """
+        Times the statements of an engine.
+
+        Arguments:
+            engine: The engine of the statements.
+            explain_engine: The engine running the `EXPLAIN` of its statements, `engine` by default.
+        """
+        explain_engine = explain_engine or engine
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def before_execute(connection, cursor, statement, parameters, context, executemany) -> None:
+            connection.info.setdefault("slow_query_starts", []).append(time.perf_counter())
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def after_execute(connection, cursor, statement, parameters, context, executemany) -> None:
+            starts = connection.info.get("slow_query_starts")
+            if not starts:
+                return
+            if current_thread() is self._thread:
+                # The plans captured by the log are not logged.
+                starts.pop()
+                return
+            duration = time.perf_counter() - starts.pop()
+            if duration >= self.threshold:
+                if executemany:
+                    parameters = parameters[0] if parameters else None
+                self.record(explain_engine, statement, parameters, duration)
+
+        @event.listens_for(engine, "handle_error")
+        def handle_error(context) -> None:
+            if context.connection is not None and context.connection.info.get("slow_query_starts"):
+                context.connection.info["slow_query_starts"].pop()
+
+    def record(self, engine: Engine, statement: str, parameters: Any, duration: float) -> None:
+        """
+        Queues the record of a slow statement for the background thread.
+        """
+        record = {
+            "at": datetime.utcnow().isoformat(),
+            "duration": duration,
+            "statement": statement,
+            "parameters": repr(parameters)[:MAX_PARAMETERS_LENGTH],
+            "route": current_route(),
+            "service": current_service_method(),
+        }
+        self._start()
+        try:
+            self._queue.put_nowait((engine, parameters, record))
+        except Full:
+            with self._lock:
+                self.dropped += 1
+
+    def flush(self) -> None:
+        """
+        Waits until the queued records are written.
+        """
+        if self._thread is not None:
+            self._queue.join()
+
+    def _start(self) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = Thread(target=self._run, name="slow-query-log", daemon=True)
+                    self._thread.start()
+
+    def _run(self) -> None:
+        with self.path.open("a", encoding="utf-8", buffering=1) as file:
+            while True:
+                engine, parameters, record = self._queue.get()
+                try:
+                    record["plan"] = self._plan(engine, record["statement"], parameters)
+                    file.write(json.dumps(record, default=str) + "\n")
+                except Exception:
+                    logger.exception("Slow-query log failed.")
+                finally:
+                    self._queue.task_done()
+
+    def _plan(self, engine: Engine, statement: str, parameters: Any) -> str | None:
+        """
+        Returns the plan of a statement, if it is explained and the rate limit allows it.
+        """
+        key = normalize(statement)
+        if key in self._plans:
+            return self._plans[key]
+        if not statement.lstrip().upper().startswith(EXPLAINED_STATEMENTS):
+            return None
+        if time.monotonic() - self._last_explain < self.explain_interval:
+            return None
+        self._last_explain = time.monotonic()
+
+        explain = "EXPLAIN QUERY PLAN " if engine.dialect.name == "sqlite" else "EXPLAIN "
+        with engine.connect() as connection:
+            rows = connection.exec_driver_sql(explain + statement, parameters or ()).all()
+        # SQLite returns (id, parent, notused, detail) rows, PostgreSQL one text line per row.
+        plan = "\n".join(str(row[-1]) for row in rows)
+        if len(self._plans) >= MAX_PLANS:
+            self._plans.clear()
+        self._plans[key] = plan
+        return plan
+
+
+class StatementSummary(NamedTuple):
+    """
+    The slow executions of a statement.
+    """
+
+    statement: str
+    calls: int
+    total: float
+    max: float
+    routes: list[str]
+    services: list[str]
+    plan: str | None
+
+    @property
+    def full_scan(self) -> bool:
+        """
+        Whether the plan reads a whole table.
+        """
+        return self.plan is not None and FULL_SCAN.search(self.plan) is not None
+
+
+def normalize(statement: str) -> str:
+    """
+    Returns the statement with its placeholder lists collapsed, so expanded `IN` lists of any length match.
+    """
+    return PLACEHOLDER_LIST.sub("(...)", " ".join(statement.split()))
+
+
+def summarize(records: Iterable[dict[str, Any]]) -> list[StatementSummary]:
+    """
+    Groups slow-query records by statement, ordered by total time.
+    """
+    groups: defaultdict[str, list[dict[str, Any]]] = defaultdict(list)
+    for record in records:
+        groups[normalize(record["statement"])].append(record)
+
+    summaries = []
+    for statement, group in groups.items():
+        durations = [record["duration"] for record in group]
+        plans = [record["plan"] for record in group if record.get("plan")]
+        summaries.append(
+            StatementSummary(
+                statement=statement,
+                calls=len(group),
+                total=sum(durations),
+                max=max(durations),
+                routes=sorted({record["route"] for record in group if record.get("route")}),
+                services=sorted({record["service"] for record in group if record.get("service")}),
+                plan=plans[-1] if plans else None,
+            )
+        )
+    return sorted(summaries, key=lambda summary: summary.total, reverse=True)
+
+
+def read_log(path: Path) -> Iterable[dict[str, Any]]:
+    """
+    Reads the records of a slow-query log file.
+    """
+    with path.open(encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
@@ -0,0 +1,405 @@
+from collections import defaultdict
+from datetime import datetime
+import logging
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+import time
+from typing import Any, Callable, Iterable, NamedTuple
+
+from pydantic import BaseModel
+from sqlalchemy import delete, func, JSON, select
+from sqlalchemy.engine import Engine
+from sqlmodel import col, Column, Field, Session, SQLModel
+
+from coupon_utils.db import execute_dml
+
+logger = logging.getLogger(__name__)
+
+# The task handlers by task name, see `handler()`.
+Handler = Callable[[Session, list[dict[str, Any]]], None]
+HANDLERS: dict[str, Handler] = {}
+
+# Tells a worker thread to stop.
+_STOP = object()
+
+# A stored task is moved to the dead letters after this many failed runs.
+MAX_ATTEMPTS = 5
+
+
+def handler(name: str) -> Callable[[Handler], Handler]:
+    """
+    Registers the handler of the tasks with the given name.
+
+    A handler is called with a session and the payloads of a batch of tasks, in one transaction it must not commit.
+    """
+
+    def register(function: Handler) -> Handler:
+        HANDLERS[name] = function
+        return function
+
+    return register
+
+
+def run_tasks(session: Session, tasks: Iterable[tuple[str, dict[str, Any]]]) -> None:
+    """
+    Runs the handlers of the tasks within the current transaction, one call per task name.
+
+    Arguments:
+        session: The session instance.
+        tasks: Task name and payload pairs.
+    """
+    batches: defaultdict[str, list[dict[str, Any]]] = defaultdict(list)
+    for name, payload in tasks:
+        batches[name].append(payload)
+    for name, payloads in batches.items():
+        HANDLERS[name](session, payloads)
+
+
+def run_tasks_isolated(session: Session, tasks: Iterable[tuple[str, dict[str, Any]]]) -> dict[str, str]:
+    """
+    Runs the handlers of the tasks within the current transaction, one savepoint per task name.
+
+    A failing or unregistered task name is rolled back to its savepoint, the other names are still run.
+
+    Arguments:
+        session: The session instance.
+        tasks: Task name and payload pairs.
+
+    Returns:
+        The error of each failed task name.
+    """
+    batches: defaultdict[str, list[dict[str, Any]]] = defaultdict(list)
+    for name, payload in tasks:
+        batches[name].append(payload)
+    errors = {}
+    for name, payloads in batches.items():
+        if name not in HANDLERS:
+            errors[name] = f"No handler for the task {name!r}."
+            continue
+        try:
+            with session.begin_nested():
+                HANDLERS[name](session, payloads)
+        except Exception as exception:
+            errors[name] = repr(exception)
+    return errors
+
+
+class TaskTable(SQLModel, table=True):
+    """
+    A task waiting in the durable queue.
+    """
+
+    __tablename__ = "tasks"
+
+    id: int | None = Field(default=None, primary_key=True)
+    name: str
+    payload: dict[str, Any] = Field(sa_column=Column(JSON, nullable=False))
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    # The failed runs of the task, and the error of the last one.
+    attempts: int = 0
+    last_error: str | None = None
+
+
+class TaskDeadLetterTable(SQLModel, table=True):
+    """
+    A task given up after too many failed runs, kept for inspection.
+    """
+
+    __tablename__ = "tasks_dead"
+
+    id: int | None = Field(default=None, primary_key=True)
+    name: str
+    payload: dict[str, Any] = Field(sa_column=Column(JSON, nullable=False))
+    created_at: datetime
+    attempts: int
+    last_error: str | None = None
+    failed_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+class TaskMetrics(BaseModel):
+    """
+    The state of the task queues of a process.
+    """
+
+    # Tasks waiting in memory, and in the durable queue of the database.
+    queued: int
+    stored: int
+    # Tasks run, and failed and stored for a retry, since the start of the process.
+    processed: int
+    failed: int
+    # Tasks given up after too many failed runs, in the database.
+    dead: int
+    # The age of the oldest waiting task, in seconds.
+    lag_seconds: float
+
+
+class QueuedTask(NamedTuple):
+    engine: Engine
+    name: str
+    payload: dict[str, Any]
+    created_at: datetime
+
+
+class TaskExecutor:
+    """
+    Runs tasks, e.g. the side effects of a committed redemption, on a bounded pool of background threads.
+
+    A worker takes up to `batch_size` queued tasks at once and runs them in one transaction per database, with one
+    savepoint per task name. The tasks are stored in the `tasks` table instead when the in-memory queue is full, when
+    they fail, and when the executor stops, so they are not lost. The workers run the stored tasks every
+    `poll_interval` seconds, a task failing `max_attempts` times is moved to the `tasks_dead` table.
+    Without workers, a task runs at once in the thread submitting it.
+    """
+
+    def __init__(
+        self,
+        workers: int = 1,
+        max_queued: int = 10_000,
+        batch_size: int = 100,
+        poll_interval: float = 5.0,
+        max_attempts: int = MAX_ATTEMPTS,
+    ) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            workers: The number of worker threads, 0 to run the tasks when they are submitted.
+            max_queued: The maximum number of tasks waiting in memory.
+            batch_size: The maximum number of tasks run in one transaction.
+            poll_interval: The interval between two runs of the stored tasks, in seconds.
+            max_attempts: The failed runs after which a task is moved to the dead letters.
+        """
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.processed = 0
+        self.failed = 0
+        self._queue: Queue = Queue(max_queued)
+        self._engines: set[Engine] = set()
+        self._lock = Lock()
+        self._threads: list[Thread] = []
+
+    def watch(self, engine: Engine) -> None:
+        """
+        Starts running the stored tasks of a database, the databases of submitted tasks are watched too.
+        """
+        with self._lock:
+            self._engines.add(engine)
+        self._start()
+
+    def submit(self, engine: Engine, name: str, payload: dict[str, Any]) -> None:
+        """
+        Queues a task, call it after the commit of the transaction it follows.
+
+        Arguments:
+            engine: The database of the task.
+            name: The name of the task handler.
+            payload: The JSON-serializable argument of the handler.
+        """
+        task = QueuedTask(engine, name, payload, datetime.utcnow())
+        if self.workers == 0:
+            self._run([task])
+            return
+        self.watch(engine)
+        try:
+            self._queue.put_nowait(task)
+        except Full:
+            self._store([task])
+
+    def flush(self) -> None:
+        """
+        Waits until the queued tasks are run or stored.
+        """
+        if self._threads:
+            self._queue.join()
+
+    def stop(self) -> None:
+        """
+        Stops the workers after the batches in progress, the tasks still queued are stored.
+        """
+        threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(_STOP)
+        for thread in threads:
+            thread.join()
+        queued = []
+        while True:
+            try:
+                task = self._queue.get_nowait()
+            except Empty:
+                break
+            self._queue.task_done()
+            if task is not _STOP:
+                queued.append(task)
+        self._store(queued)
+
+    def drain(self, engine: Engine) -> int:
+        """
+        Runs the tasks stored in a database, by batches.
+
+        A batch is claimed by deleting its rows in the transaction running it, so concurrent executors never run a
+        task twice. The tasks of a failed task name are stored again with their error, for the next drain, or moved
+        to the dead letters after `max_attempts` runs.
+
+        Returns:
+            The number of tasks run.
+        """
+        count = 0
+        last_id = 0
+        while True:
+            with Session(engine) as session:
+                rows = session.execute(
+                    select(TaskTable.__table__)  # type: ignore
+                    .where(col(TaskTable.id) > last_id)
+                    .order_by(TaskTable.id)
+                    .limit(self.batch_size)
+                ).all()
+                if not rows:
+                    return count
+                claimed = execute_dml(session, delete(TaskTable).where(col(TaskTable.id).in_([row.id for row in rows])))
+                if claimed.rowcount != len(rows):
+                    # Another executor claimed some of the tasks, the rest is taken again with the next batch.
+                    session.rollback()
+                    continue
+                last_id = rows[-1].id
+                errors = run_tasks_isolated(session, ((row.name, row.payload) for row in rows))
+                failed = [dict(row._mapping) for row in rows if row.name in errors]
+                self._retry(session, failed, errors)
+                session.commit()
+            count += len(rows) - len(failed)
+            with self._lock:
+                self.processed += len(rows) - len(failed)
+                self.failed += len(failed)
+
+    def metrics(self, engine: Engine) -> TaskMetrics:
+        """
+        Returns the state of the queues of the executor and of the durable queue of a database.
+        """
+        with self._queue.mutex:
+            waiting = [task for task in self._queue.queue if task is not _STOP]
+        with Session(engine) as session:
+            stored, oldest_stored = session.execute(select(func.count(), func.min(TaskTable.created_at))).one()
+            dead = session.execute(select(func.count()).select_from(TaskDeadLetterTable)).scalar_one()
+        oldest = min((task.created_at for task in waiting), default=None)
+        if oldest_stored is not None:
+            oldest = oldest_stored if oldest is None else min(oldest, oldest_stored)
+        return TaskMetrics(
+            queued=len(waiting),
+            stored=stored,
+            processed=self.processed,
+            failed=self.failed,
+            dead=dead,
+            lag_seconds=0.0 if oldest is None else max(0.0, (datetime.utcnow() - oldest).total_seconds()),
+        )
+
+    def _start(self) -> None:
+        if len(self._threads) < self.workers:
+            with self._lock:
+                while len(self._threads) < self.workers:
+                    thread = Thread(target=self._work, name=f"tasks-{len(self._threads)}", daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+
+    def _work(self) -> None:
+        next_poll = time.monotonic()
+        while True:
+            batch = []
+            stop = False
+            try:
+                task = self._queue.get(timeout=max(0.0, next_poll - time.monotonic()))
+                while True:
+                    if task is _STOP:
+                        stop = True
+                        self._queue.task_done()
+                        break
+                    batch.append(task)
+                    if len(batch) >= self.batch_size:
+                        break
+                    task = self._queue.get_nowait()
+            except Empty:
+                pass
+
+            if batch:
+                self._run(batch)
+                for _ in batch:
+                    self._queue.task_done()
+            if stop:
+                return
+            if time.monotonic() >= next_poll:
+                next_poll = time.monotonic() + self.poll_interval
+                with self._lock:
+                    engines = list(self._engines)
+                for engine in engines:
+                    try:
+                        self.drain(engine)
+                    except Exception:
+                        logger.exception("Stored tasks failed.")
+
+    def _run(self, tasks: list[QueuedTask]) -> None:
+        """
+        Runs the tasks in one transaction per database, the tasks of a failed task name or transaction are stored.
+        """
+        by_engine: defaultdict[Engine, list[QueuedTask]] = defaultdict(list)
+        for task in tasks:
+            by_engine[task.engine].append(task)
+        for engine, engine_tasks in by_engine.items():
+            try:
+                with Session(engine) as session:
+                    errors = run_tasks_isolated(session, ((task.name, task.payload) for task in engine_tasks))
+                    failed = [
+                        {"name": task.name, "payload": task.payload, "created_at": task.created_at, "attempts": 0}
+                        for task in engine_tasks
+                        if task.name in errors
+                    ]
+                    self._retry(session, failed, errors)
+                    session.commit()
+            except Exception:
+                logger.exception("Tasks failed.")
+                with self._lock:
+                    self.failed += len(engine_tasks)
+                self._store(engine_tasks)
+            else:
+                with self._lock:
+                    self.processed += len(engine_tasks) - len(failed)
+                    self.failed += len(failed)
+
+    def _retry(self, session: Session, tasks: list[dict[str, Any]], errors: dict[str, str]) -> None:
+        """
+        Stores failed tasks again with one more attempt and their error, or moves them to the dead letters.
+        """
+        for name, error in errors.items():
+            logger.error("Tasks %s failed: %s", name, error)
+        retried, dead = [], []
+        for task in tasks:
+            task = task | {"attempts": task["attempts"] + 1, "last_error": errors[task["name"]]}
+            if task["attempts"] >= self.max_attempts:
+                task.pop("id", None)
+                dead.append(task)
+            else:
+                retried.append(task)
+        if retried:
+            session.execute(TaskTable.__table__.insert(), retried)  # type: ignore
+        if dead:
+            session.execute(TaskDeadLetterTable.__table__.insert(), dead)  # type: ignore
+
+    def _store(self, tasks: list[QueuedTask]) -> None:
+        """
+        Writes the tasks to the durable queue of their database.
+        """
+        by_engine: defaultdict[Engine, list[QueuedTask]] = defaultdict(list)
+        for task in tasks:
+            by_engine[task.engine].append(task)
+        for engine, engine_tasks in by_engine.items():
+            try:
+                with Session(engine) as session:
+                    session.execute(
+                        TaskTable.__table__.insert(),  # type: ignore
+                        [
+                            {"name": task.name, "payload": task.payload, "created_at": task.created_at}
+                            for task in engine_tasks
+                        ],
+                    )
+                    session.commit()
+            except Exception:
+                logger.exception("Lost %d tasks.", len(engine_tasks))
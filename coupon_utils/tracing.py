@@ -0,0 +1,419 @@
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import inspect
+import json
+from pathlib import Path
+import random
+import re
+from threading import Lock
+import time
+from typing import Any, Callable, Protocol, TypeVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+T = TypeVar("T")
+
+# The OTLP span kinds and status codes.
+SPAN_KINDS = {"internal": 1, "server": 2, "client": 3}
+STATUS_UNSET, STATUS_ERROR = 0, 2
+
+# The longest SQL statement recorded in a span.
+MAX_STATEMENT_LENGTH = 2000
+
+# A W3C `traceparent` header: version, trace ID, parent span ID and flags.
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+
+class Span:
+    """
+    A timed operation of a trace, with its attributes.
+
+    The times are nanoseconds since the epoch, `end` is 0 until the span ends.
+    """
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "start", "end", "attributes", "error")
+
+    def __init__(
+        self, trace_id: str, parent_id: str | None, name: str, kind: str, attributes: dict[str, Any] | None
+    ) -> None:
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start = time.time_ns()
+        self.end = 0
+        self.attributes = attributes or {}
+        self.error: str | None = None
+
+    @property
+    def duration(self) -> float:
+        """
+        The duration of the ended span, in seconds.
+        """
+        return (self.end - self.start) / 1e9
+
+    def to_otlp(self) -> dict[str, Any]:
+        """
+        Returns the span in the OTLP JSON encoding.
+        """
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": SPAN_KINDS[self.kind],
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": otlp_attributes(self.attributes),
+            "status": {"code": STATUS_UNSET} if self.error is None else {"code": STATUS_ERROR, "message": self.error},
+        }
+        if self.parent_id is not None:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def otlp_attributes(attributes: dict[str, Any]) -> list[dict[str, Any]]:
+    """
+    Returns attributes in the OTLP JSON encoding.
+    """
+    encoded = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            encoded.append({"key": key, "value": {"boolValue": value}})
+        elif isinstance(value, int):
+            encoded.append({"key": key, "value": {"intValue": str(value)}})
+        elif isinstance(value, float):
+            encoded.append({"key": key, "value": {"doubleValue": value}})
+        else:
+            encoded.append({"key": key, "value": {"stringValue": str(value)}})
+    return encoded
+
+
+class Exporter(Protocol):
+    def export(self, span: Span) -> None: ...
+
+
+class MemoryExporter:
+    """
+    Keeps the last ended spans in memory.
+    """
+
+    __slots__ = "spans"
+
+    def __init__(self, max_spans: int = 10_000) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            max_spans: The number of kept spans, the oldest ones are dropped first.
+        """
+        self.spans: deque[Span] = deque(maxlen=max_spans)
+
+    def export(self, span: Span) -> None:
+        self.spans.append(span)
+
+
+class FileExporter:
+    """
+    Appends the ended spans to a file, one OTLP JSON `ExportTraceServiceRequest` per line.
+
+    This is the format of the file exporter of the OpenTelemetry Collector, which can replay the file to a tracer.
+    """
+
+    __slots__ = ("_file", "_lock", "_resource")
+
+    def __init__(self, path: Path, service_name: str) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            path: The file of the spans.
+            service_name: The `service.name` resource attribute of the spans.
+        """
+        self._file = path.open("a", encoding="utf-8", buffering=1)
+        self._lock = Lock()
+        self._resource = {"attributes": otlp_attributes({"service.name": service_name})}
+
+    def export(self, span: Span) -> None:
+        request = {
+            "resourceSpans": [
+                {
+                    "resource": self._resource,
+                    "scopeSpans": [{"scope": {"name": __name__}, "spans": [span.to_otlp()]}],
+                }
+            ]
+        }
+        line = json.dumps(request, separators=(",", ":"))
+        with self._lock:
+            self._file.write(line + "\n")
+
+
+# The current span, or `_DROPPED` within a trace that was not sampled.
+_DROPPED = object()
+_current: ContextVar[Any] = ContextVar("coupon_span", default=None)
+
+
+class Tracer:
+    """
+    Records spans and sends them to an exporter once they end.
+
+    Sampling is decided once per trace by its root span, the spans within a dropped trace cost a context lookup.
+    Tracing is disabled until an exporter is configured.
+    """
+
+    __slots__ = ("sample_rate", "exporter")
+
+    def __init__(self) -> None:
+        self.sample_rate = 0.0
+        self.exporter: Exporter | None = None
+
+    def configure(self, sample_rate: float, exporter: Exporter | None) -> None:
+        """
+        Sets the share of the sampled traces, between 0 and 1, and the exporter of their spans.
+        """
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+
+    def current(self) -> Span | None:
+        """
+        Returns the current span if the current trace is sampled.
+        """
+        span = _current.get()
+        return span if isinstance(span, Span) else None
+
+    def start(
+        self,
+        name: str,
+        kind: str = "internal",
+        attributes: dict[str, Any] | None = None,
+        *,
+        root: bool = True,
+        trace_id: str | None = None,
+        parent_id: str | None = None,
+        sampled: bool | None = None,
+    ) -> Span | None:
+        """
+        Starts a child of the current span, or a new trace if there is none, without making it current.
+
+        Arguments:
+            name: The name of the span.
+            kind: `internal`, `server` or `client`.
+            attributes: The attributes of the span.
+            root: Whether the span can start a trace, otherwise it is only recorded within a trace.
+            trace_id: The ID of a remote trace the new trace joins.
+            parent_id: The ID of the remote parent span of the new trace.
+            sampled: The sampling decision of the remote parent, overriding the sample rate.
+
+        Returns:
+            The span, or `None` if it is not recorded.
+        """
+        parent = _current.get()
+        if parent is _DROPPED or self.exporter is None:
+            return None
+        if parent is not None:
+            return Span(parent.trace_id, parent.span_id, name, kind, attributes)
+        if not root or not (random.random() < self.sample_rate if sampled is None else sampled):
+            return None
+        return Span(trace_id or f"{random.getrandbits(128):032x}", parent_id, name, kind, attributes)
+
+    def end(self, span: Span, error: str | None = None) -> None:
+        """
+        Ends a span and exports it.
+        """
+        span.end = time.time_ns()
+        if error is not None:
+            span.error = error
+        if self.exporter is not None:
+            self.exporter.export(span)
+
+    @contextmanager
+    def span(self, name: str, kind: str = "internal", attributes: dict[str, Any] | None = None, **options):
+        """
+        Records the block as a span, current within the block, see `start()` for the arguments.
+
+        Yields:
+            The span, or `None` if it is not recorded.
+        """
+        starts_trace = _current.get() is None and options.get("root", True)
+        span = self.start(name, kind, attributes, **options)
+        if span is None and not starts_trace:
+            yield None
+            return
+
+        token = _current.set(_DROPPED if span is None else span)
+        error = None
+        try:
+            yield span
+        except BaseException as exception:
+            error = repr(exception)
+            raise
+        finally:
+            _current.reset(token)
+            if span is not None:
+                self.end(span, error)
+
+
+# The tracer of the application.
+tracer = Tracer()
+
+
+def traced(function: Callable[..., T]) -> Callable[..., T]:
+    """
+    Records each call of the function as a span named after its qualified name.
+    """
+    name = function.__qualname__
+
+    @wraps(function)
+    def wrapper(*args, **kwargs) -> T:
+        if tracer.exporter is None:
+            return function(*args, **kwargs)
+        with tracer.span(name, attributes={"code.function": name}):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def trace_methods(cls: type[T]) -> type[T]:
+    """
+    Class decorator, applies `traced()` to the public methods defined by the class.
+
+    Static methods and generators are left alone, a span would not cover the consumption of a generator.
+    """
+    for name, attribute in list(vars(cls).items()):
+        if name.startswith("_") or not inspect.isfunction(attribute) or inspect.isgeneratorfunction(attribute):
+            continue
+        setattr(cls, name, traced(attribute))
+    return cls
+
+
+def parse_traceparent(header: str | None) -> dict[str, Any]:
+    """
+    Returns the remote parent of a W3C `traceparent` header as `Tracer.start()` options, if the header is valid.
+    """
+    match = TRACEPARENT.match(header or "")
+    if match is None or match[1] == "0" * 32 or match[2] == "0" * 16:
+        return {}
+    return {"trace_id": match[1], "parent_id": match[2], "sampled": bool(int(match[3], 16) & 1)}
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware recording each HTTP request as a server span, including the streaming of its body.
+
+    A request with a `traceparent` header joins the trace of the caller and follows its sampling decision.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http" or tracer.exporter is None:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        remote = parse_traceparent(headers.get(b"traceparent", b"").decode("latin-1"))
+        attributes = {"http.method": scope["method"], "http.target": scope["path"]}
+        with tracer.span(f"{scope['method']} {scope['path']}", "server", attributes, **remote) as span:
+            if span is None:
+                await self.app(scope, receive, send)
+                return
+
+            async def send_traced(message) -> None:
+                if message["type"] == "http.response.start":
+                    span.attributes["http.status_code"] = message["status"]
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_traced)
+            finally:
+                route = getattr(scope.get("route"), "path", None)
+                if route is not None:
+                    span.name = f"{scope['method']} {route}"
+                    span.attributes["http.route"] = route
+            if span.attributes.get("http.status_code", 500) >= 500:
+                span.error = f"HTTP {span.attributes.get('http.status_code')}"
+
+
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany) -> None:
+    span = tracer.start(
+        statement.split(None, 1)[0].upper() if statement else "SQL",
+        "client",
+        {"db.system": connection.dialect.name, "db.statement": statement[:MAX_STATEMENT_LENGTH]},
+        root=False,
+    )
+    connection.info.setdefault("trace_spans", []).append(span)
+
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany) -> None:
+    spans = connection.info.get("trace_spans")
+    span = spans.pop() if spans else None
+    if span is not None:
+        if cursor.rowcount >= 0:
+            span.attributes["db.rows"] = cursor.rowcount
+        tracer.end(span)
+
+
+def _handle_error(context) -> None:
+    spans = context.connection.info.get("trace_spans") if context.connection is not None else None
+    if spans:
+        span = spans.pop()
+        if span is not None:
+            tracer.end(span, repr(context.original_exception))
+
+
+def _after_transaction_create(session: Session, transaction) -> None:
+    if transaction.parent is None:
+        session.info["trace_transaction"] = tracer.start("session.transaction", root=False)
+
+
+def _before_commit(session: Session) -> None:
+    session.info["trace_commit"] = tracer.start("session.commit", root=False)
+
+
+def _after_commit(session: Session) -> None:
+    span = session.info.pop("trace_commit", None)
+    if span is not None:
+        tracer.end(span)
+    transaction = session.info.get("trace_transaction")
+    if transaction is not None:
+        transaction.attributes["db.outcome"] = "committed"
+
+
+def _after_transaction_end(session: Session, transaction) -> None:
+    if transaction.parent is not None:
+        return
+    # A commit span still open here is a failed commit.
+    commit = session.info.pop("trace_commit", None)
+    if commit is not None:
+        tracer.end(commit, "commit failed")
+    span = session.info.pop("trace_transaction", None)
+    if span is not None:
+        span.attributes.setdefault("db.outcome", "rolled back")
+        tracer.end(span)
+
+
+_LISTENERS: list[tuple[Any, str, Callable]] = [
+    (Engine, "before_cursor_execute", _before_cursor_execute),
+    (Engine, "after_cursor_execute", _after_cursor_execute),
+    (Engine, "handle_error", _handle_error),
+    (Session, "after_transaction_create", _after_transaction_create),
+    (Session, "before_commit", _before_commit),
+    (Session, "after_commit", _after_commit),
+    (Session, "after_transaction_end", _after_transaction_end),
+]
+
+
+def instrument_sqlalchemy() -> None:
+    """
+    Records the SQL statements of every engine and the transactions of every session as spans of the current trace.
+
+    Statements and transactions outside a sampled trace are not recorded. Calling it again has no effect.
+    """
+    for target, name, listener in _LISTENERS:
+        if not event.contains(target, name, listener):
+            event.listen(target, name, listener)